@@ -1,29 +1,208 @@
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.exceptions import DisallowedModelAdminLookup
+from django.contrib.admin.utils import build_q_object_from_lookup_parameters, prepare_lookup_value
+from django.contrib.admin.views.main import ERROR_FLAG, IGNORED_PARAMS, PAGE_VAR, SEARCH_VAR, ChangeList
+from django.db import connections
 from app_core.models import *
+from app_core.leaderboard import BOARDS, leaderboard
+from app_core.player_state import STATE_FIELDS, player_state
+from app_core.profiling import profiling
+from app_core.tasks import delete_dogs, delete_players
+
+# Параметр адреса со значением id, после которого начинается страница списка
+KEYSET_VAR = 'after'
+
+
+def estimated_count(queryset):
+    """Число строк таблицы из статистики Postgres (pg_class.reltuples) вместо COUNT(*) по всей таблице."""
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        # -1, пока таблица ни разу не анализировалась
+        if row and row[0] >= 0:
+            return row[0]
+    return queryset.count()
+
+
+class KeysetChangeList(ChangeList):
+    """
+    Список объектов с переходом по страницам через id: следующая страница - объекты с id меньше последнего
+    показанного, поэтому страница читается по индексу первичного ключа без OFFSET на любой глубине. Общее число
+    строк берётся из статистики Postgres, а с фильтром или поиском считается не дальше ADMIN_COUNT_LIMIT.
+    """
+    keyset = True
+
+    def __init__(self, request, *args, **kwargs):
+        try:
+            self.after = int(request.GET.get(KEYSET_VAR) or 0) or None
+        except ValueError:
+            self.after = None
+        super().__init__(request, *args, **kwargs)
+
+    def get_queryset(self, request, exclude_parameters=None):
+        # Фильтры, ссылки переходов и форма поиска строятся без текущего положения в списке
+        self.params.pop(KEYSET_VAR, None)
+        self.filter_params.pop(KEYSET_VAR, None)
+        return super().get_queryset(request, exclude_parameters)
+
+    def get_ordering(self, request, queryset):
+        return ['-pk']
+
+    def get_results(self, request):
+        queryset = self.queryset
+        if self.after is not None:
+            queryset = queryset.filter(pk__lt=self.after)
+        rows = list(queryset[:self.list_per_page + 1])
+        self.result_list = rows[:self.list_per_page]
+        filtered = self.has_active_filters or self.query
+        if filtered:
+            self.result_count = self.queryset[:settings.ADMIN_COUNT_LIMIT + 1].count()
+            if self.result_count > settings.ADMIN_COUNT_LIMIT:
+                self.result_count_label = f'{settings.ADMIN_COUNT_LIMIT}+'
+            else:
+                self.result_count_label = str(self.result_count)
+        else:
+            self.result_count = estimated_count(self.root_queryset)
+            self.result_count_label = f'~{self.result_count}'
+        self.next_page_url = None
+        if len(rows) > self.list_per_page:
+            self.next_page_url = self.get_query_string({KEYSET_VAR: self.result_list[-1].pk})
+        self.first_page_url = self.get_query_string() if self.after is not None else None
+        self.full_result_count = None
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.can_show_all = False
+        # Нумерованные страницы не строятся, переходы рисует шаблон admin/app_core/pagination.html
+        self.multi_page = False
+        self.paginator = None
+
+
+class ScalableModelAdmin(admin.ModelAdmin):
+    """
+    Админка для больших таблиц, которые читает игра: без COUNT(*) и OFFSET, без сортировки по произвольным
+    колонкам и с массовыми действиями в задачах Celery вместо выполнения в запросе.
+    """
+    show_full_result_count = False
+    # Фасеты считают COUNT(*) для каждого значения фильтра
+    show_facets = admin.ShowFacets.NEVER
+    sortable_by = ()
+    ordering = ['-pk']
+    list_per_page = 50
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        # Стандартное удаление загружает все выбранные объекты и их связи в запросе админки
+        actions.pop('delete_selected', None)
+        return actions
+
+    def enqueue(self, request, queryset, task, description):
+        """
+        Ставит одну задачу на выбранные объекты: отмеченные на странице id или, если выбраны все объекты списка,
+        фильтры и поиск списка. Запрос админки не перебирает id, задача сама проходит выбор пачками.
+        """
+        if request.POST.get('select_across') == '1':
+            ignored = {*IGNORED_PARAMS, PAGE_VAR, ERROR_FLAG, KEYSET_VAR}
+            lookups = {key: values for key, values in request.GET.lists() if key not in ignored}
+            task.delay(lookups=lookups, search=request.GET.get(SEARCH_VAR, ''))
+        else:
+            task.delay(ids=list(queryset.values_list('pk', flat=True)))
+        self.message_user(request, f"{description}: задача поставлена в очередь.")
+
+    def selected_pks(self, ids, lookups, search, after, limit):
+        """
+        Пачка id объектов, выбранных действием админки, после id after по возрастанию. Выбор задаётся явными id
+        или фильтрами и поиском списка; фильтры проверяются так же, как в списке.
+        """
+        queryset = self.get_queryset(None)
+        if ids is not None:
+            queryset = queryset.filter(pk__in=ids)
+        else:
+            params = {}
+            for lookup, values in (lookups or {}).items():
+                for value in values:
+                    if not self.lookup_allowed(lookup, value, None):
+                        raise DisallowedModelAdminLookup(f"Фильтр {lookup} не разрешён")
+                params[lookup] = prepare_lookup_value(lookup, values)
+            queryset = queryset.filter(build_q_object_from_lookup_parameters(params))
+            queryset, may_have_duplicates = self.get_search_results(None, queryset, search)
+            if may_have_duplicates:
+                queryset = queryset.distinct()
+        return list(queryset.filter(pk__gt=after).order_by('pk').values_list('pk', flat=True)[:limit])
+
+    def get_search_results(self, request, queryset, search_term):
+        # Поиск идёт по уникальным числовым полям, нечисловой запрос ничего не находит вместо ошибки БД
+        if search_term and not search_term.strip().isdigit():
+            return queryset.none(), False
+        return super().get_search_results(request, queryset, search_term)
 
 
 @admin.register(Player)
-class PlayerAdmin(admin.ModelAdmin):
+class PlayerAdmin(ScalableModelAdmin):
     """Регистрация в админ панели модели Player."""
-    list_display = ['id', 'tg_id', 'name', 'registration_date', 'coins', 'coins_spent_today', 'daily_bonus_friends',
-                    'consecutive_days', 'last_login_date', 'offline_coins', 'start_offline_coins',
-                    'finish_offline_coins', 'coins_in_second', 'finish_second_coins', 'lvl', 'daily_bonus',
-                    'instruction']
+    list_display = ['id', 'tg_id', 'name', 'lvl', 'coins', 'coins_in_second', 'registration_date']
+    search_fields = ['=tg_id']
+    search_help_text = "Поиск по Telegram ID"
+    actions = ['delete_in_background', 'enable_profiling', 'disable_profiling']
 
+    def save_model(self, request, obj, form, change):
+        if not change:
+            super().save_model(request, obj, form, change)
+            return
+        # Сохраняются только изменённые поля: остальные значения формы могли устареть, пока её заполняли
+        obj.save(update_fields=form.changed_data)
+        # Горячие поля живут в Redis и новее, чем в БД: переносим туда только правку, иначе она будет перезаписана
+        # очередным сбросом состояния, а прочие поля не откатываются к значениям из БД
+        player_state.reset(obj, [field for field in form.changed_data if field in STATE_FIELDS])
+        if set(form.changed_data) & set(BOARDS):
+            leaderboard.record_player(player_state.get(obj.tg_id).apply_to(obj))
 
-@admin.register(Dog)
-class DogAdmin(admin.ModelAdmin):
-    """Регистрация в админ панели модели Player."""
-    list_display = ['id', 'player', 'name', 'lvl', 'price', 'percent_up_price', 'bonus_second', 'bonus_connection',
-                    'dog_field', 'is_active']
+    @admin.action(description="Удалить игроков в фоне")
+    def delete_in_background(self, request, queryset):
+        self.enqueue(request, queryset, delete_players, "Удаление игроков")
 
+    @admin.action(description="Профилировать запросы игроков")
+    def enable_profiling(self, request, queryset):
+        tg_ids = list(queryset.values_list('tg_id', flat=True)[:settings.ADMIN_COUNT_LIMIT])
+        for tg_id in tg_ids:
+            profiling.enable_player(tg_id)
+        self.message_user(request, f"Профилирование включено для {len(tg_ids)} игроков на "
+                                   f"{settings.PROFILING_PLAYER_SECONDS} с, отчёты в {settings.PROFILING_DIR}.")
 
-@admin.register(ReferralSystem)
-class ReferralSystemAdmin(admin.ModelAdmin):
-    """Регистрация в админ панели модели ReferralSystem."""
-    list_display = ['id', 'referral', 'new_player', 'referral_bonus', 'new_player_bonus']
+    @admin.action(description="Выключить профилирование игроков")
+    def disable_profiling(self, request, queryset):
+        for tg_id in queryset.values_list('tg_id', flat=True)[:settings.ADMIN_COUNT_LIMIT]:
+            profiling.disable_player(tg_id)
 
 
+@admin.register(Dog)
+class DogAdmin(ScalableModelAdmin):
+    """Регистрация в админ панели модели Dog."""
+    list_display = ['id', 'player', 'name', 'lvl', 'price', 'bonus_second', 'bonus_connection', 'dog_field',
+                    'is_active']
+    list_select_related = ['player']
+    list_filter = ['is_active']
+    raw_id_fields = ['player']
+    search_fields = ['=player__tg_id']
+    search_help_text = "Поиск по Telegram ID игрока"
+    actions = ['delete_in_background']
 
+    @admin.action(description="Удалить собак в фоне")
+    def delete_in_background(self, request, queryset):
+        self.enqueue(request, queryset, delete_dogs, "Удаление собак")
 
 
+@admin.register(ReferralSystem)
+class ReferralSystemAdmin(ScalableModelAdmin):
+    """Регистрация в админ панели модели ReferralSystem."""
+    list_display = ['id', 'referral', 'new_player', 'referral_bonus', 'new_player_bonus']
+    list_select_related = ['referral', 'new_player']
+    raw_id_fields = ['referral', 'new_player']
+    search_fields = ['=new_player__tg_id', '=referral__tg_id']
+    search_help_text = "Поиск по Telegram ID игрока или реферала"
@@ -1,97 +1,264 @@
+from datetime import datetime
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-import json
+from django.conf import settings
+from app_core.models import BOARD_SIZE, Player, Dog
+from app_core.notifications import player_group, player_payload, subscribe, unsubscribe
+from app_core.metrics import set_status, track
+from app_core.player_state import player_state
+from app_core.profiling import PROFILE_HEADER, header_allowed, profile, profiling
+from app_core.rate_limit import rate_limiter
+from app_core.renderers import dumps_text, loads
+from app_core.serializers import compact_payload
+
+ACTIONS = ('get_dogs', 'snapshot', 'create_dog', 'update_dogs', 'delete_dog')
+# Действия, которые обращаются к Redis или БД и поэтому расходуют токены игрока; get_dogs отвечает из памяти
+LIMITED_ACTIONS = ('snapshot', 'create_dog', 'update_dogs', 'delete_dog')
+# Действия, которые можно отправить пачкой в одном сообщении
+BATCH_ACTIONS = ('create_dog', 'update_dogs', 'delete_dog')
+
+
+def _parse_datetime(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+class PlayerSession:
+    """
+    Состояние игрока, которое соединение держит в памяти всё время жизни сокета: горячее состояние из Redis,
+    собаки на 12 местах поля и виртуальная собака. Действия проверяются по нему до обращения к БД,
+    а патчи после каждого изменения поддерживают его актуальным.
+    """
+
+    def __init__(self, tg_id):
+        self.tg_id = tg_id
+        self.state = None
+        self.dogs = {}
+        self.virtual_dog = None
+        self.stale = True
+
+    async def load(self):
+        """Загружает состояние из Redis, игровое поле читается из БД только при промахе кэша."""
+        self.state = await player_state.aget(self.tg_id)
+        board = await player_state.aget_board(self.state)
+        self.dogs = {dog['id']: dog for dog in board['dogs']}
+        self.virtual_dog = board['virtual_dog']
+        self.stale = False
+
+    async def ensure_loaded(self):
+        """Перечитывает состояние, если сессия пропустила патч или игрок ещё не был загружен."""
+        if self.stale:
+            await self.load()
+
+    def apply_patch(self, patch):
+        """Применяет патч к сессии. Возвращает False, если эта версия уже учтена."""
+        if self.state is None or patch['version'] <= self.state.version:
+            return False
+        if patch['version'] != self.state.version + 1:
+            # Пропущена версия: применяем, что пришло, и перечитываем состояние перед следующим действием
+            self.stale = True
+        for dog in list(patch['added']) + list(patch['changed']):
+            self.dogs[dog['id']] = dog
+        for dog_id in patch['removed']:
+            self.dogs.pop(dog_id, None)
+        if patch['virtual_dog'] is not None:
+            self.virtual_dog = patch['virtual_dog']
+        player = patch['player']
+        self.state.coins = player['coins']
+        self.state.coins_in_second = player['coins_in_second']
+        self.state.finish_second_coins = _parse_datetime(player['finish_second_coins'])
+        # Офлайн бонус в патче посчитан на момент finish_second_coins, как и баланс
+        self.state.offline_coins = player['offline_coins']
+        self.state.start_offline_coins = _parse_datetime(player['start_offline_coins'])
+        self.state.finish_offline_coins = _parse_datetime(player['finish_offline_coins'])
+        self.state.version = patch['version']
+        return True
+
+    def snapshot(self, action):
+        """Полное состояние поля из памяти сессии."""
+        return {
+            'action': action,
+            'version': self.state.version,
+            'player': player_payload(self.state),
+            'dogs': list(self.dogs.values()),
+            'virtual_dog': self.virtual_dog,
+        }
+
+    def check_create_dog(self):
+        """Отсекает покупку, которая заведомо не пройдёт: поле заполнено или не хватает монет."""
+        if len(self.dogs) >= BOARD_SIZE:
+            raise ValueError("У игрока уже максимальное количество собак (12).")
+        if self.virtual_dog and self.state.balance() < self.virtual_dog['price']:
+            raise ValueError("У игрока недостаточно денег для создания собаки.")
+
+    def check_update_dogs(self, dog_pairs):
+        """Проверяет пары для скрещивания. Собак, уже затронутых предыдущими парами, проверяет БД."""
+        if not isinstance(dog_pairs, list) or not dog_pairs:
+            raise ValueError("Необходимо передать список пар собак.")
+        touched = set()
+        for dog_ids in dog_pairs:
+            try:
+                dog_ids = {int(dog_id) for dog_id in dog_ids}
+            except (TypeError, ValueError):
+                raise ValueError("Для скрещивания необходимо ровно две собаки.")
+            if dog_ids & touched:
+                touched |= dog_ids
+                continue
+            dogs = [self.dogs[dog_id] for dog_id in dog_ids if dog_id in self.dogs]
+            if len(dogs) != 2:
+                raise ValueError(f"Для скрещивания необходимо ровно две собаки. Найдено: {len(dogs)}")
+            if dogs[0]['lvl'] != dogs[1]['lvl']:
+                raise ValueError("Скрещивать можно только собак одного уровня.")
+            touched |= dog_ids
+
+    def check_delete_dog(self, dog_id):
+        """Проверяет, что собака есть на поле."""
+        try:
+            dog_id = int(dog_id)
+        except (TypeError, ValueError):
+            raise ValueError("Собака не найдена или уже удалена.")
+        if dog_id not in self.dogs:
+            raise ValueError("Собака не найдена или уже удалена.")
 
 
 class DogsPlayerConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        from app_core.models import Player, Dog
         self.tg_id = self.scope['url_route']['kwargs']['tg_id']
+        # ?compact=1: снимки и патчи передают собак массивами значений в порядке поля dog_fields
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.compact = query.get('compact', [''])[0] in ('1', 'true')
+        # Заголовок X-Profile в запросе на подключение включает профилирование всех действий соединения
+        headers = dict(self.scope.get('headers', []))
+        self.profile_requested = header_allowed(headers.get(PROFILE_HEADER.lower().encode(), b'').decode('latin1'))
+        # Все соединения игрока состоят в одной группе и получают изменения, сделанные в любом из них или по HTTP
+        self.group_name = player_group(self.tg_id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        # Состояние игрока загружается один раз на соединение и дальше обновляется патчами
+        self.session = PlayerSession(self.tg_id)
+        subscribe(self.tg_id, self.session)
+        try:
+            await self.session.load()
+        except Player.DoesNotExist:
+            # Сессия остаётся незагруженной, действия ответят, что игрок не найден
+            pass
         await self.accept()
 
     async def disconnect(self, close_code):
-        pass
+        if hasattr(self, 'session'):
+            unsubscribe(self.tg_id, self.session)
+        if hasattr(self, 'group_name'):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def player_update(self, event):
+        """Пересылает клиенту патч, разосланный в группу игрока, и применяет его к сессии."""
+        with track('ws', 'player_update'):
+            self.session.apply_patch(event['message'])
+            await self.send_state(event['message'])
+
+    async def send_state(self, payload):
+        """Отправляет снимок или патч поля в формате, выбранном соединением."""
+        await self.send(dumps_text(compact_payload(payload) if self.compact else payload))
 
     async def receive(self, text_data=None, bytes_data=None):
-        from app_core.models import Player, Dog
-        from app_core.serializers import DogSerializer
-        try:
-            data = json.loads(text_data)
-            action = data.get('action')
-
-            if action == 'get_dogs':
-                await self.get_dogs()
-            elif action == 'create_dog':
-                await self.create_dog()
-            elif action == 'update_dogs':
-                dog_pairs = data.get('dog_pairs', [])
-                await self.update_dogs(dog_pairs)
-            elif action == 'delete_dog':
-                dog_id = data.get('dog_id')
-                await self.delete_dog(dog_id)
-            else:
-                await self.send(json.dumps({"error": "Неизвестное действие"}))
-        except Exception as e:
-            await self.send(json.dumps({"error": str(e)}))
-
-    async def get_dogs(self):
-        from app_core.models import Player, Dog
-        from app_core.serializers import DogSerializer
-        try:
-            player = await Player.objects.aget(tg_id=self.tg_id)
-            dogs = player.dogs.filter(is_active=True)
-            dogs = [dog async for dog in dogs.aiterator()]
-            serializer = DogSerializer(dogs, many=True)
-            virtual_dog = await Dog.get_or_create_virtual_dog(player)
-            virtual_dog_serializer = DogSerializer(virtual_dog)
-
-            await self.send(json.dumps({
-                'action': 'get_dogs',
-                'dogs': serializer.data,
-                'virtual_dog': virtual_dog_serializer.data
+        players = await profiling.aplayers()
+        if self.profile_requested or players and int(self.tg_id) in players:
+            async with profile(f'ws-{self.tg_id}'):
+                await self.handle(text_data)
+        else:
+            await self.handle(text_data)
+
+    async def handle(self, text_data):
+        with track('ws', 'unknown') as metrics:
+            try:
+                data = loads(text_data)
+                action = data.get('action')
+                if action == 'batch':
+                    metrics.action = action
+                    await self.batch(data.get('actions'))
+                elif action in ACTIONS:
+                    metrics.action = action
+                    # Лишние действия отклоняются до обращения к БД
+                    if action in LIMITED_ACTIONS and not await self.acquire(1):
+                        return
+                    await self.perform(action, data)
+                else:
+                    metrics.status = 'error'
+                    await self.send(dumps_text({"error": "Неизвестное действие"}))
+            except Player.DoesNotExist:
+                metrics.status = 'error'
+                await self.send(dumps_text({"error": "Игрок не найден."}))
+            except Exception as e:
+                metrics.status = 'error'
+                await self.send(dumps_text({"error": str(e)}))
+
+    async def acquire(self, cost):
+        """Списывает токены игрока. При превышении частоты сообщает клиенту, через сколько секунд повторить."""
+        allowed, retry_after = await rate_limiter.aacquire(self.tg_id, cost)
+        if not allowed:
+            set_status('throttled')
+            await self.send(dumps_text({
+                "error": "Слишком много действий, повторите позже.",
+                "retry_after": round(retry_after, 3),
             }))
-        except Player.DoesNotExist:
-            await self.send(json.dumps({"error": "Игрок не найден."}))
-        except Exception as e:
-            await self.send(json.dumps({"error": str(e)}))
+        return allowed
 
-    async def create_dog(self):
-        from app_core.models import Player, Dog
-        try:
-            player = await Player.objects.aget(tg_id=self.tg_id)
-            dog = await Dog.create_dog(player)
+    async def perform(self, action, data):
+        if action == 'get_dogs':
             await self.get_dogs()
-        except Player.DoesNotExist:
-            await self.send(json.dumps({"error": "Игрок не найден."}))
-        except ValueError as e:
-            await self.send(json.dumps({"error": str(e)}))
-        except Exception as e:
-            await self.send(json.dumps({"error": str(e)}))
+        elif action == 'snapshot':
+            # Полный снимок для клиента, заметившего пропуск версии в патчах
+            await self.get_dogs(action, reload=True)
+        elif action == 'create_dog':
+            await self.create_dog(data.get('count', 1))
+        elif action == 'update_dogs':
+            await self.update_dogs(data.get('dog_pairs', []))
+        elif action == 'delete_dog':
+            await self.delete_dog(data.get('dog_id'))
 
-    async def update_dogs(self, dog_pairs):
-        from app_core.models import Player, Dog
-        try:
-            player = await Player.objects.aget(tg_id=self.tg_id)
-            if not dog_pairs:
-                await self.send(json.dumps({"error": "Необходимо передать список пар собак."}))
+    async def batch(self, actions):
+        """
+        Выполняет по порядку пачку действий из одного сообщения, например серию быстрых нажатий. Пачка расходует
+        по токену на действие. Первая ошибка останавливает оставшиеся действия, выполненные до неё остаются в силе,
+        а в ответе с ошибкой приходит номер действия.
+        """
+        if not isinstance(actions, list) or not actions:
+            raise ValueError("Необходимо передать список действий.")
+        if len(actions) > settings.PLAYER_RATE_LIMIT_BURST:
+            raise ValueError(f"В пачке может быть не больше {settings.PLAYER_RATE_LIMIT_BURST} действий.")
+        if any(not isinstance(item, dict) or item.get('action') not in BATCH_ACTIONS for item in actions):
+            raise ValueError(f"В пачке допустимы только действия {', '.join(BATCH_ACTIONS)}.")
+        if not await self.acquire(len(actions)):
+            return
+        for index, item in enumerate(actions):
+            try:
+                await self.perform(item['action'], item)
+            except Player.DoesNotExist:
+                set_status('error')
+                await self.send(dumps_text({"error": "Игрок не найден.", "index": index}))
                 return
-            await Dog.breed_dogs(player, dog_pairs)
-            await self.get_dogs()
-        except Player.DoesNotExist:
-            await self.send(json.dumps({"error": "Игрок не найден."}))
-        except ValueError as e:
-            await self.send(json.dumps({"error": str(e)}))
-        except Exception as e:
-            await self.send(json.dumps({"error": str(e)}))
+            except Exception as e:
+                set_status('error')
+                await self.send(dumps_text({"error": str(e), "index": index}))
+                return
+
+    async def get_dogs(self, action='get_dogs', reload=False):
+        if reload:
+            await self.session.load()
+        else:
+            await self.session.ensure_loaded()
+        await self.send_state(self.session.snapshot(action))
+
+    async def create_dog(self, count=1):
+        await self.session.ensure_loaded()
+        self.session.check_create_dog()
+        # Патч с изменениями придёт этому соединению через группу игрока, полный список не переотправляем
+        await Dog.create_dogs(self.session.state, count)
+
+    async def update_dogs(self, dog_pairs):
+        await self.session.ensure_loaded()
+        self.session.check_update_dogs(dog_pairs)
+        await Dog.breed_dogs(self.session.state, dog_pairs)
 
     async def delete_dog(self, dog_id):
-        from app_core.models import Player, Dog
-        try:
-            player = await Player.objects.aget(tg_id=self.tg_id)
-            await Dog.delete_dog(player, dog_id)
-            await self.get_dogs()
-        except Player.DoesNotExist:
-            await self.send(json.dumps({"error": "Игрок не найден."}))
-        except ValueError as e:
-            await self.send(json.dumps({"error": str(e)}))
-        except Exception as e:
-            await self.send(json.dumps({"error": str(e)}))
+        await self.session.ensure_loaded()
+        self.session.check_delete_dog(dog_id)
+        await Dog.delete_dog(self.session.state, dog_id)
@@ -0,0 +1,66 @@
+"""
+Пул соединений с Postgres (psycopg3, встроенный пул Django).
+
+Каждый процесс uvicorn и воркер Celery держит свой пул, поэтому соединение берётся из пула, а не открывается
+на каждый запрос. Когда все соединения заняты, а очередь ожидающих заполнена, новые запросы сразу получают
+503 вместо того, чтобы копиться в очереди и тянуть за собой задержку остальных.
+"""
+import logging
+from django.conf import settings
+from django.db import OperationalError, connections
+from django.http import JsonResponse
+from django.utils.deprecation import MiddlewareMixin
+from psycopg_pool import PoolTimeout, TooManyRequests
+
+logger = logging.getLogger(__name__)
+
+# Ошибки пула: соединение не выдано за DB_POOL_TIMEOUT или очередь ожидания переполнена
+POOL_ERRORS = (PoolTimeout, TooManyRequests)
+
+
+def get_pool(alias='default'):
+    """Пул соединений базы или None, если пул не настроен (например, SQLite)."""
+    return getattr(connections[alias], 'pool', None)
+
+
+def pool_stats(alias='default'):
+    """Счётчики пула psycopg: размер, свободные соединения, ожидающие запросы, время ожидания и ошибки."""
+    pool = get_pool(alias)
+    if pool is None:
+        return None
+    return pool.get_stats()
+
+
+def is_saturated(alias='default'):
+    """Все соединения заняты и очередь ожидающих соединения запросов заполнена."""
+    pool = get_pool(alias)
+    if pool is None:
+        return False
+    return pool.get_stats().get('requests_waiting', 0) >= settings.DB_POOL_MAX_WAITING
+
+
+def is_pool_error(exception):
+    """Ошибка выдачи соединения из пула, в том числе обёрнутая Django в OperationalError."""
+    if isinstance(exception, OperationalError):
+        exception = exception.__cause__
+    return isinstance(exception, POOL_ERRORS)
+
+
+def overloaded_response():
+    response = JsonResponse({"error": "Сервер перегружен, повторите запрос позже."}, status=503)
+    response['Retry-After'] = '1'
+    return response
+
+
+class DatabasePoolBackpressureMiddleware(MiddlewareMixin):
+    """Отклоняет запросы с 503, пока пул соединений процесса перегружен."""
+
+    def process_request(self, request):
+        if is_saturated():
+            logger.warning("Пул соединений с БД перегружен: %s", pool_stats())
+            return overloaded_response()
+
+    def process_exception(self, request, exception):
+        if is_pool_error(exception):
+            logger.warning("Не удалось получить соединение из пула: %s", pool_stats())
+            return overloaded_response()
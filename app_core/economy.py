@@ -0,0 +1,30 @@
+"""Формулы игровой экономики, общие для модели Player и горячего состояния в Redis."""
+from datetime import timedelta
+
+
+def accrue(coins, coins_in_second, settled_at, now):
+    """
+    Ленивое начисление ежесекундного дохода.
+    Баланс - функция от последнего зафиксированного баланса, дохода в секунду, времени фиксации и текущего времени.
+    Возвращает баланс и время, до которого доход учтён. Учитываются только целые секунды, поэтому дробный остаток
+    не теряется при следующей фиксации.
+    """
+    if settled_at is None:
+        return coins, settled_at
+    seconds = max(int((now - settled_at).total_seconds()), 0)
+    return coins + seconds * coins_in_second, settled_at + timedelta(seconds=seconds)
+
+
+def accrue_offline(offline_coins, coins_in_second, settled_at, now, start, finish, percent, max_coins):
+    """
+    Ленивое начисление офлайн бонуса за окно [start, finish]: percent процентов дохода в секунду за каждую секунду
+    окна, но не больше max_coins за окно. Учитываются те же целые секунды с settled_at, что и в accrue, поэтому
+    бонус фиксируется вместе с балансом и доход по старой ставке не пересчитывается по новой.
+    """
+    if settled_at is None or start is None or finish is None:
+        return offline_coins
+    seconds = max(int((now - settled_at).total_seconds()), 0)
+    overlap = (min(settled_at + timedelta(seconds=seconds), finish) - max(settled_at, start)).total_seconds()
+    if overlap <= 0:
+        return offline_coins
+    return min(offline_coins + int(overlap * coins_in_second * percent / 100), max_coins)
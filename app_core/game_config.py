@@ -0,0 +1,119 @@
+"""
+Игровая конфигурация: таблица ежедневных бонусов и параметры прогрессии собак.
+
+Конфигурация читается из JSON-файлов в GAME_CONFIG_DIR и перечитывается без перезапуска процесса: не чаще раза
+в GAME_CONFIG_RELOAD_INTERVAL секунд сверяется время изменения файлов. Версия - хэш содержимого, по ней клиент
+кэширует конфигурацию (ETag) и скачивает её заново только после изменения баланса.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from django.conf import settings
+from app_core.progression import Progression
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FILES = {
+    'daily_bonuses': 'daily_bonuses.json',
+    'progression': 'progression.json',
+}
+
+
+class DailyBonusTable:
+    """
+    Таблица ежедневных бонусов, сжатая в список по номеру дня: бонус за день серии ищется по индексу.
+    Пропущенные в JSON дни дают 0 монет. После последнего дня таблицы действует правило after_last_day:
+    repeat_last - каждый следующий день приносит бонус последнего дня, cycle - таблица начинается заново.
+    """
+    RULES = ('repeat_last', 'cycle')
+
+    def __init__(self, data):
+        self.after_last_day = data.get('after_last_day', 'repeat_last')
+        if self.after_last_day not in self.RULES:
+            raise ValueError(f"Неизвестное правило after_last_day: {self.after_last_day}")
+        bonuses = {bonus['day']: bonus['coins'] for bonus in data['bonuses']}
+        self.coins_by_day = [bonuses.get(day, 0) for day in range(1, max(bonuses, default=0) + 1)]
+
+    def coins(self, day):
+        """Бонус за day-й день серии входов (день считается с 1)."""
+        if not self.coins_by_day or day < 1:
+            return 0
+        if day > len(self.coins_by_day):
+            if self.after_last_day == 'cycle':
+                day = (day - 1) % len(self.coins_by_day) + 1
+            else:
+                day = len(self.coins_by_day)
+        return self.coins_by_day[day - 1]
+
+
+class GameConfig:
+    """Одна версия игровой конфигурации с предрассчитанными таблицами."""
+
+    def __init__(self, sources):
+        self.daily_bonuses = sources['daily_bonuses']['bonuses']
+        self.daily_bonus_table = DailyBonusTable(sources['daily_bonuses'])
+        self.progression = Progression(sources['progression'])
+        content = json.dumps(sources, sort_keys=True, separators=(',', ':')).encode()
+        self.version = hashlib.sha256(content).hexdigest()[:16]
+        self.etag = f'"{self.version}"'
+        self.payload = {
+            'version': self.version,
+            'daily_bonuses': self.daily_bonuses,
+            'daily_bonus_after_last_day': self.daily_bonus_table.after_last_day,
+            'progression': sources['progression'],
+        }
+
+
+class GameConfigLoader:
+    """Держит текущую конфигурацию процесса и перечитывает её при изменении файлов."""
+
+    def __init__(self):
+        self._config = None
+        self._mtimes = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _paths():
+        config_dir = Path(settings.GAME_CONFIG_DIR)
+        return {name: config_dir / file_name for name, file_name in CONFIG_FILES.items()}
+
+    def get(self):
+        """Текущая конфигурация. Проверка файлов - один stat на файл раз в интервал."""
+        now = time.monotonic()
+        if self._config is not None and now - self._checked_at < settings.GAME_CONFIG_RELOAD_INTERVAL:
+            return self._config
+        with self._lock:
+            if self._config is None or now - self._checked_at >= settings.GAME_CONFIG_RELOAD_INTERVAL:
+                self._reload_if_changed()
+                self._checked_at = now
+        return self._config
+
+    def _reload_if_changed(self):
+        paths = self._paths()
+        mtimes = tuple(os.stat(path).st_mtime_ns for path in paths.values())
+        if mtimes == self._mtimes:
+            return
+        sources = {}
+        try:
+            for name, path in paths.items():
+                with open(path, 'r') as file:
+                    sources[name] = json.load(file)
+            config = GameConfig(sources)
+        except (ValueError, KeyError, TypeError):
+            # Файл могли сохранить наполовину или с ошибкой - остаёмся на прежней версии
+            if self._config is None:
+                raise
+            logger.exception("Не удалось перечитать игровую конфигурацию, используется версия %s",
+                             self._config.version)
+            return
+        if self._config is not None and config.version != self._config.version:
+            logger.info("Игровая конфигурация обновлена: %s -> %s", self._config.version, config.version)
+        self._config, self._mtimes = config, mtimes
+
+
+game_config = GameConfigLoader()
@@ -0,0 +1,176 @@
+"""
+Рейтинги игроков в сортированных множествах Redis.
+
+Для каждого рейтинга (монеты, уровень, доход в секунду) ведётся сортированное множество `leaderboard:<рейтинг>`
+с tg_id в качестве элемента. Значения обновляются вместе со сбросом горячего состояния в БД, поэтому топ и место
+игрока читаются за O(log N) без запросов ORDER BY к таблице Player. После потери данных Redis рейтинги
+пересобираются из Postgres одним потоковым проходом задачей `rebuild_leaderboard`, он же раз в период добавляет
+в рейтинг по монетам доход бездействующих игроков.
+"""
+import asyncio
+import logging
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+from app_core.economy import accrue
+
+logger = logging.getLogger(__name__)
+
+BOARDS = ('coins', 'lvl', 'coins_in_second')
+# Рейтинги, которые меняются вместе с горячим состоянием игрока
+STATE_BOARDS = ('coins', 'coins_in_second')
+
+TOP_LIMIT = 100
+NEIGHBOURS_LIMIT = 50
+
+REBUILD_LOCK_KEY = 'leaderboard:rebuild_lock'
+REBUILD_SCHEDULED_KEY = 'leaderboard:rebuild_scheduled'
+# Отметка о том, что рейтинги собраны: без игроков множества пусты и в Redis их нет
+BUILT_KEY = 'leaderboard:built'
+
+
+class Leaderboard:
+    """Рейтинги игроков поверх сортированных множеств Redis."""
+
+    def __init__(self):
+        # Фоновые постановки пересборки в очередь: цикл событий хранит только слабые ссылки на задачи
+        self._pending = set()
+
+    @staticmethod
+    def key(board):
+        return f'leaderboard:{board}'
+
+    @staticmethod
+    def check_board(board):
+        if board not in BOARDS:
+            raise ValueError(f"Неизвестный рейтинг. Доступные рейтинги: {', '.join(BOARDS)}.")
+
+    def record(self, players):
+        """Обновляет рейтинги по монетам и доходу для игроков с уже зафиксированным на текущий момент балансом."""
+        if not players:
+            return
+        pipe = settings.REDIS_INSTANCE.pipeline(transaction=False)
+        for board in STATE_BOARDS:
+            pipe.zadd(self.key(board), {player.tg_id: getattr(player, board) for player in players})
+        pipe.execute()
+
+    def record_player(self, player):
+        """Обновляет все рейтинги игрока, например после правки в админке."""
+        coins = accrue(player.coins, player.coins_in_second, player.finish_second_coins, timezone.now())[0]
+        pipe = settings.REDIS_INSTANCE.pipeline(transaction=False)
+        pipe.zadd(self.key('coins'), {player.tg_id: coins})
+        pipe.zadd(self.key('lvl'), {player.tg_id: player.lvl})
+        pipe.zadd(self.key('coins_in_second'), {player.tg_id: player.coins_in_second})
+        pipe.execute()
+
+    async def atop(self, board, limit):
+        """Первые limit игроков рейтинга."""
+        self.check_board(board)
+        limit = max(1, min(limit, TOP_LIMIT))
+        rows = await settings.REDIS_ASYNC_INSTANCE.zrevrange(self.key(board), 0, limit - 1, withscores=True)
+        if not rows:
+            await self._ensure_built(board)
+        return await self._entries(rows, 1)
+
+    async def aaround(self, board, tg_id, neighbours):
+        """Место игрока и по neighbours соседей выше и ниже. None, если игрока нет в рейтинге."""
+        self.check_board(board)
+        neighbours = max(0, min(neighbours, NEIGHBOURS_LIMIT))
+        client = settings.REDIS_ASYNC_INSTANCE
+        rank = await client.zrevrank(self.key(board), tg_id)
+        if rank is None:
+            await self._ensure_built(board)
+            return None
+        start = max(rank - neighbours, 0)
+        rows = await client.zrevrange(self.key(board), start, rank + neighbours, withscores=True)
+        return {'rank': rank + 1, 'entries': await self._entries(rows, start + 1)}
+
+    @staticmethod
+    async def _entries(rows, first_rank):
+        """Строки рейтинга с местами и именами игроков. Имена читаются одним запросом по уникальному tg_id."""
+        from app_core.models import Player
+        tg_ids = [int(tg_id) for tg_id, _ in rows]
+        names = {tg_id: name async for tg_id, name in
+                 Player.objects.filter(tg_id__in=tg_ids).values_list('tg_id', 'name')}
+        return [
+            {'rank': first_rank + index, 'tg_id': tg_id, 'name': names.get(tg_id, ''), 'score': int(score)}
+            for index, (tg_id, (_, score)) in enumerate(zip(tg_ids, rows))
+        ]
+
+    async def _ensure_built(self, board):
+        """Если рейтинга нет в Redis (например, после его очистки), ставит в очередь одну пересборку."""
+        client = settings.REDIS_ASYNC_INSTANCE
+        if await client.exists(self.key(board), BUILT_KEY):
+            return
+        if await client.set(REBUILD_SCHEDULED_KEY, 1, nx=True, ex=settings.CELERY_TASK_TIME_LIMIT):
+            # Запрос не ждёт брокер: пока рейтинг собирается, отдаётся пустой
+            task = asyncio.ensure_future(self._enqueue_rebuild())
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+
+    async def _enqueue_rebuild(self):
+        try:
+            await sync_to_async(self._publish_rebuild, thread_sensitive=False)()
+        except Exception:
+            # Пересборку поставит следующий запрос
+            await settings.REDIS_ASYNC_INSTANCE.delete(REBUILD_SCHEDULED_KEY)
+            logger.exception("Не удалось поставить пересборку рейтингов в очередь")
+
+    @staticmethod
+    def _publish_rebuild():
+        """
+        Ставит задачу пересборки одной попыткой: при недоступном брокере ошибка возвращается сразу, а не после
+        повторных подключений kombu.
+        """
+        from app_core.tasks import rebuild_leaderboard
+        with rebuild_leaderboard.app.connection_for_write(transport_options={'max_retries': 0}) as connection:
+            rebuild_leaderboard.apply_async(retry=False, connection=connection)
+
+    def rebuild(self, chunk_size=2000):
+        """
+        Пересобирает рейтинги из Postgres потоковым проходом по таблице Player, дописывая значения прямо в текущие
+        множества. Пока идёт проход, flush_player_state записывает более свежие значения, поэтому они не
+        перезаписываются: монеты обновляются, только если выросли (доход бездействующих игроков), уровень и доход
+        в секунду - только у игроков, которых в рейтинге нет. Удалённых игроков убирает Player.purge.
+        Возвращает число игроков.
+        """
+        from app_core.models import Player
+        client = settings.REDIS_INSTANCE
+        lock = client.lock(REBUILD_LOCK_KEY, timeout=settings.CELERY_TASK_TIME_LIMIT)
+        if not lock.acquire(blocking=False):
+            return 0
+        try:
+            now = timezone.now()
+            total, chunk = 0, []
+            rows = Player.objects.order_by('id').values_list(
+                'tg_id', 'coins', 'coins_in_second', 'finish_second_coins', 'lvl')
+            for row in rows.iterator(chunk_size=chunk_size):
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    total += self._write_chunk(client, chunk, now)
+                    chunk = []
+            total += self._write_chunk(client, chunk, now)
+            pipe = client.pipeline(transaction=True)
+            pipe.set(BUILT_KEY, 1)
+            pipe.delete(REBUILD_SCHEDULED_KEY)
+            pipe.execute()
+            return total
+        finally:
+            lock.release()
+
+    def _write_chunk(self, client, chunk, now):
+        if not chunk:
+            return 0
+        coins, lvl, coins_in_second = {}, {}, {}
+        for tg_id, player_coins, rate, settled_at, player_lvl in chunk:
+            coins[tg_id] = accrue(player_coins, rate, settled_at, now)[0]
+            lvl[tg_id] = player_lvl
+            coins_in_second[tg_id] = rate
+        pipe = client.pipeline(transaction=False)
+        pipe.zadd(self.key('coins'), coins, gt=True)
+        pipe.zadd(self.key('lvl'), lvl, nx=True)
+        pipe.zadd(self.key('coins_in_second'), coins_in_second, nx=True)
+        pipe.execute()
+        return len(chunk)
+
+leaderboard = Leaderboard()
@@ -0,0 +1,65 @@
+"""
+Сравнение затрат CPU на ответ с игровым полем: прежний путь через DogSerializer и json/JSONRenderer против
+ручной сборки словарей и orjson. БД не нужна, собаки создаются в памяти.
+
+    python manage.py bench_serialization --dogs 12 --iterations 20000
+"""
+import json
+import time
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+from app_core.game_config import game_config
+from app_core.models import Dog
+from app_core.renderers import ORJSONRenderer, dumps_text
+from app_core.serializers import DogSerializer, compact_payload, dogs_data
+
+
+class Command(BaseCommand):
+    help = "Замеряет CPU на сериализацию ответа с собаками игрока для DRF и быстрого пути"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dogs', type=int, default=12, help="Собак на поле")
+        parser.add_argument('--iterations', type=int, default=20000, help="Ответов на каждый вариант")
+
+    def handle(self, *args, dogs, iterations, **options):
+        board = [
+            Dog(id=index + 1, player_id=1, lvl=index % 7 + 1, price=100 + index, bonus_second=3 + index,
+                dog_field=index + 1)
+            for index in range(dogs)
+        ]
+        virtual_dog = game_config.get().progression.virtual_dog(dogs, 7, player_id=1)
+
+        def drf_http():
+            data = {'dogs': DogSerializer(board, many=True).data, 'virtual_dog': virtual_dog, 'version': 1}
+            return JSONRenderer().render(data)
+
+        def drf_ws():
+            return json.dumps({'dogs': DogSerializer(board, many=True).data, 'virtual_dog': virtual_dog, 'version': 1})
+
+        def fast_http():
+            return ORJSONRenderer().render({'dogs': dogs_data(board), 'virtual_dog': virtual_dog, 'version': 1})
+
+        def fast_ws():
+            return dumps_text({'dogs': dogs_data(board), 'virtual_dog': virtual_dog, 'version': 1})
+
+        def compact_ws():
+            return dumps_text(compact_payload({'dogs': dogs_data(board), 'virtual_dog': virtual_dog, 'version': 1}))
+
+        variants = [
+            ('DRF: DogSerializer + JSONRenderer', drf_http),
+            ('DRF: DogSerializer + json.dumps (WS)', drf_ws),
+            ('Быстрый: dogs_data + ORJSONRenderer', fast_http),
+            ('Быстрый: dogs_data + orjson (WS)', fast_ws),
+            ('Компактный: массивы + orjson (WS)', compact_ws),
+        ]
+        self.stdout.write(f"Собак на поле: {dogs}, ответов на вариант: {iterations}")
+        baseline = None
+        for title, render in variants:
+            size = len(render())
+            started = time.process_time()
+            for _ in range(iterations):
+                render()
+            per_response = (time.process_time() - started) / iterations * 1e6
+            baseline = baseline or per_response
+            self.stdout.write(
+                f"{title:<40} {per_response:8.1f} мкс CPU/ответ  {size:5d} байт  x{baseline / per_response:.1f}")
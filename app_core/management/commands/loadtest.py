@@ -0,0 +1,249 @@
+"""
+Нагрузочный прогон игрового API внутри процесса: ASGI-приложение, Postgres и Redis берутся из настроек, поэтому
+прогон можно делать и на локальных сервисах, и на SQLite с fakeredis (`--settings=dogs.test_settings`).
+
+Каждый виртуальный игрок повторяет настоящую сессию мини-приложения: открывает игру (данные игрока, конфигурация
+и поле разом), опрашивает бонус, подключается по WebSocket, покупает собак и скрещивает их. По каждому действию
+выводятся p50/p99 задержки, число запросов к БД на действие и ошибки, по прогону - действий в секунду.
+
+    python manage.py loadtest --players 200 --concurrency 50 --buys 6
+    python manage.py loadtest --players 20 --settings=dogs.test_settings
+"""
+import asyncio
+import contextvars
+import json
+import math
+import time
+from collections import defaultdict
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test import AsyncClient, override_settings
+from dogs.asgi import application
+from app_core.models import Player
+from app_core.renderers import loads
+
+# Host, с которым ходит тестовый клиент Django
+TEST_HOST = 'testserver'
+
+# Счётчик запросов к БД текущего виртуального игрока. Контекст переходит в поток ORM вместе с sync_to_async
+_player_queries = contextvars.ContextVar('loadtest_player_queries', default=None)
+
+
+def _count_query(execute, sql, params, many, context):
+    counter = _player_queries.get()
+    if counter is not None:
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+def _install_counter(sender, connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+class CountQueries:
+    """
+    ASGI-обёртка, которая засчитывает запросы к БД соединения WebSocket игроку: тестовый клиент запускает
+    приложение с пустым контекстом, поэтому счётчик передаётся явно.
+    """
+
+    def __init__(self, app, counter):
+        self.app = app
+        self.counter = counter
+
+    async def __call__(self, scope, receive, send):
+        _player_queries.set(self.counter)
+        return await self.app(scope, receive, send)
+
+
+def percentile(values, percent):
+    """Процентиль по ближайшему рангу."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Stats:
+    """Задержки, запросы к БД и ошибки по действиям."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(int)
+        self.errors = defaultdict(int)
+
+    def add(self, action, seconds, queries, ok):
+        self.latencies[action].append(seconds)
+        self.queries[action] += queries
+        if not ok:
+            self.errors[action] += 1
+
+    def report(self, elapsed):
+        actions = {}
+        for action, latencies in self.latencies.items():
+            actions[action] = {
+                'count': len(latencies),
+                'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+                'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+                'queries_per_action': round(self.queries[action] / len(latencies), 2),
+                'errors': self.errors[action],
+            }
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return {'elapsed_s': round(elapsed, 3), 'actions': total, 'rps': round(total / elapsed, 1) if elapsed else 0,
+                'by_action': actions}
+
+
+class VirtualPlayer:
+    """Один игрок, выполняющий сессию мини-приложения."""
+
+    def __init__(self, tg_id, stats, polls, buys, timeout):
+        self.tg_id = tg_id
+        self.stats = stats
+        self.polls = polls
+        self.buys = buys
+        self.timeout = timeout
+        self.client = AsyncClient()
+        self.queries = [0]
+
+    async def measure(self, action, call):
+        """Выполняет действие и записывает его задержку и запросы к БД. call возвращает признак успеха."""
+        before = self.queries[0]
+        started = time.perf_counter()
+        try:
+            ok = await call()
+        except Exception:
+            ok = False
+        self.stats.add(action, time.perf_counter() - started, self.queries[0] - before, ok)
+
+    async def run(self):
+        _player_queries.set(self.queries)
+        await self.measure('open', self.open)
+        for _ in range(self.polls):
+            await self.measure('poll_bonus', self.poll_bonus)
+        websocket = WebsocketCommunicator(CountQueries(application, self.queries), f'/ws/dogs/{self.tg_id}/')
+        connected, _ = await websocket.connect(timeout=self.timeout)
+        if not connected:
+            self.stats.add('ws_connect', 0, 0, False)
+            return
+        try:
+            await self.measure('ws_get_dogs', lambda: self.ws_call(websocket, {'action': 'get_dogs'}))
+            for _ in range(self.buys):
+                await self.measure('ws_create_dog', lambda: self.ws_call(websocket, {'action': 'create_dog'}))
+            snapshot = await self.ws_request(websocket, {'action': 'get_dogs'})
+            pairs = self.breeding_pairs(snapshot.get('dogs', []))
+            if pairs:
+                await self.measure('ws_update_dogs',
+                                   lambda: self.ws_call(websocket, {'action': 'update_dogs', 'dog_pairs': pairs}))
+        finally:
+            await websocket.disconnect()
+
+    async def open(self):
+        """Открытие мини-приложения: три запроса почти одновременно."""
+        responses = await asyncio.gather(
+            self.client.get(f'/api/player-info/{self.tg_id}/loadtest/'),
+            self.client.get('/api/game-config/'),
+            self.client.get(f'/api/dogs-player/{self.tg_id}/'),
+        )
+        return all(response.status_code < 400 for response in responses)
+
+    async def poll_bonus(self):
+        response = await self.client.post(
+            '/api/collecting-bonuses/', {'tg_id': self.tg_id, 'second': True}, content_type='application/json')
+        return response.status_code < 400
+
+    async def ws_request(self, websocket, message):
+        await websocket.send_to(text_data=json.dumps(message))
+        return loads(await websocket.receive_from(timeout=self.timeout))
+
+    async def ws_call(self, websocket, message):
+        return 'error' not in await self.ws_request(websocket, message)
+
+    @staticmethod
+    def breeding_pairs(dogs):
+        """Пары собак одного уровня, как их выбрал бы игрок."""
+        by_lvl = defaultdict(list)
+        for dog in dogs:
+            by_lvl[dog['lvl']].append(dog['id'])
+        return [ids[index:index + 2] for ids in by_lvl.values() for index in range(0, len(ids) - 1, 2)]
+
+
+class Command(BaseCommand):
+    help = "Нагрузочный прогон игрового API: p50/p99 задержки, запросы к БД на действие и действий в секунду"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, default=50, help="Виртуальных игроков")
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help="Одновременных сессий (по умолчанию все игроки сразу)")
+        parser.add_argument('--polls', type=int, default=3, help="Опросов бонуса за сессию")
+        parser.add_argument('--buys', type=int, default=4, help="Покупок собак за сессию")
+        parser.add_argument('--coins', type=int, default=10 ** 7, help="Стартовые монеты игроков")
+        parser.add_argument('--tg-id-start', type=int, default=9_000_000_000,
+                            help="Первый tg_id виртуальных игроков, диапазон должен быть свободен")
+        parser.add_argument('--timeout', type=float, default=10, help="Ожидание ответа WebSocket (с)")
+        parser.add_argument('--rate-limit', action='store_true',
+                            help="Не отключать ограничение частоты действий на время прогона")
+        parser.add_argument('--keep', action='store_true', help="Не удалять виртуальных игроков после прогона")
+        parser.add_argument('--json', action='store_true', help="Вывести результат в JSON")
+
+    def handle(self, *args, **options):
+        tg_ids = list(range(options['tg_id_start'], options['tg_id_start'] + options['players']))
+        if Player.objects.filter(tg_id__in=tg_ids).exists():
+            raise CommandError("В диапазоне tg_id уже есть игроки, укажите другой --tg-id-start.")
+        connection_created.connect(_install_counter)
+        for connection in connections.all(initialized_only=True):
+            _install_counter(None, connection)
+        self.create_players(tg_ids, options['coins'])
+        # Без этого запросы тестового клиента отклоняются с DisallowedHost
+        overrides = {'ALLOWED_HOSTS': [*settings.ALLOWED_HOSTS, TEST_HOST]}
+        if not options['rate_limit']:
+            overrides.update(PLAYER_RATE_LIMIT_RATE=10 ** 6, PLAYER_RATE_LIMIT_BURST=10 ** 6)
+        try:
+            with override_settings(**overrides):
+                # Прогон идёт в пустом контексте: иначе виртуальные игроки делят с вызывающим кодом хранилище
+                # asgiref.local (например, после async_to_sync в тестах) и задачи одного игрока отправляют работу
+                # в уже завершённый поток другого
+                report = contextvars.Context().run(asyncio.run, self.run(tg_ids, options))
+        finally:
+            connection_created.disconnect(_install_counter)
+            if not options['keep']:
+                self.delete_players(tg_ids)
+        if options['json']:
+            self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+        else:
+            self.print_report(report)
+
+    @staticmethod
+    def create_players(tg_ids, coins):
+        for tg_id in tg_ids:
+            Player.register(tg_id, 'loadtest')
+        Player.objects.filter(tg_id__in=tg_ids).update(coins=coins)
+
+    @staticmethod
+    def delete_players(tg_ids):
+        """Удаляет игроков прогона из БД и их следы из Redis."""
+        Player.purge(tg_ids)
+
+    async def run(self, tg_ids, options):
+        stats = Stats()
+        semaphore = asyncio.Semaphore(options['concurrency'] or len(tg_ids))
+
+        async def session(tg_id):
+            async with semaphore:
+                await VirtualPlayer(tg_id, stats, options['polls'], options['buys'], options['timeout']).run()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(session(tg_id) for tg_id in tg_ids))
+        report = stats.report(time.perf_counter() - started)
+        # Соединения с БД потоков ORM закрываются в том же цикле событий
+        await sync_to_async(connections.close_all)()
+        return report
+
+    def print_report(self, report):
+        self.stdout.write(f"Действий: {report['actions']} за {report['elapsed_s']} с, {report['rps']} в секунду")
+        self.stdout.write(f"{'действие':<16}{'число':>8}{'p50, мс':>10}{'p99, мс':>10}{'запросов':>10}{'ошибок':>8}")
+        for action, row in report['by_action'].items():
+            self.stdout.write(f"{action:<16}{row['count']:>8}{row['p50_ms']:>10}{row['p99_ms']:>10}"
+                              f"{row['queries_per_action']:>10}{row['errors']:>8}")
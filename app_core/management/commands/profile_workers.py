@@ -0,0 +1,27 @@
+"""
+Включает семплер стеков во всех процессах uvicorn, которые обращаются к тому же Redis. Каждый процесс замечает
+команду при ближайшей сверке (до PROFILING_REFRESH_INTERVAL секунд после очередного запроса) и по окончании
+пишет стеки в PROFILING_DIR/stacks-<pid>-<время>.folded.
+
+    python manage.py profile_workers --seconds 60
+    flamegraph.pl profiles/stacks-*.folded > flame.svg
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from app_core.profiling import profiling
+
+
+class Command(BaseCommand):
+    help = "Включает на время семплер стеков в процессах uvicorn"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=int, default=60, help="Сколько секунд собирать стеки")
+        parser.add_argument('--stop', action='store_true', help="Остановить семплер досрочно")
+
+    def handle(self, *args, seconds, stop, **options):
+        if stop:
+            profiling.stop_sampler()
+            self.stdout.write("Семплер будет остановлен при ближайшей сверке процессов.")
+            return
+        profiling.start_sampler(seconds)
+        self.stdout.write(f"Семплер включён на {seconds} с, стеки будут записаны в {settings.PROFILING_DIR}.")
@@ -0,0 +1,312 @@
+"""
+Метрики производительности HTTP-запросов и действий WebSocket в текстовом формате Prometheus.
+
+Каждый HTTP-запрос (MetricsMiddleware) и каждое сообщение WebSocket (DogsPlayerConsumer) выполняются внутри
+`track`: в переменной контекста лежат счётчики действия, куда обёртка запросов Django записывает число и время
+запросов к БД, пулы клиентов Redis - число обращений к серверу, а кодирование JSON - время сериализации. Контекст
+переходит в потоки sync_to_async и в задачи asyncio, поэтому ORM и Redis засчитываются действию, где бы они ни
+выполнялись. Завершённое действие попадает в гистограммы процесса с метками транспорта и действия, а медленное
+ещё и в лог вместе со списком своих запросов к БД.
+
+Метрики живут в памяти процесса uvicorn и отдаются по /api/metrics/. Вне действия (Celery, команды) счётчики
+ничего не делают.
+"""
+import contextvars
+import functools
+import inspect
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+# Длина SQL одного запроса в логе медленных действий
+SLOW_LOG_SQL_LENGTH = 500
+
+_current = contextvars.ContextVar('metrics_action', default=None)
+
+
+class ActionMetrics:
+    """Счётчики одного HTTP-запроса или действия WebSocket."""
+    __slots__ = ('transport', 'action', 'status', 'queries', 'db_seconds', 'redis_calls', 'serialize_seconds', 'sql')
+
+    def __init__(self, transport, action):
+        self.transport = transport
+        self.action = action
+        self.status = 'ok'
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.redis_calls = 0
+        self.serialize_seconds = 0.0
+        # Первые METRICS_SLOW_QUERY_LIMIT запросов к БД для лога медленных действий: (время, SQL)
+        self.sql = []
+
+    def add_query(self, sql, seconds):
+        self.queries += 1
+        self.db_seconds += seconds
+        if len(self.sql) < settings.METRICS_SLOW_QUERY_LIMIT:
+            self.sql.append((seconds, sql))
+
+
+class Histogram:
+    """Гистограмма Prometheus: число наблюдений в каждой корзине, сумма и количество."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Последняя корзина - +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{_labels(labels, le=bound)} {cumulative}'
+        yield f'{name}_sum{_labels(labels)} {self.sum}'
+        yield f'{name}_count{_labels(labels)} {cumulative}'
+
+
+class ActionSeries:
+    """Накопленные метрики одного действия."""
+
+    def __init__(self):
+        self.duration = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.db_seconds = 0.0
+        self.redis_calls = 0
+        self.serialize_seconds = 0.0
+        self.slow = 0
+        self.statuses = defaultdict(int)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, **extra):
+    pairs = [*labels.items(), *extra.items()]
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+class MetricsRegistry:
+    """Метрики процесса по действиям. Запись - одно взятие блокировки на завершённое действие."""
+
+    def __init__(self):
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def record(self, metrics, seconds):
+        with self._lock:
+            series = self._series.get((metrics.transport, metrics.action))
+            if series is None:
+                series = self._series[(metrics.transport, metrics.action)] = ActionSeries()
+            series.duration.observe(seconds)
+            series.queries.observe(metrics.queries)
+            series.db_seconds += metrics.db_seconds
+            series.redis_calls += metrics.redis_calls
+            series.serialize_seconds += metrics.serialize_seconds
+            series.statuses[metrics.status] += 1
+            slow = (seconds >= settings.METRICS_SLOW_ACTION_SECONDS
+                    or metrics.queries >= settings.METRICS_SLOW_ACTION_QUERIES)
+            if slow:
+                series.slow += 1
+        if slow:
+            log_slow_action(metrics, seconds)
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+    def render(self):
+        """Все метрики процесса в текстовом формате Prometheus."""
+        with self._lock:
+            series = sorted(self._series.items())
+            lines = []
+            self._histogram(lines, series, 'dogs_action_duration_seconds', 'duration',
+                            "Время выполнения HTTP-запроса или действия WebSocket")
+            self._histogram(lines, series, 'dogs_action_db_queries', 'queries',
+                            "Число запросов к БД за действие")
+            self._counter(lines, series, 'dogs_action_db_seconds_total', 'db_seconds',
+                          "Время запросов к БД за все действия")
+            self._counter(lines, series, 'dogs_action_redis_calls_total', 'redis_calls',
+                          "Обращения к Redis (команда или конвейер) за все действия")
+            self._counter(lines, series, 'dogs_action_serialization_seconds_total', 'serialize_seconds',
+                          "Время кодирования JSON за все действия")
+            self._counter(lines, series, 'dogs_slow_actions_total', 'slow', "Действия, попавшие в лог медленных")
+            lines += ['# HELP dogs_actions_total Завершённые действия по результату', '# TYPE dogs_actions_total counter']
+            for (transport, action), item in series:
+                for status, count in sorted(item.statuses.items()):
+                    lines.append(f'dogs_actions_total'
+                                 f'{_labels({"transport": transport, "action": action, "status": status})} {count}')
+        lines += _pool_lines()
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _histogram(lines, series, name, attr, help_text):
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for (transport, action), item in series:
+            lines += getattr(item, attr).lines(name, {'transport': transport, 'action': action})
+
+    @staticmethod
+    def _counter(lines, series, name, attr, help_text):
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for (transport, action), item in series:
+            lines.append(f'{name}{_labels({"transport": transport, "action": action})} {getattr(item, attr)}')
+
+
+def _pool_lines():
+    """Счётчики пула соединений с Postgres, если пул настроен."""
+    from app_core.db_pool import pool_stats
+    stats = pool_stats()
+    if not stats:
+        return []
+    lines = []
+    for key, value in sorted(stats.items()):
+        if isinstance(value, (int, float)):
+            lines += [f'# TYPE dogs_db_pool_{key} gauge', f'dogs_db_pool_{key} {value}']
+    return lines
+
+
+def log_slow_action(metrics, seconds):
+    queries = '\n'.join(f'  {query_seconds * 1000:.1f} мс  {sql[:SLOW_LOG_SQL_LENGTH]}'
+                        for query_seconds, sql in metrics.sql)
+    logger.warning(
+        "Медленное действие %s %s (%s): %.1f мс, запросов к БД %d (%.1f мс), обращений к Redis %d, "
+        "сериализация %.1f мс\n%s",
+        metrics.transport, metrics.action, metrics.status, seconds * 1000, metrics.queries,
+        metrics.db_seconds * 1000, metrics.redis_calls, metrics.serialize_seconds * 1000, queries,
+    )
+
+
+registry = MetricsRegistry()
+
+
+@contextmanager
+def track(transport, action=''):
+    """Замеряет действие. Название и результат можно уточнить в возвращённых счётчиках до выхода из блока."""
+    metrics = ActionMetrics(transport, action)
+    token = _current.set(metrics)
+    started = time.perf_counter()
+    try:
+        yield metrics
+    except BaseException:
+        metrics.status = 'error'
+        raise
+    finally:
+        _current.reset(token)
+        if settings.METRICS_ENABLED:
+            registry.record(metrics, time.perf_counter() - started)
+
+
+def set_status(status):
+    """Результат текущего действия, например error или throttled."""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.status = status
+
+
+def add_serialization(seconds):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.serialize_seconds += seconds
+
+
+def _count_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.add_query(sql, time.perf_counter() - started)
+
+
+def _install_query_counter(sender, connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+def _count_redis_call():
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.redis_calls += 1
+
+
+def instrument_redis(client):
+    """Считает обращения клиента к Redis: каждая команда и каждый конвейер берут соединение из пула клиента."""
+    pool = client.connection_pool
+    get_connection = pool.get_connection
+    if hasattr(get_connection, '__wrapped__'):
+        return
+    if inspect.iscoroutinefunction(get_connection):
+        @functools.wraps(get_connection)
+        async def counted(*args, **kwargs):
+            _count_redis_call()
+            return await get_connection(*args, **kwargs)
+    else:
+        @functools.wraps(get_connection)
+        def counted(*args, **kwargs):
+            _count_redis_call()
+            return get_connection(*args, **kwargs)
+    pool.get_connection = counted
+
+
+def install():
+    """Подключает счётчики к соединениям с БД и клиентам Redis процесса. Вызывается из AppCoreConfig.ready."""
+    if not settings.METRICS_ENABLED:
+        return
+    connection_created.connect(_install_query_counter, dispatch_uid='app_core.metrics')
+    instrument_redis(settings.REDIS_INSTANCE)
+    instrument_redis(settings.REDIS_ASYNC_INSTANCE)
+
+
+def http_action(request):
+    """Метод и шаблон адреса: tg_id и другие параметры пути не порождают новых серий метрик."""
+    match = request.resolver_match
+    return f'{request.method} /{match.route}' if match is not None else f'{request.method} unmatched'
+
+
+class MetricsMiddleware:
+    """Замеряет каждый HTTP-запрос, включая рендеринг ответа и остальные middleware."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        with track('http') as metrics:
+            response = self.get_response(request)
+            self.finish(metrics, request, response)
+        return response
+
+    async def __acall__(self, request):
+        with track('http') as metrics:
+            response = await self.get_response(request)
+            self.finish(metrics, request, response)
+        return response
+
+    @staticmethod
+    def finish(metrics, request, response):
+        metrics.action = http_action(request)
+        metrics.status = str(response.status_code)
@@ -0,0 +1,46 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:00
+
+from django.db import migrations, models
+
+
+def fill_dog_fields(apps, schema_editor):
+    """Заполняет маску занятых мест и максимальный уровень по активным собакам, проходя их одним потоком."""
+    Player = apps.get_model('app_core', 'Player')
+    Dog = apps.get_model('app_core', 'Dog')
+    batch, current = [], None
+    dogs = Dog.objects.filter(is_active=True).order_by('player_id').values_list('player_id', 'dog_field', 'lvl')
+    for player_id, dog_field, lvl in dogs.iterator(chunk_size=2000):
+        if current is None or current.id != player_id:
+            if current is not None:
+                batch.append(current)
+            current = Player(id=player_id, dog_fields=0, max_dog_lvl=0)
+        if dog_field and 1 <= dog_field <= 12:
+            current.dog_fields |= 1 << (dog_field - 1)
+        current.max_dog_lvl = max(current.max_dog_lvl, lvl)
+        if len(batch) >= 1000:
+            Player.objects.bulk_update(batch, ['dog_fields', 'max_dog_lvl'])
+            batch = []
+    if current is not None:
+        batch.append(current)
+    Player.objects.bulk_update(batch, ['dog_fields', 'max_dog_lvl'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_core', '0002_alter_dog_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='dog_fields',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='Занятые места поля (битовая маска)'),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='max_dog_lvl',
+            field=models.IntegerField(default=0, verbose_name='Максимальный уровень собаки на поле'),
+        ),
+        migrations.RunPython(fill_dog_fields, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:02
+
+from bisect import bisect_right
+from django.db import migrations, models
+
+
+def version_1_prices():
+    """Цены первой версии таблиц прогрессии, зафиксированные для миграции."""
+    prices = [100]
+    for index in range(1, 200):
+        percent = 7.0 if index - 1 < 16 else 17.5
+        prices.append(min(int(prices[-1] * (1 + percent / 100)), 2 ** 31 - 1))
+    return prices
+
+
+def fill_dogs_bought(apps, schema_editor):
+    """
+    Номер следующей покупки восстанавливается по цене виртуальной собаки, после чего строки виртуальных собак
+    удаляются: виртуальная собака теперь вычисляется по таблицам прогрессии.
+    """
+    Player = apps.get_model('app_core', 'Player')
+    Dog = apps.get_model('app_core', 'Dog')
+    prices = version_1_prices()
+    batch = []
+    virtual_dogs = Dog.objects.filter(is_active=False).values_list('player_id', 'price')
+    for player_id, price in virtual_dogs.iterator(chunk_size=2000):
+        batch.append(Player(id=player_id, dogs_bought=max(bisect_right(prices, price) - 1, 0)))
+        if len(batch) >= 1000:
+            Player.objects.bulk_update(batch, ['dogs_bought'])
+            batch = []
+    Player.objects.bulk_update(batch, ['dogs_bought'])
+    Dog.objects.filter(is_active=False).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_core', '0003_player_dog_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='dogs_bought',
+            field=models.PositiveIntegerField(default=0, verbose_name='Количество купленных собак'),
+        ),
+        migrations.RunPython(fill_dogs_bought, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:05
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_core', '0004_player_dogs_bought'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='player',
+            name='daily_bonus',
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:09
+
+from django.db import migrations, models
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_referral_counters(apps, schema_editor):
+    """
+    Счётчик друзей заполняется одним UPDATE с подзапросом. Заработок за прошлое неизвестен, поэтому им считается
+    текущий баланс, уже учтённый для рефералов.
+    """
+    Player = apps.get_model('app_core', 'Player')
+    ReferralSystem = apps.get_model('app_core', 'ReferralSystem')
+    friends = ReferralSystem.objects.filter(referral_id=OuterRef('pk')).values('referral_id').annotate(
+        count=Count('id')).values('count')
+    Player.objects.update(
+        friends_count=Coalesce(Subquery(friends, output_field=models.IntegerField()), 0),
+        coins_earned=F('coins'),
+        referral_earned_credited=F('coins'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_core', '0005_remove_player_daily_bonus'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='coins_earned',
+            field=models.PositiveBigIntegerField(default=0, verbose_name='Заработано монет за всё время'),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='friends_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Количество приглашённых друзей'),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='referral_earned_credited',
+            field=models.PositiveBigIntegerField(default=0, verbose_name='Заработок, уже учтённый в бонусе реферала'),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='referral_earned_pending',
+            field=models.PositiveBigIntegerField(default=0, verbose_name='Заработок, начисляемый рефералу в текущем проходе'),
+        ),
+        migrations.RunPython(fill_referral_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,118 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:30
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+DOG_ACTIVE_LVL_INDEX = models.Index(condition=models.Q(('is_active', True)), fields=['player', '-lvl'],
+                                    include=['dog_field'], name='dog_active_player_lvl_idx')
+DOG_ACTIVE_FIELD_UNIQUE = models.UniqueConstraint(condition=models.Q(('is_active', True)),
+                                                  fields=('player', 'dog_field'), name='dog_active_player_field_uniq')
+REFERRAL_PAIR_UNIQUE = models.UniqueConstraint(fields=('new_player', 'referral'), name='referral_pair_uniq')
+
+
+def remove_duplicate_referrals(apps, schema_editor):
+    """Оставляет по одной записи на пару приглашённый-реферал, иначе уникальный индекс не построится."""
+    ReferralSystem = apps.get_model('app_core', 'ReferralSystem')
+    duplicates = ReferralSystem.objects.values('new_player_id', 'referral_id').annotate(
+        first_id=Min('id'), count=Count('id')).filter(count__gt=1)
+    for pair in duplicates.iterator():
+        ReferralSystem.objects.filter(new_player_id=pair['new_player_id'], referral_id=pair['referral_id']).exclude(
+            id=pair['first_id']).delete()
+
+
+def move_duplicate_dogs(apps, schema_editor):
+    """
+    Разводит активных собак, занявших одно место поля, по свободным местам. Затрагиваются только игроки
+    с такими собаками; если свободного места нет, собака остаётся без места.
+    """
+    Player = apps.get_model('app_core', 'Player')
+    Dog = apps.get_model('app_core', 'Dog')
+    player_ids = Dog.objects.filter(is_active=True, dog_field__isnull=False).values(
+        'player_id', 'dog_field').annotate(count=Count('id')).filter(count__gt=1).values_list('player_id', flat=True)
+    for player_id in set(player_ids):
+        dogs = list(Dog.objects.filter(player_id=player_id, is_active=True).order_by('id'))
+        taken, moved = set(), []
+        for dog in dogs:
+            if dog.dog_field is None or dog.dog_field in taken:
+                moved.append(dog)
+            else:
+                taken.add(dog.dog_field)
+        free = [field for field in range(1, 13) if field not in taken]
+        for dog in moved:
+            dog.dog_field = free.pop(0) if free else None
+            if dog.dog_field is not None:
+                taken.add(dog.dog_field)
+        Dog.objects.bulk_update(moved, ['dog_field'])
+        dog_fields = sum(1 << (field - 1) for field in taken if 1 <= field <= 12)
+        Player.objects.filter(id=player_id).update(dog_fields=dog_fields)
+
+
+class ByVendor(migrations.SeparateDatabaseAndState):
+    """
+    Операции с БД отдельно для Postgres (индексы строятся CONCURRENTLY) и для остальных баз (обычные AddIndex
+    и AddConstraint, например на SQLite в тестах). Состояние моделей у обоих вариантов общее.
+    """
+
+    def __init__(self, postgresql, other, state_operations):
+        super().__init__(database_operations=postgresql, state_operations=state_operations)
+        self.other_operations = other
+
+    def _for_vendor(self, schema_editor):
+        if schema_editor.connection.vendor == 'postgresql':
+            return migrations.SeparateDatabaseAndState(database_operations=self.database_operations)
+        return migrations.SeparateDatabaseAndState(database_operations=self.other_operations)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        self._for_vendor(schema_editor).database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        self._for_vendor(schema_editor).database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+    # Индексы в Postgres строятся без блокировки записи (CONCURRENTLY), это невозможно внутри транзакции
+    atomic = False
+
+    dependencies = [
+        ('app_core', '0006_referral_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_referrals, migrations.RunPython.noop, atomic=True),
+        migrations.RunPython(move_duplicate_dogs, migrations.RunPython.noop, atomic=True),
+        ByVendor(
+            postgresql=[AddIndexConcurrently(model_name='dog', index=DOG_ACTIVE_LVL_INDEX)],
+            other=[migrations.AddIndex(model_name='dog', index=DOG_ACTIVE_LVL_INDEX)],
+            state_operations=[migrations.AddIndex(model_name='dog', index=DOG_ACTIVE_LVL_INDEX)],
+        ),
+        # Уникальное частичное ограничение Django создаёт как уникальный индекс, поэтому в Postgres строим его сами
+        ByVendor(
+            postgresql=[
+                migrations.RunSQL(
+                    'CREATE UNIQUE INDEX CONCURRENTLY "dog_active_player_field_uniq" '
+                    'ON "app_core_dog" ("player_id", "dog_field") WHERE "is_active"',
+                    'DROP INDEX CONCURRENTLY IF EXISTS "dog_active_player_field_uniq"',
+                ),
+            ],
+            other=[migrations.AddConstraint(model_name='dog', constraint=DOG_ACTIVE_FIELD_UNIQUE)],
+            state_operations=[migrations.AddConstraint(model_name='dog', constraint=DOG_ACTIVE_FIELD_UNIQUE)],
+        ),
+        # Ограничение уникальности пары подключается к заранее построенному индексу без долгой блокировки
+        ByVendor(
+            postgresql=[
+                migrations.RunSQL(
+                    'CREATE UNIQUE INDEX CONCURRENTLY "referral_pair_uniq" '
+                    'ON "app_core_referralsystem" ("new_player_id", "referral_id")',
+                    'DROP INDEX CONCURRENTLY IF EXISTS "referral_pair_uniq"',
+                ),
+                migrations.RunSQL(
+                    'ALTER TABLE "app_core_referralsystem" '
+                    'ADD CONSTRAINT "referral_pair_uniq" UNIQUE USING INDEX "referral_pair_uniq"',
+                    'ALTER TABLE "app_core_referralsystem" DROP CONSTRAINT IF EXISTS "referral_pair_uniq"',
+                ),
+            ],
+            other=[migrations.AddConstraint(model_name='referralsystem', constraint=REFERRAL_PAIR_UNIQUE)],
+            state_operations=[migrations.AddConstraint(model_name='referralsystem', constraint=REFERRAL_PAIR_UNIQUE)],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_core', '0007_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='player',
+            name='daily_bonus_friends',
+            field=models.BigIntegerField(default=0, verbose_name='Бонус от рефералов за текущий день'),
+        ),
+    ]
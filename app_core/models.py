@@ -1,19 +1,16 @@
-import json
 from datetime import timedelta
-from pathlib import Path
-from django.db import models
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import models, transaction
 from django.utils import timezone
+from app_core.economy import accrue
+from app_core.notifications import push_player_update
+from app_core.player_state import player_state
+from app_core.game_config import game_config
 
-
-def load_daily_bonuses():
-    """Загружает ежедневные бонусы из JSON-файла."""
-    bonuses_file_path = Path(__file__).resolve().parent / 'daily_bonuses.json'
-    with open(bonuses_file_path, 'r') as file:
-        bonuses_data = json.load(file)
-    return bonuses_data['bonuses']
-
-
-DAILY_BONUSES = load_daily_bonuses()
+# Количество мест на игровом поле и маска полностью занятого поля
+BOARD_SIZE = 12
+FULL_BOARD_MASK = (1 << BOARD_SIZE) - 1
 
 
 class Player(models.Model):
@@ -23,7 +20,13 @@ class Player(models.Model):
     registration_date = models.DateTimeField(auto_now_add=True, verbose_name="Дата регистрации игрока")
     coins = models.PositiveBigIntegerField(default=0, verbose_name="Текущие монеты игрока")
     coins_spent_today = models.PositiveBigIntegerField(default=0, verbose_name="Потраченные монеты за текущий день")
-    daily_bonus_friends = models.IntegerField(default=0, verbose_name="Бонус от рефералов за текущий день")
+    daily_bonus_friends = models.BigIntegerField(default=0, verbose_name="Бонус от рефералов за текущий день")
+    friends_count = models.PositiveIntegerField(default=0, verbose_name="Количество приглашённых друзей")
+    coins_earned = models.PositiveBigIntegerField(default=0, verbose_name="Заработано монет за всё время")
+    referral_earned_credited = models.PositiveBigIntegerField(
+        default=0, verbose_name="Заработок, уже учтённый в бонусе реферала")
+    referral_earned_pending = models.PositiveBigIntegerField(
+        default=0, verbose_name="Заработок, начисляемый рефералу в текущем проходе")
     consecutive_days = models.IntegerField(default=0, verbose_name="Количество дней входов подряд")
     last_login_date = models.DateField(null=True, blank=True, verbose_name="Последний вход для расчёта дней подряд")
     offline_coins = models.IntegerField(default=0, verbose_name="Офлайн бонусы 1 раз в 3 часа")
@@ -32,35 +35,119 @@ class Player(models.Model):
     coins_in_second = models.IntegerField(default=0, verbose_name="Заработок монет в секунду")
     finish_second_coins = models.DateTimeField(null=True, blank=True, verbose_name="Время последнего сбора бонуса")
     lvl = models.IntegerField(default=1, verbose_name="Уровень игрока")
-    daily_bonus = models.BooleanField(default=True, verbose_name="Выдача ежедневного бонуса")
     instruction = models.BooleanField(default=True, verbose_name="Показ инструкции")
+    dog_fields = models.PositiveSmallIntegerField(default=0, verbose_name="Занятые места поля (битовая маска)")
+    max_dog_lvl = models.IntegerField(default=0, verbose_name="Максимальный уровень собаки на поле")
+    dogs_bought = models.PositiveIntegerField(default=0, verbose_name="Количество купленных собак")
+
+    def balance(self, now=None):
+        """Текущий баланс с учётом ежесекундного дохода, накопленного с finish_second_coins."""
+        return accrue(self.coins, self.coins_in_second, self.finish_second_coins, now or timezone.now())[0]
+
+    @classmethod
+    def register(cls, tg_id, name, referral_tg_id=None):
+        """
+        Создаёт игрока вместе с таймерами бонусов одной вставкой и, если указан существующий реферал, связь
+        с ним - всё в одной транзакции. Неизвестный реферал не мешает регистрации.
+        """
+        from app_core.leaderboard import leaderboard
+        now = timezone.now()
+        with transaction.atomic():
+            player = cls.objects.create(
+                tg_id=tg_id,
+                name=name,
+                start_offline_coins=now,
+                finish_offline_coins=now + game_config.get().progression.offline_window,
+                finish_second_coins=now,
+            )
+            if referral_tg_id and referral_tg_id != tg_id:
+                referral_id = cls.objects.filter(tg_id=referral_tg_id).values_list('id', flat=True).first()
+                if referral_id is not None:
+                    ReferralSystem.objects.create(referral_id=referral_id, new_player=player)
+                    cls.objects.filter(id=referral_id).update(friends_count=models.F('friends_count') + 1)
+        # Новый игрок сразу попадает в рейтинги, не дожидаясь пересборки
+        leaderboard.record_player(player)
+        return player
+
+    @classmethod
+    def purge(cls, tg_ids):
+        """
+        Удаляет игроков вместе с собаками и реферальными связями, а затем их следы в Redis: горячее состояние,
+        кэш поля, корзину частоты действий и места в рейтингах, чтобы flush_player_state не записал их обратно.
+        Возвращает число удалённых игроков.
+        """
+        from app_core.leaderboard import BOARDS, leaderboard
+        from app_core.player_state import DIRTY_KEY
+        from app_core.rate_limit import rate_limiter
+        tg_ids = list(tg_ids)
+        if not tg_ids:
+            return 0
+        deleted = cls.objects.filter(tg_id__in=tg_ids).delete()[1].get(cls._meta.label, 0)
+        pipe = settings.REDIS_INSTANCE.pipeline(transaction=False)
+        for tg_id in tg_ids:
+            pipe.delete(player_state.key(tg_id), player_state.board_key(tg_id), rate_limiter.key(tg_id))
+        pipe.srem(DIRTY_KEY, *tg_ids)
+        for board in BOARDS:
+            pipe.zrem(leaderboard.key(board), *tg_ids)
+        pipe.execute()
+        return deleted
+
+    def free_dog_field(self):
+        """Первое свободное место поля (1..12) по битовой маске или None, если поле заполнено."""
+        free = ~self.dog_fields & FULL_BOARD_MASK
+        return (free & -free).bit_length() or None
+
+    def is_board_full(self):
+        """Заняты ли все места поля."""
+        return self.dog_fields & FULL_BOARD_MASK == FULL_BOARD_MASK
+
+    def occupy_dog_field(self, dog_field):
+        """Отмечает место поля занятым."""
+        self.dog_fields |= 1 << (dog_field - 1)
+
+    def release_dog_field(self, dog_field):
+        """Отмечает место поля свободным."""
+        if dog_field:
+            self.dog_fields &= ~(1 << (dog_field - 1))
+
+    @property
+    def daily_bonus(self):
+        """
+        Доступен ли ежедневный бонус: игрок ещё не входил сегодня по московскому времени. Считается по дате
+        последнего входа, поэтому в полночь не нужно массово сбрасывать флаг у всех игроков.
+        """
+        return self.last_login_date != timezone.localdate()
+
+    def virtual_dog(self):
+        """Виртуальная собака - предложение следующей покупки по таблицам прогрессии."""
+        return game_config.get().progression.virtual_dog(self.dogs_bought, self.max_dog_lvl, player_id=self.id)
 
     async def update_daily_status(self):
         """
-        Проверяем вход пользователя, если вход подряд увеличиваем количество дней подряд, проверяем какой день подряд
-        вошёл пользователь и начисляем ему монеты, проверяем количество дней подряд.
+        Проверяем вход пользователя, если вход подряд увеличиваем количество дней подряд и начисляем монеты
+        за этот день серии. Бонус забирается одним условным UPDATE: он проходит, только если серия и дата входа
+        не изменились с момента чтения, поэтому параллельный повторный запрос бонус не получит.
+        Возвращает True, если бонус начислен.
         """
-        # Получаем текущее время в UTC
-        now_utc = timezone.now()
-        # Добавляем 4 часа (смещение для московского времени)
-        now_moscow = now_utc + timedelta(hours=4)
-        # Получаем дату в московском времени
-        today = now_moscow.date()
+        # Получаем дату в московском времени (TIME_ZONE проекта)
+        today = timezone.localdate()
         # Если пользователь уже заходил сегодня, ничего не делаем
         if not self.daily_bonus:
-            return
-        # Проверка для расчета consecutive_days
-        if self.last_login_date:
-            days_diff = (today - self.last_login_date).days
-            self.consecutive_days = self.consecutive_days + 1 if days_diff == 1 else 1
-        else:
-            self.consecutive_days = 1
-        # Получаем бонус для текущего дня
-        daily_bonuses = DAILY_BONUSES
-        bonus = next((b for b in daily_bonuses if b["day"] == self.consecutive_days), {"coins": 0})
-        self.coins += bonus.get("coins", 0)
-        self.last_login_date = today
-        await self.asave()
+            return False
+        # Серия продолжается, только если предыдущий вход был вчера
+        consecutive_days = self.consecutive_days + 1 if self.last_login_date == today - timedelta(days=1) else 1
+        claimed = await Player.objects.filter(
+            id=self.id, last_login_date=self.last_login_date, consecutive_days=self.consecutive_days,
+        ).aupdate(consecutive_days=consecutive_days, last_login_date=today)
+        if not claimed:
+            return False
+        self.consecutive_days, self.last_login_date = consecutive_days, today
+        # Монеты живут в горячем состоянии игрока, поэтому бонус начисляем атомарно в Redis
+        coins = game_config.get().daily_bonus_table.coins(consecutive_days)
+        state = await player_state.aapply(self.tg_id, incr={'coins': coins, 'coins_earned': coins}, bump=True)
+        state.apply_to(self)
+        await push_player_update(state, 'daily_bonus')
+        return True
 
     class Meta:
         verbose_name = "Игрок"
@@ -82,138 +169,202 @@ class Dog(models.Model):
     dog_field = models.IntegerField(null=True, blank=True, verbose_name='Место на игровом поле')
     is_active = models.BooleanField(default=True, verbose_name="Активная собака")
 
-    @classmethod
-    async def get_or_create_virtual_dog(cls, player):
-        """Получаем или создаем виртуальную собаку для игрока"""
-        virtual_dog = await cls.objects.filter(player=player, is_active=False).afirst()
-        if not virtual_dog:
-            virtual_dog = await cls.objects.acreate(player=player, is_active=False)
-        return virtual_dog
-
-    @classmethod
-    async def find_free_field(cls, player):
-        """Находим первое свободное место на поле игрока"""
-        # Получаем все занятые места с помощью асинхронного итератора
-        occupied_fields = set()
-        async for dog_field in player.dogs.filter(is_active=True).values_list('dog_field', flat=True).aiterator():
-            occupied_fields.add(dog_field)
-        # Ищем первое свободное место (от 1 до 12)
-        for field in range(1, 13):
-            if field not in occupied_fields:
-                return field
-        return None
-
     @classmethod
     async def create_dog(cls, player):
-        """Создание активной собаки для игрока"""
-        # Проверяем, что у игрока меньше 12 собак
-        if await player.dogs.filter(is_active=True).acount() >= 12:
-            raise ValueError("У игрока уже максимальное количество собак (12).")
-        # Получаем виртуальную собаку и используем её данные
-        virtual_dog = await cls.get_or_create_virtual_dog(player)
-        if player.coins >= virtual_dog.price:
-            player.coins -= virtual_dog.price
-            player.coins_spent_today += virtual_dog.price
-            player.coins_in_second += virtual_dog.bonus_second
-            await player.asave(update_fields=['coins', 'coins_spent_today', 'coins_in_second'])
-            # Создаем активную собаку
-            dog = await cls.objects.acreate(
-                player=player,
-                lvl=virtual_dog.lvl,
-                price=virtual_dog.price,
-                percent_up_price=virtual_dog.percent_up_price,
-                bonus_second=virtual_dog.bonus_second,
-                bonus_connection=virtual_dog.bonus_connection,
-                dog_field=await cls.find_free_field(player),
-                is_active=True
-            )
-            # Обновляем виртуальную собаку для следующей покупки
-            await cls.update_virtual_dog(player)
-            return dog
-        else:
-            raise ValueError("У игрока недостаточно денег для создания собаки.")
+        """Создание активной собаки для игрока. Возвращает собаку и виртуальную собаку для следующей покупки."""
+        dogs, virtual_dog = await cls.create_dogs(player, 1)
+        return dogs[0], virtual_dog
 
     @classmethod
-    async def update_virtual_dog(cls, player):
-        """Обновляем виртуальную собаку (уровень и цену)"""
-        virtual_dog = await cls.get_or_create_virtual_dog(player)
-        # Определяем уровень следующей собаки
-        max_lvl_result = await player.dogs.filter(is_active=True).aaggregate(models.Max('lvl'))
-        max_lvl_dog = max_lvl_result.get('lvl__max')
-        if max_lvl_dog is None:
-            max_lvl_dog = 1
-        if max_lvl_dog >= virtual_dog.lvl:
-            virtual_dog.lvl = max_lvl_dog // 5 + 1 if max_lvl_dog >= 5 else 1
-            virtual_dog.bonus_second = virtual_dog.bonus_second * virtual_dog.lvl
-            virtual_dog.bonus_connection = virtual_dog.lvl - 1
-        virtual_dog.price = int(virtual_dog.price * (1 + virtual_dog.percent_up_price / 100))
-        # Обновляем процент увеличения цены
-        if virtual_dog.lvl == 2:
-            virtual_dog.percent_up_price = 17.5
-        await virtual_dog.asave()
-        return virtual_dog
+    async def create_dogs(cls, player, count):
+        """
+        Покупка до count собак подряд одной транзакцией, как если бы игрок нажал покупку count раз. Покупается
+        столько собак, сколько помещается на поле и хватает монет. Возвращает купленных собак и виртуальную собаку
+        для следующей покупки.
+        """
+        try:
+            count = int(count)
+        except (TypeError, ValueError):
+            count = 0
+        if not 1 <= count <= BOARD_SIZE:
+            raise ValueError(f"За раз можно купить от 1 до {BOARD_SIZE} собак.")
+        dogs, virtual_dog = await sync_to_async(cls._create_dogs_locked)(player, count)
+        state = await player_state.ainvalidate_board(player.tg_id)
+        state.apply_to(player)
+        await push_player_update(state, 'create_dog', added=dogs, virtual_dog=virtual_dog)
+        return dogs, virtual_dog
 
     @classmethod
-    async def update_virtual_dog_level(cls, player):
-        """Обновляем уровень виртуальной собаки (без изменения цены)"""
-        virtual_dog = await cls.get_or_create_virtual_dog(player)
-        # Определяем уровень следующей собаки
-        max_lvl_result = await player.dogs.filter(is_active=True).aaggregate(models.Max('lvl'))
-        max_lvl_dog = max_lvl_result.get('lvl__max')
-        if max_lvl_dog is None:
-            max_lvl_dog = 1
-        if max_lvl_dog >= virtual_dog.lvl:
-            virtual_dog.lvl = max_lvl_dog // 5 + 1 if max_lvl_dog >= 5 else 1
-            virtual_dog.bonus_second = virtual_dog.bonus_second * virtual_dog.lvl
-            virtual_dog.bonus_connection = virtual_dog.lvl - 1
-            if virtual_dog.lvl == 2:
-                virtual_dog.percent_up_price = 17.5
-            await virtual_dog.asave()
-        return virtual_dog
+    def _create_dogs_locked(cls, player, count):
+        """
+        Покупка собак одной транзакцией из трёх запросов при любом их числе: блокировка строки игрока, вставка собак
+        и обновление строки игрока. Строка игрока служит замком игрового поля: свободные места, максимальный уровень
+        и номер покупки берутся из неё, цены и доход - из таблиц прогрессии. Монеты живут в Redis, поэтому проверка
+        баланса и списание за все собаки выполняются одним атомарным скриптом, а при откате транзакции списанное
+        возвращается.
+        """
+        state = None
+        try:
+            with transaction.atomic():
+                board = Player.objects.select_for_update().only(
+                    'id', 'dog_fields', 'max_dog_lvl', 'dogs_bought').get(id=player.id)
+                # Проверяем, что у игрока меньше 12 собак
+                if board.free_dog_field() is None:
+                    raise ValueError("У игрока уже максимальное количество собак (12).")
+                # Покупки идут по очереди: каждая занимает первое свободное место и дорожает по таблице прогрессии
+                balance = player_state.get(player.tg_id).balance() if count > 1 else None
+                dogs, price, income = [], 0, 0
+                while len(dogs) < count:
+                    dog_field = board.free_dog_field()
+                    offer = board.virtual_dog()
+                    if dog_field is None or (balance is not None and price + offer['price'] > balance):
+                        break
+                    dogs.append(cls(
+                        player_id=player.id,
+                        lvl=offer['lvl'],
+                        price=offer['price'],
+                        percent_up_price=offer['percent_up_price'],
+                        bonus_second=offer['bonus_second'],
+                        bonus_connection=offer['bonus_connection'],
+                        dog_field=dog_field,
+                        is_active=True
+                    ))
+                    price += offer['price']
+                    income += offer['bonus_second']
+                    board.occupy_dog_field(dog_field)
+                    board.max_dog_lvl = max(board.max_dog_lvl, offer['lvl'])
+                    board.dogs_bought += 1
+                # Списываем монеты, только если их хватает; доход до смены ставки фиксируется по старой ставке
+                if dogs:
+                    state = player_state.apply(
+                        player.tg_id,
+                        incr={'coins': -price, 'coins_spent_today': price, 'coins_in_second': income},
+                        when={'coins': ('ge', price)},
+                    )
+                if state is None:
+                    raise ValueError("У игрока недостаточно денег для создания собаки.")
+                cls.objects.bulk_create(dogs)
+                board.save(update_fields=['dog_fields', 'max_dog_lvl', 'dogs_bought'])
+        except Exception:
+            # Монеты уже списаны, а собаки не сохранились - возвращаем их
+            if state is not None:
+                player_state.apply(
+                    player.tg_id,
+                    incr={'coins': price, 'coins_spent_today': -price, 'coins_in_second': -income},
+                )
+            raise
+        return dogs, board.virtual_dog()
 
     @classmethod
     async def breed_dogs(cls, player, dog_pairs):
-        """Скрещивание собак"""
-        upgraded_dogs = []
-        for dog_ids in dog_pairs:
-            # Получаем собак по их ID
-            dogs_query = cls.objects.filter(id__in=dog_ids, player=player, is_active=True)
-            # # Преобразуем QuerySet в список асинхронно
-            dogs = [dog async for dog in dogs_query.aiterator()]
-            # Проверяем, что найдены ровно две собаки
-            if len(dogs) != 2:
-                raise ValueError(f"Для скрещивания необходимо ровно две собаки. Найдено: {len(dogs)}")
-            # Проверяем, что все собаки одного уровня
-            if len(set(dog.lvl for dog in dogs)) != 1:
-                raise ValueError("Скрещивать можно только собак одного уровня.")
-            # Удаляем одну собаку и повышаем уровень другой
-            dog_to_upgrade = dogs[0]
-            dog_to_delete = dogs[1]
-            dog_to_upgrade.lvl += 1
-            await dog_to_upgrade.asave()
-            await dog_to_delete.adelete()
-            upgraded_dogs.append(dog_to_upgrade)
-            player.coins_in_second += dog_to_upgrade.lvl - 1
-            await player.asave(update_fields=['coins_in_second'])
-        # Обновляем виртуальную собаку после скрещивания
-        await cls.update_virtual_dog_level(player)
-        return upgraded_dogs
+        """
+        Скрещивание собак пачкой пар. Пачка применяется целиком или не применяется вовсе.
+        Возвращает улучшенных собак и виртуальную собаку для следующей покупки.
+        """
+        if not isinstance(dog_pairs, list) or not dog_pairs:
+            raise ValueError("Необходимо передать список пар собак.")
+        upgraded_dogs, deleted_dogs, virtual_dog = await sync_to_async(cls._breed_dogs_locked)(player, dog_pairs)
+        state = await player_state.ainvalidate_board(player.tg_id)
+        state.apply_to(player)
+        await push_player_update(state, 'update_dogs', changed=upgraded_dogs, removed=deleted_dogs,
+                                 virtual_dog=virtual_dog)
+        return upgraded_dogs, virtual_dog
+
+    @classmethod
+    def _breed_dogs_locked(cls, player, dog_pairs):
+        """
+        Игровое поле блокируется по строке игрока, собаки читаются одним запросом, пары проверяются и скрещиваются
+        в памяти, после чего повышения, удаления и маска поля записываются постоянным числом
+        запросов в одной транзакции. В паре остаётся собака с меньшим id, вторая удаляется. Доход в секунду живёт в Redis и
+        меняется одним атомарным скриптом внутри транзакции, при откате транзакции изменение возвращается.
+        """
+        income, income_applied = 0, False
+        try:
+            with transaction.atomic():
+                board = Player.objects.select_for_update().only(
+                    'id', 'dog_fields', 'max_dog_lvl', 'dogs_bought').get(id=player.id)
+                dogs = {dog.id: dog for dog in cls.objects.filter(player_id=player.id, is_active=True)}
+                upgraded, deleted = {}, []
+                for dog_ids in dog_pairs:
+                    try:
+                        dog_ids = list(dict.fromkeys(int(dog_id) for dog_id in dog_ids))
+                    except (TypeError, ValueError):
+                        raise ValueError("Для скрещивания необходимо ровно две собаки. Найдено: 0")
+                    pair = sorted((dogs[dog_id] for dog_id in dog_ids if dog_id in dogs), key=lambda dog: dog.id)
+                    # Проверяем, что найдены ровно две собаки
+                    if len(pair) != 2:
+                        raise ValueError(f"Для скрещивания необходимо ровно две собаки. Найдено: {len(pair)}")
+                    # Проверяем, что все собаки одного уровня
+                    if pair[0].lvl != pair[1].lvl:
+                        raise ValueError("Скрещивать можно только собак одного уровня.")
+                    # Удаляем одну собаку и повышаем уровень другой
+                    dog_to_upgrade, dog_to_delete = pair
+                    dog_to_upgrade.lvl += 1
+                    upgraded[dog_to_upgrade.id] = dog_to_upgrade
+                    del dogs[dog_to_delete.id]
+                    upgraded.pop(dog_to_delete.id, None)
+                    deleted.append(dog_to_delete.id)
+                    board.release_dog_field(dog_to_delete.dog_field)
+                    income += dog_to_upgrade.lvl - 1
+                cls.objects.bulk_update(upgraded.values(), ['lvl'])
+                cls.objects.filter(id__in=deleted).delete()
+                board.max_dog_lvl = max((dog.lvl for dog in dogs.values()), default=0)
+                board.save(update_fields=['dog_fields', 'max_dog_lvl'])
+                player_state.apply(player.tg_id, incr={'coins_in_second': income})
+                income_applied = True
+        except Exception:
+            # Транзакция не зафиксировалась уже после изменения дохода в Redis - возвращаем его
+            if income_applied:
+                player_state.apply(player.tg_id, incr={'coins_in_second': -income})
+            raise
+        return list(upgraded.values()), deleted, board.virtual_dog()
 
     @classmethod
     async def delete_dog(cls, player, dog_id):
         """Удаление собаки"""
         try:
-            dog = await cls.objects.aget(id=dog_id, player=player, is_active=True)
-            await dog.adelete()
+            deleted_id, virtual_dog = await sync_to_async(cls._delete_dog_locked)(player, dog_id)
+            state = await player_state.ainvalidate_board(player.tg_id)
+            await push_player_update(state, 'delete_dog', removed=[deleted_id], virtual_dog=virtual_dog)
             return True
         except cls.DoesNotExist:
             raise ValueError("Собака не найдена или уже удалена.")
         except Exception as e:
             raise ValueError(f"Ошибка при удалении собаки: {str(e)}")
 
+    @classmethod
+    def _delete_dog_locked(cls, player, dog_id):
+        """
+        Удаляет собаку под замком игрового поля и освобождает её место в маске. Максимальный уровень
+        перечитывается только если удалена собака максимального уровня. Возвращает id удалённой собаки
+        и виртуальную собаку.
+        """
+        with transaction.atomic():
+            board = Player.objects.select_for_update().only(
+                'id', 'dog_fields', 'max_dog_lvl', 'dogs_bought').get(id=player.id)
+            dog = cls.objects.get(id=dog_id, player_id=player.id, is_active=True)
+            deleted_id = dog.id
+            dog.delete()
+            board.release_dog_field(dog.dog_field)
+            if dog.lvl >= board.max_dog_lvl:
+                board.max_dog_lvl = cls.objects.filter(player_id=player.id, is_active=True).order_by(
+                    '-lvl').values_list('lvl', flat=True).first() or 0
+            board.save(update_fields=['dog_fields', 'max_dog_lvl'])
+        return deleted_id, board.virtual_dog()
+
     class Meta:
         verbose_name = "Собака"
         verbose_name_plural = "Собаки"
+        indexes = [
+            # Максимальный уровень активных собак игрока читается из начала индекса, не заходя в таблицу
+            models.Index(fields=['player', '-lvl'], include=['dog_field'], condition=models.Q(is_active=True),
+                         name='dog_active_player_lvl_idx'),
+        ]
+        constraints = [
+            # Место поля занимает не больше одной активной собаки. Индекс также отдаёт активных собак игрока
+            models.UniqueConstraint(fields=['player', 'dog_field'], condition=models.Q(is_active=True),
+                                    name='dog_active_player_field_uniq'),
+        ]
 
 
 class ReferralSystem(models.Model):
@@ -228,6 +379,11 @@ class ReferralSystem(models.Model):
     class Meta:
         verbose_name = "Реферальная система"
         verbose_name_plural = "Реферальная системы"
+        constraints = [
+            # Пара приглашённый-реферал записывается один раз. Поиск реферала игрока и начисление бонусов рефералам
+            # читают пары только из индекса ограничения
+            models.UniqueConstraint(fields=['new_player', 'referral'], name='referral_pair_uniq'),
+        ]
 
 
 # class PromoCode(models.Model):
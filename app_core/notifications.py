@@ -0,0 +1,92 @@
+"""
+Рассылка изменений состояния игрока во все его открытые WebSocket-соединения через channel layer.
+
+Каждое изменение уходит патчем с версией состояния из Redis: добавленные, изменённые и удалённые собаки, новая
+виртуальная собака и баланс. Клиент применяет патч с версией на единицу больше своей, а при пропуске версии
+запрашивает полный снимок действием `snapshot`.
+"""
+import logging
+import weakref
+from collections import defaultdict
+from channels.layers import get_channel_layer
+from django.utils import timezone
+from app_core.economy import accrue
+
+logger = logging.getLogger(__name__)
+
+# Сессии WebSocket этого процесса по tg_id. Патч применяется к ним сразу, до доставки через Redis, поэтому
+# следующее действие в том же соединении уже проверяется по актуальному состоянию
+_local_sessions = defaultdict(weakref.WeakSet)
+
+
+def player_group(tg_id):
+    """Имя группы channel layer, в которую входят все соединения игрока."""
+    return f'player_{tg_id}'
+
+
+def subscribe(tg_id, session):
+    """Подписывает сессию соединения на патчи игрока внутри процесса."""
+    _local_sessions[int(tg_id)].add(session)
+
+
+def unsubscribe(tg_id, session):
+    """Отписывает сессию при закрытии соединения."""
+    sessions = _local_sessions.get(int(tg_id))
+    if sessions is not None:
+        sessions.discard(session)
+        if not sessions:
+            del _local_sessions[int(tg_id)]
+
+
+def player_payload(player):
+    """
+    Данные, по которым клиент сам досчитывает баланс между сообщениями, не опрашивая сервер:
+    coins + coins_in_second * (целые секунды с finish_second_coins). Офлайн бонус посчитан на тот же момент
+    и забирается, когда наступит finish_offline_coins.
+    """
+    now = timezone.now()
+    coins, settled_at = accrue(player.coins, player.coins_in_second, player.finish_second_coins, now)
+    return {
+        'coins': coins,
+        'coins_in_second': player.coins_in_second,
+        'finish_second_coins': settled_at.isoformat() if settled_at else None,
+        'offline_coins': player.offline_balance(now),
+        'start_offline_coins': player.start_offline_coins.isoformat() if player.start_offline_coins else None,
+        'finish_offline_coins': player.finish_offline_coins.isoformat() if player.finish_offline_coins else None,
+    }
+
+
+def build_patch(state, event, added=(), changed=(), removed=(), virtual_dog=None):
+    """
+    Собирает патч состояния игрока. `state` - состояние из Redis после изменения, несущее его версию,
+    `virtual_dog` - уже готовый словарь из таблиц прогрессии.
+    """
+    from app_core.serializers import dogs_data
+    return {
+        'action': 'patch',
+        'event': event,
+        'version': state.version,
+        'player': player_payload(state),
+        'added': dogs_data(added),
+        'changed': dogs_data(changed),
+        'removed': list(removed),
+        'virtual_dog': virtual_dog,
+    }
+
+
+async def push_player_update(state, event, added=(), changed=(), removed=(), virtual_dog=None):
+    """
+    Отправляет патч во все соединения игрока, через какой бы путь (HTTP или WebSocket) ни произошло изменение.
+    Ошибка доставки не должна ломать игровое действие: она только логируется, а клиент восстановится по пропуску
+    версии.
+    """
+    message = build_patch(state, event, added, changed, removed, virtual_dog)
+    for session in list(_local_sessions.get(state.tg_id, ())):
+        session.apply_patch(message)
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    try:
+        await channel_layer.group_send(player_group(state.tg_id), {'type': 'player.update', 'message': message})
+    except Exception:
+        logger.exception("Не удалось разослать изменение состояния игрока %s", state.tg_id)
@@ -0,0 +1,539 @@
+"""
+Горячее состояние игроков в Redis.
+
+Монеты, доход в секунду, отметки времени бонусов и игровое поле игрока хранятся в Redis и меняются атомарными
+Lua-скриптами, поэтому частые запросы игры не обращаются к Postgres. Изменённые игроки попадают в множество
+`player_state:dirty`, откуда задача Celery `flush_player_state` пачками переносит их в таблицу Player.
+
+Поверх Redis в каждом процессе работает короткий кэш: одновременные запросы одного игрока (мини-приложение при
+открытии почти разом вызывает несколько эндпоинтов) делят одну загрузку состояния и поля, а её результат ещё
+PLAYER_LOCAL_CACHE_TTL секунд отдаётся из памяти. Изменения через этот процесс сразу обновляют кэш.
+"""
+import asyncio
+import copy
+import json
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.utils import timezone
+from app_core.economy import accrue, accrue_offline
+from app_core.game_config import game_config
+from app_core.leaderboard import leaderboard
+
+# Поля Player, которые живут в Redis и сбрасываются в БД задачей flush_player_state
+STATE_FIELDS = (
+    'coins', 'coins_spent_today', 'coins_in_second', 'finish_second_coins', 'offline_coins', 'start_offline_coins',
+    'finish_offline_coins', 'coins_earned',
+)
+# Отметки времени хранятся в Redis как unix-время в секундах
+DATETIME_FIELDS = ('finish_second_coins', 'start_offline_coins', 'finish_offline_coins')
+
+DIRTY_KEY = 'player_state:dirty'
+FLUSHING_KEY = 'player_state:flushing'
+FLUSH_LOCK_KEY = 'player_state:flush_lock'
+
+# KEYS[1] - хэш игрока; ARGV[1] - TTL, ARGV[2..] - пары поле/значение из БД
+LOAD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return redis.call('HGETALL', KEYS[1])
+"""
+
+# KEYS[1] - хэш игрока, KEYS[2] - кэш игрового поля, KEYS[3] - множество изменённых игроков
+# ARGV[1] - tg_id, ARGV[2] - TTL, ARGV[3] - текущее время, ARGV[4] - операция в JSON
+# Возвращает nil, если игрок не загружен, 0, если условия не выполнены, иначе новое состояние.
+# Фиксация дохода (settle) переносит в coins доход за целые секунды, то же делает economy.accrue, и копит офлайн
+# бонус за те же секунды внутри окна, как economy.accrue_offline. claim_offline переносит накопленный бонус в coins
+APPLY_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+local op = cjson.decode(ARGV[4])
+local now = tonumber(ARGV[3])
+local dirty = false
+if op['settle'] then
+    local settled_at = tonumber(redis.call('HGET', KEYS[1], 'finish_second_coins') or '')
+    if settled_at then
+        local seconds = math.max(math.floor(now - settled_at), 0)
+        local rate = tonumber(redis.call('HGET', KEYS[1], 'coins_in_second'))
+        redis.call('HINCRBY', KEYS[1], 'coins', seconds * rate)
+        redis.call('HINCRBY', KEYS[1], 'coins_earned', seconds * rate)
+        local start = tonumber(redis.call('HGET', KEYS[1], 'start_offline_coins') or '')
+        local finish = tonumber(redis.call('HGET', KEYS[1], 'finish_offline_coins') or '')
+        if start and finish then
+            local overlap = math.min(settled_at + seconds, finish) - math.max(settled_at, start)
+            if overlap > 0 then
+                local offline = tonumber(redis.call('HGET', KEYS[1], 'offline_coins') or '') or 0
+                offline = math.min(offline + math.floor(overlap * rate * op['offline'][1] / 100), op['offline'][2])
+                redis.call('HSET', KEYS[1], 'offline_coins', offline)
+            end
+        end
+        redis.call('HSET', KEYS[1], 'finish_second_coins', settled_at + seconds)
+    else
+        redis.call('HSET', KEYS[1], 'finish_second_coins', ARGV[3])
+    end
+    dirty = true
+end
+for field, cond in pairs(op['when']) do
+    local current = tonumber(redis.call('HGET', KEYS[1], field) or '')
+    if current == nil or (cond[1] == 'ge' and current < cond[2]) or (cond[1] == 'le' and current > cond[2]) then
+        if dirty then
+            redis.call('SADD', KEYS[3], ARGV[1])
+        end
+        return 0
+    end
+end
+if op['claim_offline'] then
+    local offline = tonumber(redis.call('HGET', KEYS[1], 'offline_coins') or '') or 0
+    redis.call('HINCRBY', KEYS[1], 'coins', offline)
+    redis.call('HINCRBY', KEYS[1], 'coins_earned', offline)
+    redis.call('HSET', KEYS[1], 'offline_coins', 0)
+end
+for field, value in pairs(op['incr']) do
+    redis.call('HINCRBY', KEYS[1], field, value)
+    dirty = true
+end
+for field, value in pairs(op['set']) do
+    redis.call('HSET', KEYS[1], field, value)
+    dirty = true
+end
+if op['board'] then
+    redis.call('DEL', KEYS[2])
+end
+if op['board'] or op['bump'] then
+    redis.call('HINCRBY', KEYS[1], 'version', 1)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+if dirty then
+    redis.call('SADD', KEYS[3], ARGV[1])
+end
+return redis.call('HGETALL', KEYS[1])
+"""
+
+# KEYS[1] - хэш игрока, KEYS[2] - кэш игрового поля; ARGV[1] - версия при чтении, ARGV[2] - поле, ARGV[3] - TTL
+# Поле сохраняется, только если состояние никто не изменил, пока поле читалось из БД
+SET_BOARD_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'version') == ARGV[1] then
+    redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+    return 1
+end
+return 0
+"""
+
+# KEYS[1] - хэш игрока; ARGV - пары поле/значение. Перезаписывает только уже загруженное состояние
+RESET_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HSET', KEYS[1], unpack(ARGV))
+end
+return 1
+"""
+
+# KEYS[1] - изменённые игроки, KEYS[2] - игроки в процессе сохранения; ARGV[1] - размер пачки
+CLAIM_SCRIPT = """
+local ids = redis.call('SPOP', KEYS[1], ARGV[1])
+if #ids > 0 then
+    redis.call('SADD', KEYS[2], unpack(ids))
+end
+return ids
+"""
+
+
+def _encode(value):
+    """Приводит значение поля к строке для Redis."""
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return repr(value.timestamp())
+    return str(value)
+
+
+def _decode(raw):
+    """Приводит ответ HGETALL (словарь или плоский список из Lua) к словарю строк."""
+    if isinstance(raw, dict):
+        items = raw.items()
+    else:
+        items = zip(raw[::2], raw[1::2])
+    return {
+        (key.decode() if isinstance(key, bytes) else key): (value.decode() if isinstance(value, bytes) else value)
+        for key, value in items
+    }
+
+
+class PlayerState:
+    """Снимок горячего состояния игрока из Redis."""
+
+    def __init__(self, data):
+        self.id = int(data['id'])
+        self.tg_id = int(data['tg_id'])
+        self.version = int(data.get('version') or 0)
+        for field in STATE_FIELDS:
+            value = data.get(field) or ''
+            if field in DATETIME_FIELDS:
+                value = datetime.fromtimestamp(float(value), tz=dt_timezone.utc) if value else None
+            else:
+                value = int(value or 0)
+            setattr(self, field, value)
+
+    @classmethod
+    def from_redis(cls, raw):
+        return cls(_decode(raw))
+
+    def balance(self, now=None):
+        """Текущий баланс с учётом ежесекундного дохода, вычисленный без записи."""
+        return accrue(self.coins, self.coins_in_second, self.finish_second_coins, now or timezone.now())[0]
+
+    def offline_balance(self, now=None):
+        """Офлайн бонус, накопленный в текущем окне к моменту now, вычисленный без записи."""
+        progression = game_config.get().progression
+        return accrue_offline(
+            self.offline_coins, self.coins_in_second, self.finish_second_coins, now or timezone.now(),
+            self.start_offline_coins, self.finish_offline_coins, progression.offline_percent,
+            progression.offline_max_coins)
+
+    def apply_to(self, player, now=None):
+        """Переносит горячие поля на экземпляр Player, фиксируя накопленный доход на момент now."""
+        now = now or timezone.now()
+        for field in STATE_FIELDS:
+            setattr(player, field, getattr(self, field))
+        # Офлайн бонус фиксируется до того же момента, что и баланс
+        player.offline_coins = self.offline_balance(now)
+        player.coins, player.finish_second_coins = accrue(
+            self.coins, self.coins_in_second, self.finish_second_coins, now)
+        # Зафиксированный доход считается заработком так же, как при фиксации в Redis
+        player.coins_earned = self.coins_earned + player.coins - self.coins
+        return player
+
+    def to_player(self):
+        """Собирает экземпляр Player с горячими полями для bulk_update."""
+        from app_core.models import Player
+        return self.apply_to(Player(id=self.id, tg_id=self.tg_id))
+
+
+class SingleFlight:
+    """
+    Кэш загрузок в памяти процесса: на ключ выполняется одна загрузка, остальные одновременные запросы ждут её
+    результат, который затем живёт PLAYER_LOCAL_CACHE_TTL секунд. Загрузка идёт отдельной задачей, поэтому
+    отмена одного запроса (клиент закрыл соединение) не отменяет её для остальных.
+
+    Синхронный код (apply из sync_to_async, админка, задачи) сбрасывает ключи из своих потоков, пока цикл событий
+    работает с теми же словарями, поэтому все обращения к ним идут под замком. Замок не держится через await.
+    """
+
+    def __init__(self):
+        self._cache = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Значение из кэша или None, если его нет или срок истёк."""
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._cache[key]
+                return None
+            return entry[1]
+
+    def set(self, key, value):
+        """Кладёт свежее значение. Идущая загрузка ключа прочитала данные раньше и кэш уже не перезапишет."""
+        with self._lock:
+            self._inflight.pop(key, None)
+            self._store(key, value)
+
+    def invalidate(self, key):
+        """Сбрасывает значение ключа, следующий запрос загрузит его заново."""
+        with self._lock:
+            self._inflight.pop(key, None)
+            self._cache.pop(key, None)
+
+    async def aload(self, key, loader):
+        """Значение из кэша, результат уже идущей загрузки ключа или результат новой загрузки loader()."""
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            task = self._inflight.get(key)
+            if task is None or task.get_loop() is not asyncio.get_running_loop():
+                task = asyncio.ensure_future(loader())
+                self._inflight[key] = task
+                task.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        with self._lock:
+            if self._inflight.get(key) is not task:
+                # Ключ изменили или сбросили во время загрузки: результат мог устареть
+                return
+            del self._inflight[key]
+            if not task.cancelled() and task.exception() is None:
+                self._store(key, task.result())
+
+    def _store(self, key, value):
+        # Вызывается под замком
+        ttl = settings.PLAYER_LOCAL_CACHE_TTL
+        if ttl <= 0:
+            return
+        now = time.monotonic()
+        if key not in self._cache and len(self._cache) >= settings.PLAYER_LOCAL_CACHE_SIZE:
+            # Сначала выбрасываем истёкшие записи, затем самые старые
+            self._cache = {k: entry for k, entry in self._cache.items() if entry[0] > now}
+            while len(self._cache) >= settings.PLAYER_LOCAL_CACHE_SIZE:
+                del self._cache[next(iter(self._cache))]
+        self._cache[key] = (now + ttl, value)
+
+
+class PlayerStateStore:
+    """Хранилище горячего состояния игроков поверх Redis."""
+
+    def __init__(self):
+        self._scripts = {}
+        # Состояния и игровые поля по tg_id в памяти процесса
+        self._states = SingleFlight()
+        self._boards = SingleFlight()
+
+    @staticmethod
+    def key(tg_id):
+        return f'player_state:{tg_id}'
+
+    @staticmethod
+    def board_key(tg_id):
+        return f'player_state:{tg_id}:board'
+
+    @staticmethod
+    def _tg_id(tg_id):
+        """Проверяет tg_id так же, как это сделал бы запрос к БД."""
+        from app_core.models import Player
+        try:
+            return int(tg_id)
+        except (TypeError, ValueError):
+            raise Player.DoesNotExist("Player matching query does not exist.")
+
+    def _script(self, client, source):
+        """Регистрирует Lua-скрипт один раз для каждого клиента Redis."""
+        script = self._scripts.get((id(client), source))
+        if script is None:
+            script = self._scripts[(id(client), source)] = client.register_script(source)
+        return script
+
+    @staticmethod
+    def _row_args(row):
+        """Готовит строку из БД к записи в хэш игрока."""
+        args = []
+        for field in ('id', 'tg_id') + STATE_FIELDS:
+            args += [field, _encode(row[field])]
+        # Версия начинается с текущего времени в микросекундах, чтобы после повторной загрузки из БД она не
+        # оказалась меньше той, что уже видели клиенты: для этого игрок должен был бы менять состояние чаще раза
+        # в микросекунду
+        return args + ['version', str(int(time.time() * 1_000_000))]
+
+    def _apply_params(self, tg_id, incr, values, when, settle, board, bump, claim_offline):
+        incr, values, when = incr or {}, values or {}, when or {}
+        # Доход до смены ставки должен начислиться по старой ставке, а проверка баланса и выдача офлайн бонуса -
+        # видеть весь доход
+        settle = (settle or claim_offline or 'coins_in_second' in incr or 'coins_in_second' in values
+                  or 'coins' in when)
+        progression = game_config.get().progression
+        op = {
+            'incr': {field: int(value) for field, value in incr.items()},
+            'set': {field: _encode(value) for field, value in values.items()},
+            'when': {field: [cond, float(_encode(value))] for field, (cond, value) in when.items()},
+            'settle': settle,
+            'board': board,
+            'bump': bump,
+            'claim_offline': claim_offline,
+            'offline': [progression.offline_percent, progression.offline_max_coins],
+        }
+        keys = [self.key(tg_id), self.board_key(tg_id), DIRTY_KEY]
+        args = [tg_id, settings.PLAYER_STATE_TTL, repr(time.time()), json.dumps(op)]
+        return keys, args
+
+    def _apply_result(self, tg_id, result, board):
+        if board:
+            self._boards.invalidate(tg_id)
+        if result == 0:
+            return None
+        state = PlayerState.from_redis(result)
+        self._states.set(tg_id, state)
+        return copy.copy(state)
+
+    async def aget(self, tg_id, row=None):
+        """
+        Возвращает состояние игрока, при первом обращении загружая его из БД. Если вызывающий код уже прочитал
+        строку игрока с горячими полями (или только что её создал), она передаётся в row и повторно не читается.
+        Одновременные запросы одного игрока в процессе делят одну загрузку. Вызывающий код получает свою копию
+        состояния и может её менять.
+        """
+        tg_id = self._tg_id(tg_id)
+        state = await self._states.aload(tg_id, lambda: self._aload(tg_id, row))
+        return copy.copy(state)
+
+    async def _aload(self, tg_id, row):
+        from app_core.models import Player
+        client = settings.REDIS_ASYNC_INSTANCE
+        raw = await client.hgetall(self.key(tg_id))
+        if raw:
+            return PlayerState.from_redis(raw)
+        if row is None:
+            row = await Player.objects.filter(tg_id=tg_id).values('id', 'tg_id', *STATE_FIELDS).afirst()
+        if row is None:
+            raise Player.DoesNotExist("Player matching query does not exist.")
+        raw = await self._script(client, LOAD_SCRIPT)(
+            keys=[self.key(tg_id)], args=[settings.PLAYER_STATE_TTL, *self._row_args(row)])
+        return PlayerState.from_redis(raw)
+
+    def get(self, tg_id):
+        """Синхронная версия aget для задач Celery и кода внутри транзакций."""
+        from app_core.models import Player
+        tg_id = self._tg_id(tg_id)
+        client = settings.REDIS_INSTANCE
+        raw = client.hgetall(self.key(tg_id))
+        if raw:
+            return PlayerState.from_redis(raw)
+        row = Player.objects.filter(tg_id=tg_id).values('id', 'tg_id', *STATE_FIELDS).first()
+        if row is None:
+            raise Player.DoesNotExist("Player matching query does not exist.")
+        raw = self._script(client, LOAD_SCRIPT)(
+            keys=[self.key(tg_id)], args=[settings.PLAYER_STATE_TTL, *self._row_args(row)])
+        return PlayerState.from_redis(raw)
+
+    async def aapply(self, tg_id, incr=None, values=None, when=None, settle=False, board=False, bump=False,
+                     claim_offline=False):
+        """
+        Атомарно меняет состояние игрока:
+        - `incr`: приращения целочисленных полей;
+        - `values`: новые значения полей;
+        - `when`: условия вида {'поле': ('ge' или 'le', значение)}, при невыполнении которых ничего не меняется;
+        - `settle`: зафиксировать ежесекундный доход, накопленный с finish_second_coins;
+        - `board`: сбросить закэшированное игровое поле;
+        - `bump`: увеличить версию состояния, по которой клиенты применяют патчи (`board` тоже увеличивает её);
+        - `claim_offline`: после проверки условий перенести накопленный офлайн бонус в баланс.
+        Доход фиксируется и без `settle`, если меняется доход в секунду, проверяется баланс или выдаётся офлайн
+        бонус.
+        Возвращает новое состояние или None, если условия не выполнены.
+        """
+        tg_id = self._tg_id(tg_id)
+        script = self._script(settings.REDIS_ASYNC_INSTANCE, APPLY_SCRIPT)
+        keys, args = self._apply_params(tg_id, incr, values, when, settle, board, bump, claim_offline)
+        result = await script(keys=keys, args=args)
+        if result is None:
+            # Состояние ещё не загружено или истекло: поднимаем его из БД и повторяем
+            self._states.invalidate(tg_id)
+            await self.aget(tg_id)
+            result = await script(keys=keys, args=args)
+        return self._apply_result(tg_id, result, board)
+
+    def apply(self, tg_id, incr=None, values=None, when=None, settle=False, board=False, bump=False,
+              claim_offline=False):
+        """Синхронная версия aapply."""
+        tg_id = self._tg_id(tg_id)
+        script = self._script(settings.REDIS_INSTANCE, APPLY_SCRIPT)
+        keys, args = self._apply_params(tg_id, incr, values, when, settle, board, bump, claim_offline)
+        result = script(keys=keys, args=args)
+        if result is None:
+            self.get(tg_id)
+            result = script(keys=keys, args=args)
+        # Синхронный код выполняется вне цикла событий, поэтому кэш процесса только сбрасывается
+        self._states.invalidate(tg_id)
+        if board:
+            self._boards.invalidate(tg_id)
+        if result == 0:
+            return None
+        return PlayerState.from_redis(result)
+
+    async def ainvalidate_board(self, tg_id):
+        """Сбрасывает закэшированное игровое поле после изменения собак и возвращает состояние с новой версией."""
+        return await self.aapply(tg_id, board=True)
+
+    def reset(self, player, fields=STATE_FIELDS):
+        """
+        Перезаписывает поля fields загруженного состояния значениями player, например после правки в админке.
+        Остальные поля в Redis новее, чем в БД, поэтому они не трогаются.
+        """
+        args = []
+        for field in fields:
+            args += [field, _encode(getattr(player, field))]
+        if args:
+            self._script(settings.REDIS_INSTANCE, RESET_SCRIPT)(keys=[self.key(player.tg_id)], args=args)
+        self._states.invalidate(player.tg_id)
+
+    async def aget_board(self, player):
+        """
+        Возвращает игровое поле игрока (активные собаки и виртуальная собака), читая БД только при промахе кэша.
+        В кэше лежат собаки и счётчики поля, а виртуальная собака каждый раз считается по текущей игровой
+        конфигурации, поэтому смена прогрессии сразу видна и в закэшированных полях.
+        """
+        from app_core.game_config import game_config
+        board = self._boards.get(player.tg_id)
+        if board is not None and board['version'] != player.version:
+            # Поле другой версии состояния уже не годится: его изменили в другом процессе
+            self._boards.invalidate(player.tg_id)
+            board = None
+        if board is None:
+            board = await self._boards.aload(player.tg_id, lambda: self._aload_board(player))
+        virtual_dog = game_config.get().progression.virtual_dog(
+            board['dogs_bought'], board['max_dog_lvl'], player_id=player.id)
+        return {'dogs': list(board['dogs']), 'virtual_dog': virtual_dog}
+
+    async def _aload_board(self, player):
+        from app_core.models import Dog, Player
+        from app_core.serializers import dogs_data
+        client = settings.REDIS_ASYNC_INSTANCE
+        cached = await client.get(self.board_key(player.tg_id))
+        if cached is not None:
+            board = json.loads(cached)
+        else:
+            dogs = [dog async for dog in Dog.objects.filter(player_id=player.id, is_active=True).aiterator()]
+            dogs_bought, max_dog_lvl = await Player.objects.filter(id=player.id).values_list(
+                'dogs_bought', 'max_dog_lvl').aget()
+            board = {
+                'dogs': dogs_data(dogs),
+                'dogs_bought': dogs_bought,
+                'max_dog_lvl': max_dog_lvl,
+            }
+            await self._script(client, SET_BOARD_SCRIPT)(
+                keys=[self.key(player.tg_id), self.board_key(player.tg_id)],
+                args=[player.version, json.dumps(board), settings.PLAYER_STATE_TTL])
+        return {**board, 'version': player.version}
+
+    def flush(self, batch_size=None):
+        """Переносит изменённых игроков из Redis в Postgres пачками через bulk_update. Возвращает их количество."""
+        client = settings.REDIS_INSTANCE
+        batch_size = batch_size or settings.PLAYER_STATE_FLUSH_BATCH
+        lock = client.lock(FLUSH_LOCK_KEY, timeout=settings.CELERY_TASK_TIME_LIMIT)
+        if not lock.acquire(blocking=False):
+            return 0
+        try:
+            flushed = 0
+            # Сначала дописываем пачку, которую не успел сохранить упавший воркер
+            tg_ids = client.smembers(FLUSHING_KEY)
+            # Ограничиваем число пачек, чтобы не гоняться за игроками, которые меняются прямо во время сброса
+            for _ in range(client.scard(DIRTY_KEY) // batch_size + 2):
+                if not tg_ids:
+                    tg_ids = self._script(client, CLAIM_SCRIPT)(keys=[DIRTY_KEY, FLUSHING_KEY], args=[batch_size])
+                if not tg_ids:
+                    break
+                flushed += self._flush_batch(client, tg_ids, batch_size)
+                tg_ids = None
+            return flushed
+        finally:
+            lock.release()
+
+    def _flush_batch(self, client, tg_ids, batch_size):
+        from app_core.models import Player
+        pipe = client.pipeline(transaction=False)
+        for tg_id in tg_ids:
+            pipe.hgetall(self.key(int(tg_id)))
+        players = [PlayerState.from_redis(raw).to_player() for raw in pipe.execute() if raw]
+        Player.objects.bulk_update(players, STATE_FIELDS, batch_size=batch_size)
+        # Рейтинги обновляются теми же значениями, что ушли в БД
+        leaderboard.record(players)
+        # Игрок, изменённый во время сохранения, уже снова лежит в множестве изменённых
+        client.srem(FLUSHING_KEY, *tg_ids)
+        return len(players)
+
+
+player_state = PlayerStateStore()
@@ -0,0 +1,231 @@
+"""
+Профилирование живого процесса uvicorn по запросу.
+
+Два режима, оба выключены по умолчанию и включаются без перезапуска:
+
+- Профиль отдельного запроса или действия WebSocket (pyinstrument в асинхронном режиме: в отчёт попадает только
+  задача этого запроса, включая время ожидания await). Включается заголовком `X-Profile: <PROFILING_TOKEN>`
+  (для WebSocket - в запросе на подключение) или для игрока действием в админке. Отчёты HTML пишутся
+  в PROFILING_DIR.
+- Семплер стеков всех потоков процесса с частотой 1/PROFILING_SAMPLE_INTERVAL. Стеки складываются в формате
+  folded (`кадр;кадр;кадр число`), который понимают flamegraph.pl, speedscope и inferno. Включается на время
+  командой `profile_workers`.
+
+Включённые игроки и семплер хранятся в Redis, процесс сверяется с ним не чаще раза в PROFILING_REFRESH_INTERVAL
+секунд. Пока профилирование выключено, запрос платит только сравнением времени и поиском во множестве.
+"""
+import hmac
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import datetime
+from pathlib import Path
+from asgiref.sync import markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.urls import Resolver404, resolve
+from pyinstrument import Profiler
+
+logger = logging.getLogger(__name__)
+
+# Игроки с включённым профилированием: tg_id -> время окончания (unix)
+PLAYERS_KEY = 'profiling:players'
+# Время окончания работы семплера (unix), ключ истекает вместе с ним
+SAMPLER_KEY = 'profiling:sampler'
+PROFILE_HEADER = 'X-Profile'
+
+
+def _file_name(label, extension):
+    label = re.sub(r'[^A-Za-z0-9_]+', '-', label).strip('-')
+    return f'{datetime.now():%Y%m%d-%H%M%S}-{label}-{uuid.uuid4().hex[:8]}.{extension}'
+
+
+def _write(name, content):
+    """Пишет отчёт в PROFILING_DIR и возвращает путь к нему."""
+    path = Path(settings.PROFILING_DIR) / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+    return path
+
+
+def header_allowed(value):
+    """Заголовок X-Profile совпадает с PROFILING_TOKEN. Без токена заголовок не действует."""
+    if not settings.PROFILING_TOKEN or not value:
+        return False
+    return hmac.compare_digest(value.encode(), settings.PROFILING_TOKEN.encode())
+
+
+@asynccontextmanager
+async def profile(label):
+    """Профилирует блок текущей задачи и сохраняет HTML-отчёт. Возвращает словарь, куда записывается имя файла."""
+    report = {}
+    profiler = Profiler(interval=settings.PROFILING_INTERVAL, async_mode='enabled')
+    profiler.start()
+    try:
+        yield report
+    finally:
+        profiler.stop()
+        report['file'] = _file_name(label, 'html')
+        try:
+            path = await sync_to_async(_write, thread_sensitive=False)(report['file'], profiler.output_html())
+            logger.info("Профиль %s сохранён: %s", label, path)
+        except Exception:
+            logger.exception("Не удалось сохранить профиль %s", label)
+
+
+class StackSampler:
+    """Поток, который снимает стеки всех потоков процесса и по окончании пишет их в формате folded."""
+
+    def __init__(self):
+        self._thread = None
+        self._stop = threading.Event()
+        self._until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def ensure_running(self, until):
+        """Запускает семплер до момента until (unix) или продлевает работу уже запущенного."""
+        with self._lock:
+            self._until = until
+            if self.running or until <= time.time():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self.running:
+            self._stop.set()
+
+    def _run(self):
+        stacks = Counter()
+        own = threading.get_ident()
+        started = datetime.now()
+        interval = settings.PROFILING_SAMPLE_INTERVAL
+        logger.info("Семплер стеков запущен")
+        while not self._stop.wait(interval) and time.time() < self._until:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own:
+                    stacks[self.fold(names.get(thread_id, thread_id), frame)] += 1
+        content = ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+        name = f'stacks-{os.getpid()}-{started:%Y%m%d-%H%M%S}.folded'
+        try:
+            logger.info("Семплер стеков остановлен, %d выборок: %s", sum(stacks.values()), _write(name, content))
+        except Exception:
+            logger.exception("Не удалось сохранить стеки семплера")
+
+    @staticmethod
+    def fold(thread_name, frame):
+        """Стек от корня к текущему кадру: имя потока, затем модуль:функция каждого кадра."""
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_qualname}")
+            frame = frame.f_back
+        frames.append(str(thread_name))
+        return ';'.join(reversed(frames)).replace(' ', '_')
+
+
+class ProfilingControl:
+    """Включение профилирования игроков и семплера, общее для всех процессов через Redis."""
+
+    def __init__(self):
+        self.sampler = StackSampler()
+        self._players = frozenset()
+        self._refresh_at = 0.0
+
+    def enable_player(self, tg_id, seconds=None):
+        """Профилировать все запросы и действия игрока seconds секунд (по умолчанию PROFILING_PLAYER_SECONDS)."""
+        now = time.time()
+        pipe = settings.REDIS_INSTANCE.pipeline(transaction=False)
+        pipe.zremrangebyscore(PLAYERS_KEY, '-inf', now)
+        pipe.zadd(PLAYERS_KEY, {tg_id: now + (seconds or settings.PROFILING_PLAYER_SECONDS)})
+        pipe.execute()
+
+    def disable_player(self, tg_id):
+        settings.REDIS_INSTANCE.zrem(PLAYERS_KEY, tg_id)
+
+    def start_sampler(self, seconds):
+        settings.REDIS_INSTANCE.set(SAMPLER_KEY, time.time() + seconds, ex=max(int(seconds), 1))
+
+    def stop_sampler(self):
+        settings.REDIS_INSTANCE.delete(SAMPLER_KEY)
+
+    async def aplayers(self):
+        """tg_id игроков с включённым профилированием. Раз в интервал заодно запускает или останавливает семплер."""
+        if time.monotonic() >= self._refresh_at:
+            await self._arefresh()
+        return self._players
+
+    async def _arefresh(self):
+        self._refresh_at = time.monotonic() + settings.PROFILING_REFRESH_INTERVAL
+        try:
+            pipe = settings.REDIS_ASYNC_INSTANCE.pipeline(transaction=False)
+            pipe.zrangebyscore(PLAYERS_KEY, time.time(), '+inf')
+            pipe.get(SAMPLER_KEY)
+            players, sampler_until = await pipe.execute()
+        except Exception:
+            # Профилирование не должно ронять запросы, остаёмся с прежним состоянием до следующей сверки
+            logger.exception("Не удалось прочитать настройки профилирования")
+            return
+        self._players = frozenset(int(tg_id) for tg_id in players)
+        if sampler_until:
+            self.sampler.ensure_running(float(sampler_until))
+        else:
+            self.sampler.stop()
+
+
+profiling = ProfilingControl()
+
+
+def request_tg_id(request):
+    """tg_id игрока из параметров адреса или JSON-тела запроса."""
+    try:
+        tg_id = resolve(request.path_info).kwargs.get('tg_id')
+    except Resolver404:
+        return None
+    if tg_id is None and request.content_type == 'application/json':
+        from app_core.renderers import loads
+        try:
+            data = loads(request.body)
+        except ValueError:
+            return None
+        tg_id = data.get('tg_id') if isinstance(data, dict) else None
+    try:
+        return int(tg_id)
+    except (TypeError, ValueError):
+        return None
+
+
+class ProfilingMiddleware:
+    """
+    Профилирует HTTP-запрос с заголовком X-Profile или запрос игрока с включённым профилированием. Для запроса
+    с заголовком имя отчёта возвращается в заголовке ответа X-Profile-File.
+    """
+    sync_capable = False
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        markcoroutinefunction(self)
+
+    async def __call__(self, request):
+        requested = header_allowed(request.headers.get(PROFILE_HEADER))
+        players = await profiling.aplayers()
+        # tg_id ищется, только когда профилирование включено хоть для одного игрока
+        if not requested and not (players and request_tg_id(request) in players):
+            return await self.get_response(request)
+        async with profile(f'http-{request.method}-{request.path}') as report:
+            response = await self.get_response(request)
+        if requested:
+            response['X-Profile-File'] = report['file']
+        return response
@@ -0,0 +1,61 @@
+"""
+Таблицы прогрессии собак: цена по порядковому номеру покупки, доход в секунду и бонус за скрещивание по уровню,
+а также параметры офлайн бонуса.
+Таблицы строятся один раз на версию progression.json (см. game_config), поэтому виртуальная собака (предложение
+следующей покупки) вычисляется по количеству покупок и максимальному уровню собаки на поле без строки в БД.
+"""
+from bisect import bisect_right
+from datetime import timedelta
+
+# Верхняя граница цены: Dog.price хранится в IntegerField
+MAX_PRICE = 2 ** 31 - 1
+# Верхняя граница офлайн бонуса: Player.offline_coins хранится в IntegerField
+MAX_OFFLINE_COINS = 2 ** 31 - 1
+
+
+class Progression:
+    """Предрассчитанные таблицы прогрессии одной версии."""
+
+    def __init__(self, data):
+        self.version = data['version']
+        self.level_step = data['level_step']
+        self.max_level = data['max_level']
+        # Процент роста цены и цена для каждой покупки по порядку
+        bounds = [step['from_purchase'] for step in data['price_growth']]
+        self.percent_up_price = [
+            data['price_growth'][bisect_right(bounds, index) - 1]['percent_up_price']
+            for index in range(data['max_purchases'])
+        ]
+        self.prices = [data['base_price']]
+        for percent in self.percent_up_price[:-1]:
+            self.prices.append(min(int(self.prices[-1] * (1 + percent / 100)), MAX_PRICE))
+        # Доход в секунду и бонус за скрещивание для каждого уровня виртуальной собаки
+        self.bonus_second = [0] + [data['base_bonus_second'] * lvl for lvl in range(1, self.max_level + 1)]
+        self.bonus_connection = [0] + [lvl - 1 for lvl in range(1, self.max_level + 1)]
+        # Офлайн бонус: окно, процент дохода в секунду, который копится за окно, и потолок за одно окно. Бонус
+        # добавляется к обычному доходу, который тоже копится офлайн, а не заменяет его
+        offline = data.get('offline_bonus', {})
+        self.offline_window = timedelta(seconds=offline.get('window_seconds', 3 * 60 * 60))
+        self.offline_percent = offline.get('percent', 100)
+        self.offline_max_coins = min(offline.get('max_coins', MAX_OFFLINE_COINS), MAX_OFFLINE_COINS)
+
+    def level(self, max_dog_lvl):
+        """Уровень виртуальной собаки по максимальному уровню собаки на поле."""
+        return min(max_dog_lvl // self.level_step + 1, self.max_level)
+
+    def virtual_dog(self, dogs_bought, max_dog_lvl, player_id=None):
+        """Виртуальная собака в формате DogSerializer. После последней строки таблицы цена не растёт."""
+        index = min(dogs_bought, len(self.prices) - 1)
+        lvl = self.level(max_dog_lvl)
+        return {
+            'id': None,
+            'name': '',
+            'lvl': lvl,
+            'price': self.prices[index],
+            'percent_up_price': self.percent_up_price[index],
+            'bonus_second': self.bonus_second[lvl],
+            'bonus_connection': self.bonus_connection[lvl],
+            'dog_field': None,
+            'is_active': False,
+            'player': player_id,
+        }
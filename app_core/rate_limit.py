@@ -0,0 +1,114 @@
+"""
+Ограничение частоты действий игрока.
+
+У каждого tg_id в Redis лежит корзина токенов `rate_limit:<tg_id>`, общая для HTTP и WebSocket: она пополняется
+со скоростью PLAYER_RATE_LIMIT_RATE токенов в секунду до PLAYER_RATE_LIMIT_BURST, каждое действие забирает токены.
+Лишние действия отклоняются до обращения к Postgres, а быстрые нажатия клиент может отправить одной пачкой.
+"""
+import logging
+import time
+from django.conf import settings
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.throttling import BaseThrottle
+
+logger = logging.getLogger(__name__)
+
+# KEYS[1] - корзина игрока; ARGV[1] - скорость пополнения, ARGV[2] - ёмкость, ARGV[3] - текущее время,
+# ARGV[4] - стоимость действия. Возвращает {1, 0}, если токены списаны, иначе {0, секунды до нужного запаса}
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+if wait > 0 then
+    return {0, tostring(wait)}
+end
+return {1, '0'}
+"""
+
+
+class RateLimiter:
+    """Корзины токенов игроков в Redis."""
+
+    def __init__(self):
+        self._scripts = {}
+
+    @staticmethod
+    def key(tg_id):
+        return f'rate_limit:{tg_id}'
+
+    def _script(self, client):
+        script = self._scripts.get(id(client))
+        if script is None:
+            script = self._scripts[id(client)] = client.register_script(TOKEN_BUCKET_SCRIPT)
+        return script
+
+    @staticmethod
+    def _args(cost):
+        return [settings.PLAYER_RATE_LIMIT_RATE, settings.PLAYER_RATE_LIMIT_BURST, repr(time.time()), cost]
+
+    @staticmethod
+    def _result(result):
+        allowed, wait = result
+        return bool(int(allowed)), float(wait)
+
+    async def aacquire(self, tg_id, cost=1):
+        """Списывает cost токенов. Возвращает (разрешено, секунды до повтора)."""
+        try:
+            result = await self._script(settings.REDIS_ASYNC_INSTANCE)(keys=[self.key(tg_id)], args=self._args(cost))
+        except Exception:
+            # Без Redis ограничение не работает, но и действия игроков не блокирует
+            logger.warning("Не удалось проверить частоту действий игрока %s", tg_id, exc_info=True)
+            return True, 0.0
+        return self._result(result)
+
+    def acquire(self, tg_id, cost=1):
+        """Синхронная версия aacquire."""
+        try:
+            result = self._script(settings.REDIS_INSTANCE)(keys=[self.key(tg_id)], args=self._args(cost))
+        except Exception:
+            logger.warning("Не удалось проверить частоту действий игрока %s", tg_id, exc_info=True)
+            return True, 0.0
+        return self._result(result)
+
+
+rate_limiter = RateLimiter()
+
+
+class PlayerActionThrottle(BaseThrottle):
+    """
+    Ограничение изменяющих запросов игрока по корзине токенов его tg_id. tg_id берётся из адреса или тела
+    запроса, чтения не ограничиваются. Превышение DRF превращает в ответ 429 с заголовком Retry-After.
+    """
+
+    def __init__(self):
+        self.retry_after = None
+
+    def allow_request(self, request, view):
+        if request.method in SAFE_METHODS:
+            return True
+        tg_id = view.kwargs.get('tg_id')
+        if tg_id is None and hasattr(request.data, 'get'):
+            tg_id = request.data.get('tg_id')
+        try:
+            tg_id = int(tg_id)
+        except (TypeError, ValueError):
+            # Неверный tg_id отклонит само представление
+            return True
+        allowed, self.retry_after = rate_limiter.acquire(tg_id)
+        return allowed
+
+    def wait(self):
+        return self.retry_after
@@ -0,0 +1,62 @@
+"""
+Реферальная система: начисление рефералам процента от заработка приглашённых игроков.
+
+Заработок игрока за всё время (`coins_earned`) растёт вместе с балансом в горячем состоянии и сбрасывается в БД.
+Задача `distribute_referral_rewards` раз в период одной транзакцией из трёх UPDATE переносит прирост заработка
+приглашённых игроков в `daily_bonus_friends` их рефералов, не перебирая игроков в Python.
+"""
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from app_core.models import Player, ReferralSystem
+
+
+class SecondsSince(models.Func):
+    """Целые секунды от отметки времени до момента now, не меньше нуля, как в economy.accrue."""
+    template = 'GREATEST(FLOOR(EXTRACT(EPOCH FROM (%(now)s - %(expressions)s))), 0)'
+    # django_timestamp_diff - функция, которую Django регистрирует в SQLite: разность отметок в микросекундах
+    sqlite_template = 'MAX(django_timestamp_diff(%(now)s, %(expressions)s) / 1000000, 0)'
+    output_field = models.BigIntegerField()
+
+    def __init__(self, expression, now, **extra):
+        super().__init__(expression, **extra)
+        self.now = now
+
+    def as_sql(self, compiler, connection, **extra_context):
+        sql, params = super().as_sql(compiler, connection, now='%s', **extra_context)
+        # Параметр now стоит в шаблоне перед выражением
+        return sql, (connection.ops.adapt_datetimefield_value(self.now), *params)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template=self.sqlite_template, **extra_context)
+
+
+def distribute_referral_rewards(percent=None):
+    """
+    Начисляет рефералам percent процентов от заработка приглашённых ими игроков с прошлого прохода.
+    Заработок включает доход в секунду, ещё не зафиксированный в coins, поэтому промежуток между проходами не
+    зависит от того, заходил ли игрок. Возвращает количество рефералов, получивших бонус.
+    """
+    percent = settings.REFERRAL_REWARD_PERCENT if percent is None else percent
+    now = timezone.now()
+    earned = F('coins_earned') + Coalesce(F('coins_in_second') * SecondsSince('finish_second_coins', now), Value(0))
+    referred = Player.objects.filter(new_person__referral__isnull=False)
+    with transaction.atomic():
+        # 1. Фиксируем прирост заработка приглашённых игроков: новое значение и прирост считаются из одной строки
+        referred.alias(earned=earned).filter(earned__gt=F('referral_earned_credited')).update(
+            referral_earned_pending=earned - F('referral_earned_credited'),
+            referral_earned_credited=earned,
+        )
+        # 2. Одним UPDATE начисляем каждому рефералу процент от суммы прироста его друзей
+        friends_earned = ReferralSystem.objects.filter(
+            referral_id=OuterRef('pk'), new_player__referral_earned_pending__gt=0,
+        ).values('referral_id').annotate(total=Sum('new_player__referral_earned_pending')).values('total')
+        credited = Player.objects.filter(referral__new_player__referral_earned_pending__gt=0).update(
+            daily_bonus_friends=F('daily_bonus_friends') + Subquery(
+                friends_earned, output_field=models.BigIntegerField()) * percent / 100,
+        )
+        # 3. Прирост учтён
+        referred.filter(referral_earned_pending__gt=0).update(referral_earned_pending=0)
+    return credited
@@ -0,0 +1,41 @@
+"""
+Кодирование JSON через orjson для ответов API и сообщений WebSocket.
+
+Типы, которые orjson не знает (ленивые строки переводов, Decimal, QuerySet), а также даты кодируются так же, как
+это делает JSONRenderer DRF, поэтому ответы совпадают с прежними.
+"""
+import time
+import orjson
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+from app_core.metrics import add_serialization
+
+_encoder = JSONEncoder()
+_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+loads = orjson.loads
+
+
+def dumps(data):
+    """JSON в байтах UTF-8. Время кодирования засчитывается текущему действию в метриках."""
+    started = time.perf_counter()
+    content = orjson.dumps(data, default=_encoder.default, option=_OPTIONS)
+    add_serialization(time.perf_counter() - started)
+    return content
+
+
+def dumps_text(data):
+    """JSON строкой для текстовых сообщений WebSocket."""
+    return dumps(data).decode()
+
+
+class ORJSONRenderer(BaseRenderer):
+    """Замена JSONRenderer DRF на orjson."""
+    media_type = 'application/json'
+    format = 'json'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return dumps(data)
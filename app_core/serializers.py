@@ -1,12 +1,15 @@
 from adrf.serializers import ModelSerializer
+from rest_framework import serializers
 from app_core.models import *
 
 
 class PlayerSerializer(ModelSerializer):
     """Сериализатор для модели Player"""
+    daily_bonus = serializers.BooleanField(read_only=True)
+
     class Meta:
         model = Player
-        fields = '__all__'
+        exclude = ('referral_earned_credited', 'referral_earned_pending')
 
 
 class DogSerializer(ModelSerializer):
@@ -14,3 +17,46 @@ class DogSerializer(ModelSerializer):
     class Meta:
         model = Dog
         fields = '__all__'
+
+
+# Поля собаки в компактном формате: собака передаётся массивом значений в этом порядке, а сам порядок приходит
+# в ответе полем dog_fields. Игрок и признак активности для собак на поле не нужны
+DOG_COMPACT_FIELDS = ('id', 'name', 'lvl', 'price', 'percent_up_price', 'bonus_second', 'bonus_connection',
+                      'dog_field')
+
+
+def dog_data(dog):
+    """Собака в формате DogSerializer, собранная напрямую: ответы игры отдают поле целиком и часто."""
+    return {
+        'id': dog.id,
+        'name': dog.name,
+        'lvl': dog.lvl,
+        'price': dog.price,
+        'percent_up_price': dog.percent_up_price,
+        'bonus_second': dog.bonus_second,
+        'bonus_connection': dog.bonus_connection,
+        'dog_field': dog.dog_field,
+        'is_active': dog.is_active,
+        'player': dog.player_id,
+    }
+
+
+def dogs_data(dogs):
+    return [dog_data(dog) for dog in dogs]
+
+
+def compact_dog(dog):
+    """Собака (словарь в формате DogSerializer) массивом значений в порядке DOG_COMPACT_FIELDS."""
+    return [dog[field] for field in DOG_COMPACT_FIELDS]
+
+
+def compact_payload(payload):
+    """Копия ответа с полем игрока (снимка или патча), в которой собаки и виртуальная собака - массивы."""
+    compact = dict(payload)
+    for key in ('dogs', 'added', 'changed'):
+        if key in compact:
+            compact[key] = [compact_dog(dog) for dog in compact[key]]
+    if compact.get('virtual_dog') is not None:
+        compact['virtual_dog'] = compact_dog(compact['virtual_dog'])
+    compact['dog_fields'] = DOG_COMPACT_FIELDS
+    return compact
@@ -1,8 +1,72 @@
 from celery import shared_task
+from django.conf import settings
 from app_core.models import *
+from app_core.leaderboard import leaderboard
+from app_core.player_state import player_state
+from app_core.referrals import distribute_referral_rewards
 
 
-@shared_task(acks_late=True, reject_on_worker_lost=True)
-def reset_login_today():
-    """Сбрасывает поле daily_bonus у всех игроков."""
-    Player.objects.update(daily_bonus=True)
+@shared_task(acks_late=True, reject_on_worker_lost=True, ignore_result=True)
+def flush_player_state():
+    """Сбрасывает изменённое горячее состояние игроков из Redis в БД."""
+    return player_state.flush()
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True, ignore_result=True)
+def rebuild_leaderboard():
+    """Пересобирает рейтинги игроков в Redis из БД."""
+    return leaderboard.rebuild()
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True, ignore_result=True)
+def credit_referral_rewards():
+    """Начисляет рефералам бонус от заработка приглашённых игроков."""
+    return distribute_referral_rewards()
+
+
+def _selected_page(model, ids, lookups, search, after):
+    """Пачка id объектов, выбранных действием админки (см. ScalableModelAdmin.enqueue), после id after."""
+    from django.contrib import admin
+    return admin.site.get_model_admin(model).selected_pks(ids, lookups, search, after,
+                                                          settings.ADMIN_TASK_CHUNK_SIZE)
+
+
+def _next_page(task, page, ids, lookups, search):
+    """Полная пачка - выбор не закончился: задача ставит себя же на следующую пачку."""
+    if len(page) >= settings.ADMIN_TASK_CHUNK_SIZE:
+        task.delay(ids=ids, lookups=lookups, search=search, after=page[-1])
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True, ignore_result=True)
+def delete_players(ids=None, lookups=None, search='', after=0):
+    """Удаляет игроков, выбранных в админке, вместе с их данными в Redis, пачками по ADMIN_TASK_CHUNK_SIZE."""
+    player_ids = _selected_page(Player, ids, lookups, search, after)
+    deleted = Player.purge(Player.objects.filter(id__in=player_ids).values_list('tg_id', flat=True))
+    _next_page(delete_players, player_ids, ids, lookups, search)
+    return deleted
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True, ignore_result=True)
+def delete_dogs(ids=None, lookups=None, search='', after=0):
+    """
+    Удаляет собак, выбранных в админке, пачками по ADMIN_TASK_CHUNK_SIZE. Собаки на поле удаляются по одной под
+    замком поля игрока с освобождением места, после чего закэшированные поля игроков сбрасываются.
+    """
+    dog_ids = _selected_page(Dog, ids, lookups, search, after)
+    touched, inactive = set(), []
+    for dog_id, is_active, player_id, tg_id in Dog.objects.filter(id__in=dog_ids).values_list(
+            'id', 'is_active', 'player_id', 'player__tg_id'):
+        if not is_active:
+            inactive.append(dog_id)
+            continue
+        try:
+            Dog._delete_dog_locked(Player(id=player_id, tg_id=tg_id), dog_id)
+        except Dog.DoesNotExist:
+            # Игрок успел сам скрестить или удалить собаку
+            continue
+        touched.add(tg_id)
+    Dog.objects.filter(id__in=inactive, is_active=False).delete()
+    for tg_id in touched:
+        player_state.apply(tg_id, board=True)
+    _next_page(delete_dogs, dog_ids, ids, lookups, search)
+    return len(touched)
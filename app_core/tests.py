@@ -1,3 +1,1347 @@
-from django.test import TestCase
+import asyncio
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.apps import apps
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin.exceptions import DisallowedModelAdminLookup
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, OperationalError
+from django.db.models.query import QuerySet
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from psycopg_pool import PoolTimeout
+from app_core.admin import DogAdmin, PlayerAdmin
+from app_core.economy import accrue, accrue_offline
+from app_core.game_config import CONFIG_FILES, DailyBonusTable, GameConfigLoader, game_config
+from app_core.models import BOARD_SIZE, Dog, Player
+from app_core.leaderboard import REBUILD_SCHEDULED_KEY, Leaderboard, leaderboard
+from app_core.consumers import PlayerSession
+from app_core.db_pool import DatabasePoolBackpressureMiddleware, is_saturated, pool_stats
+from app_core.metrics import CONTENT_TYPE, ActionMetrics, registry, track
+from app_core.notifications import _local_sessions, build_patch
+from app_core.profiling import StackSampler, profiling, request_tg_id
+from app_core.player_state import DIRTY_KEY, FLUSHING_KEY, SingleFlight, player_state
+from app_core.rate_limit import rate_limiter
+from app_core.serializers import DOG_COMPACT_FIELDS, DogSerializer, compact_payload, dog_data
+from app_core.referrals import distribute_referral_rewards
+from app_core.tasks import delete_players
+from dogs.routing import websocket_urlpatterns
 
-# Create your tests here.
+# Тесты запускаются на SQLite и fakeredis: python manage.py test --settings=dogs.test_settings
+
+
+class RedisTestMixin:
+    """Очищает Redis перед каждым тестом: состояние игроков и рейтинги не переходят между тестами."""
+
+    def setUp(self):
+        super().setUp()
+        settings.REDIS_INSTANCE.flushall()
+
+
+class LoadtestCommandTests(RedisTestMixin, TransactionTestCase):
+    def test_smoke_run_without_errors(self):
+        out = StringIO()
+        call_command('loadtest', players=2, json=True, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertGreater(report['actions'], 0)
+        self.assertEqual({action: row['errors'] for action, row in report['by_action'].items()},
+                         dict.fromkeys(report['by_action'], 0))
+
+
+class PlayerStateTests(RedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # Без дохода в секунду баланс не меняется между вызовами
+        self.player = Player.objects.create(tg_id=1001, name='player', coins=100, coins_in_second=0)
+
+    def test_apply_rejects_underfunded_purchase(self):
+        state = player_state.apply(self.player.tg_id, incr={'coins': -150, 'coins_spent_today': 150},
+                                   when={'coins': ('ge', 150)})
+        self.assertIsNone(state)
+        state = player_state.get(self.player.tg_id)
+        self.assertEqual((state.coins, state.coins_spent_today), (100, 0))
+
+    def test_apply_charges_when_balance_is_enough(self):
+        state = player_state.apply(self.player.tg_id, incr={'coins': -60, 'coins_spent_today': 60},
+                                   when={'coins': ('ge', 60)})
+        self.assertEqual((state.coins, state.coins_spent_today), (40, 60))
+
+    def test_version_grows_by_one_per_change(self):
+        version = player_state.get(self.player.tg_id).version
+        self.assertEqual(player_state.apply(self.player.tg_id, bump=True).version, version + 1)
+        self.assertEqual(player_state.apply(self.player.tg_id, board=True).version, version + 2)
+        # Изменение без bump и board версию не трогает
+        self.assertEqual(player_state.apply(self.player.tg_id, incr={'coins': 1}).version, version + 2)
+
+    def test_version_does_not_go_back_after_reload(self):
+        player_state.get(self.player.tg_id)
+        for _ in range(3):
+            seen = player_state.apply(self.player.tg_id, bump=True).version
+        settings.REDIS_INSTANCE.delete(player_state.key(self.player.tg_id))
+        self.assertGreater(player_state.get(self.player.tg_id).version, seen)
+
+    def test_flush_writes_changes_once_and_clears_dirty_set(self):
+        player_state.apply(self.player.tg_id, incr={'coins': 50, 'coins_spent_today': 50})
+        self.assertTrue(settings.REDIS_INSTANCE.sismember(DIRTY_KEY, self.player.tg_id))
+        self.assertEqual(player_state.flush(), 1)
+        self.assertEqual(settings.REDIS_INSTANCE.scard(DIRTY_KEY), 0)
+        self.assertEqual(settings.REDIS_INSTANCE.scard(FLUSHING_KEY), 0)
+        self.assertEqual(player_state.flush(), 0)
+        self.player.refresh_from_db()
+        self.assertEqual((self.player.coins, self.player.coins_spent_today), (150, 50))
+
+    def test_flush_finishes_batch_of_crashed_worker(self):
+        player_state.apply(self.player.tg_id, incr={'coins': 50})
+        # Воркер забрал игрока в пачку и упал до сохранения
+        settings.REDIS_INSTANCE.smove(DIRTY_KEY, FLUSHING_KEY, self.player.tg_id)
+        self.assertEqual(player_state.flush(), 1)
+        self.assertEqual(settings.REDIS_INSTANCE.scard(FLUSHING_KEY), 0)
+        self.player.refresh_from_db()
+        self.assertEqual(self.player.coins, 150)
+
+    def test_get_after_reset_returns_db_values(self):
+        player_state.apply(self.player.tg_id, incr={'coins': 500})
+        Player.objects.filter(id=self.player.id).update(coins=7, coins_spent_today=3)
+        self.player.refresh_from_db()
+        player_state.reset(self.player)
+        state = player_state.get(self.player.tg_id)
+        self.assertEqual((state.coins, state.coins_spent_today), (7, 3))
+
+
+class DogTests(RedisTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.player = Player.objects.create(tg_id=2001, name='player', coins=10 ** 6, coins_in_second=0)
+
+    def add_dogs(self, *levels):
+        Player.objects.filter(id=self.player.id).update(dog_fields=(1 << len(levels)) - 1, max_dog_lvl=max(levels))
+        return [Dog.objects.create(player=self.player, lvl=lvl, dog_field=field) for field, lvl in enumerate(levels, 1)]
+
+    def board(self):
+        return Player.objects.values('dog_fields', 'max_dog_lvl', 'dogs_bought').get(id=self.player.id)
+
+    def active_levels(self):
+        return sorted(Dog.objects.filter(player_id=self.player.id, is_active=True).values_list('lvl', flat=True))
+
+    async def test_concurrent_purchases_of_last_free_field(self):
+        await sync_to_async(self.add_dogs)(*[1] * (BOARD_SIZE - 1))
+        results = await asyncio.gather(Dog.create_dog(self.player), Dog.create_dog(self.player),
+                                       return_exceptions=True)
+        bought = [result for result in results if not isinstance(result, Exception)]
+        errors = [result for result in results if isinstance(result, Exception)]
+        self.assertEqual(len(bought), 1)
+        self.assertIsInstance(errors[0], ValueError)
+        self.assertEqual(bought[0][0].dog_field, BOARD_SIZE)
+        board = await Player.objects.values('dog_fields', 'dogs_bought').aget(id=self.player.id)
+        self.assertEqual(board, {'dog_fields': (1 << BOARD_SIZE) - 1, 'dogs_bought': 1})
+        # Монеты списаны только за одну собаку
+        state = await player_state.aget(self.player.tg_id)
+        self.assertEqual(state.coins_spent_today, bought[0][0].price)
+
+    def test_breeding_frees_field_for_next_purchase(self):
+        first, second = self.add_dogs(1, 1)
+        Dog._breed_dogs_locked(self.player, [[first.id, second.id]])
+        self.assertEqual(self.board(), {'dog_fields': 0b1, 'max_dog_lvl': 2, 'dogs_bought': 0})
+        (dog,), _ = Dog._create_dogs_locked(self.player, 1)
+        self.assertEqual(dog.dog_field, second.dog_field)
+        self.assertEqual(self.board(), {'dog_fields': 0b11, 'max_dog_lvl': 2, 'dogs_bought': 1})
+        self.assertEqual(self.active_levels(), [1, 2])
+
+    def test_breeding_keeps_dog_with_lower_id(self):
+        first, second = self.add_dogs(1, 1)
+        upgraded, deleted, _ = Dog._breed_dogs_locked(self.player, [[second.id, first.id]])
+        self.assertEqual(([dog.id for dog in upgraded], deleted), ([first.id], [second.id]))
+        self.assertEqual(Dog.objects.get(id=first.id).lvl, 2)
+        self.assertFalse(Dog.objects.filter(id=second.id).exists())
+        # Доход собаки второго уровня
+        self.assertEqual(player_state.get(self.player.tg_id).coins_in_second, 1)
+
+    def test_breeding_chains_pairs_through_upgraded_dog(self):
+        first, second, third = self.add_dogs(1, 1, 2)
+        upgraded, deleted, _ = Dog._breed_dogs_locked(self.player, [[first.id, second.id], [first.id, third.id]])
+        self.assertEqual(([dog.id for dog in upgraded], deleted), ([first.id], [second.id, third.id]))
+        self.assertEqual(self.active_levels(), [3])
+        self.assertEqual(self.board(), {'dog_fields': 0b1, 'max_dog_lvl': 3, 'dogs_bought': 0})
+        self.assertEqual(player_state.get(self.player.tg_id).coins_in_second, 1 + 2)
+
+    def test_breeding_rejects_dogs_of_different_levels(self):
+        first, second = self.add_dogs(1, 2)
+        with self.assertRaises(ValueError):
+            Dog._breed_dogs_locked(self.player, [[first.id, second.id]])
+        self.assertEqual(self.board(), {'dog_fields': 0b11, 'max_dog_lvl': 2, 'dogs_bought': 0})
+        self.assertEqual(self.active_levels(), [1, 2])
+        self.assertEqual(player_state.get(self.player.tg_id).coins_in_second, 0)
+
+    def test_batch_with_invalid_pair_is_not_applied(self):
+        first, second, third, fourth = self.add_dogs(1, 1, 1, 2)
+        with self.assertRaises(ValueError):
+            Dog._breed_dogs_locked(self.player, [[first.id, second.id], [third.id, fourth.id]])
+        self.assertEqual(self.active_levels(), [1, 1, 1, 2])
+        self.assertEqual(player_state.get(self.player.tg_id).coins_in_second, 0)
+
+    async def test_breeding_rejects_pairs_that_are_not_a_list(self):
+        for dog_pairs in (5, 'ab', {'a': 1}, []):
+            with self.assertRaisesMessage(ValueError, "Необходимо передать список пар собак."):
+                await Dog.breed_dogs(self.player, dog_pairs)
+
+    def test_purchase_is_refunded_when_insert_fails(self):
+        before = player_state.get(self.player.tg_id)
+        with mock.patch.object(QuerySet, 'bulk_create', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                Dog._create_dogs_locked(self.player, 3)
+        state = player_state.get(self.player.tg_id)
+        self.assertEqual((state.coins, state.coins_spent_today, state.coins_in_second),
+                         (before.coins, before.coins_spent_today, before.coins_in_second))
+        self.assertEqual(self.active_levels(), [])
+        self.assertEqual(self.board(), {'dog_fields': 0, 'max_dog_lvl': 0, 'dogs_bought': 0})
+
+
+class DailyBonusTableTests(SimpleTestCase):
+    BONUSES = [{'day': 1, 'coins': 10}, {'day': 3, 'coins': 30}]
+
+    def test_missing_days_give_nothing(self):
+        table = DailyBonusTable({'bonuses': self.BONUSES})
+        self.assertEqual([table.coins(day) for day in (0, 1, 2, 3)], [0, 10, 0, 30])
+
+    def test_repeat_last_after_the_table_ends(self):
+        table = DailyBonusTable({'after_last_day': 'repeat_last', 'bonuses': self.BONUSES})
+        self.assertEqual([table.coins(day) for day in (4, 5, 100)], [30, 30, 30])
+
+    def test_cycle_after_the_table_ends(self):
+        table = DailyBonusTable({'after_last_day': 'cycle', 'bonuses': self.BONUSES})
+        self.assertEqual([table.coins(day) for day in (4, 5, 6, 7)], [10, 0, 30, 10])
+
+    def test_unknown_rule_is_rejected(self):
+        with self.assertRaises(ValueError):
+            DailyBonusTable({'after_last_day': 'reset', 'bonuses': self.BONUSES})
+
+
+class DailyBonusTests(RedisTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.player = Player.objects.create(tg_id=3001, name='player', coins_in_second=0)
+        self.today = timezone.localdate()
+
+    def set_streak(self, last_login_date, consecutive_days):
+        Player.objects.filter(id=self.player.id).update(
+            last_login_date=last_login_date, consecutive_days=consecutive_days)
+
+    async def test_second_claim_on_the_same_day_is_a_no_op(self):
+        # Оба запроса прочитали игрока до того, как один из них забрал бонус
+        first, second = [await Player.objects.aget(id=self.player.id) for _ in range(2)]
+        claimed = await asyncio.gather(first.update_daily_status(), second.update_daily_status())
+        self.assertEqual(sorted(claimed), [False, True])
+        self.assertFalse(await first.update_daily_status())
+        player = await Player.objects.aget(id=self.player.id)
+        self.assertEqual((player.consecutive_days, player.last_login_date), (1, self.today))
+        state = await player_state.aget(self.player.tg_id)
+        self.assertEqual(state.coins, game_config.get().daily_bonus_table.coins(1))
+
+    async def test_streak_continues_after_yesterday(self):
+        await sync_to_async(self.set_streak)(self.today - timedelta(days=1), 4)
+        player = await Player.objects.aget(id=self.player.id)
+        self.assertTrue(await player.update_daily_status())
+        self.assertEqual(player.consecutive_days, 5)
+        self.assertEqual(player.coins, game_config.get().daily_bonus_table.coins(5))
+
+    async def test_streak_resets_after_missed_day(self):
+        await sync_to_async(self.set_streak)(self.today - timedelta(days=2), 4)
+        player = await Player.objects.aget(id=self.player.id)
+        self.assertTrue(await player.update_daily_status())
+        player = await Player.objects.aget(id=self.player.id)
+        self.assertEqual((player.consecutive_days, player.last_login_date), (1, self.today))
+
+
+class PlayerAdminTests(RedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.player = Player.objects.create(tg_id=4001, name='player', coins=100, coins_in_second=0)
+        # Игрок заработал монеты, которые ещё не сброшены в БД
+        player_state.apply(self.player.tg_id, incr={'coins': 500, 'coins_spent_today': 5})
+        self.admin = PlayerAdmin(Player, admin.site)
+
+    def save(self, **changes):
+        player = Player.objects.get(id=self.player.id)
+        for field, value in changes.items():
+            setattr(player, field, value)
+        self.admin.save_model(None, player, SimpleNamespace(changed_data=list(changes)), change=True)
+
+    def test_editing_other_fields_keeps_hot_state(self):
+        self.save(name='renamed', lvl=3)
+        state = player_state.get(self.player.tg_id)
+        self.assertEqual((state.coins, state.coins_spent_today), (600, 5))
+        self.assertEqual(Player.objects.get(id=self.player.id).lvl, 3)
+        # Рейтинг получает монеты из Redis, а не отстающие из БД
+        self.assertEqual(settings.REDIS_INSTANCE.zscore(leaderboard.key('coins'), self.player.tg_id), 600)
+
+    def test_edited_hot_field_replaces_value_in_redis(self):
+        self.save(coins=7)
+        state = player_state.get(self.player.tg_id)
+        self.assertEqual((state.coins, state.coins_spent_today), (7, 5))
+        self.assertEqual(settings.REDIS_INSTANCE.zscore(leaderboard.key('coins'), self.player.tg_id), 7)
+
+
+class LeaderboardRebuildTests(RedisTestMixin, TransactionTestCase):
+    async def wait_enqueued(self):
+        await asyncio.gather(*leaderboard._pending)
+
+    async def test_empty_board_is_returned_without_waiting_for_broker(self):
+        published = threading.Event()
+        with mock.patch.object(Leaderboard, '_publish_rebuild', side_effect=lambda: published.wait(5)):
+            started = time.perf_counter()
+            self.assertEqual(await leaderboard.atop('coins', 10), [])
+            self.assertLess(time.perf_counter() - started, 1)
+            published.set()
+            await self.wait_enqueued()
+
+    async def test_failed_enqueue_lets_next_request_retry(self):
+        with mock.patch.object(Leaderboard, '_publish_rebuild', side_effect=ConnectionError) as publish:
+            await leaderboard.atop('coins', 10)
+            await self.wait_enqueued()
+            self.assertFalse(await settings.REDIS_ASYNC_INSTANCE.exists(REBUILD_SCHEDULED_KEY))
+            await leaderboard.atop('coins', 10)
+            await self.wait_enqueued()
+        self.assertEqual(publish.call_count, 2)
+
+    async def test_missing_board_is_rebuilt_once(self):
+        player = await Player.objects.acreate(tg_id=5001, name='player')
+        with mock.patch.object(Leaderboard, '_publish_rebuild', wraps=Leaderboard._publish_rebuild) as publish:
+            await asyncio.gather(leaderboard.atop('lvl', 10), leaderboard.atop('lvl', 10))
+            await self.wait_enqueued()
+        self.assertEqual(publish.call_count, 1)
+        self.assertEqual([row['tg_id'] for row in await leaderboard.atop('lvl', 10)], [player.tg_id])
+
+    def scores(self, board):
+        rows = settings.REDIS_INSTANCE.zrange(leaderboard.key(board), 0, -1, withscores=True)
+        return {int(tg_id): int(score) for tg_id, score in rows}
+
+    def test_rebuild_merges_into_live_boards(self):
+        now = timezone.now()
+        active = Player.objects.create(tg_id=5002, name='active', coins=100, coins_in_second=5, lvl=2,
+                                       finish_second_coins=now)
+        idle = Player.objects.create(tg_id=5003, name='idle', coins=10, coins_in_second=2,
+                                     finish_second_coins=now - timedelta(seconds=100))
+        # flush_player_state успел записать значения новее тех, что прочитает пересборка
+        leaderboard.record([SimpleNamespace(tg_id=active.tg_id, coins=500, coins_in_second=9),
+                            SimpleNamespace(tg_id=idle.tg_id, coins=10, coins_in_second=2)])
+        self.assertEqual(leaderboard.rebuild(), 2)
+        # Монеты бездействующего игрока выросли на доход за 100 секунд
+        self.assertEqual(self.scores('coins'), {active.tg_id: 500, idle.tg_id: 210})
+        self.assertEqual(self.scores('coins_in_second'), {active.tg_id: 9, idle.tg_id: 2})
+        self.assertEqual(self.scores('lvl'), {active.tg_id: 2, idle.tg_id: 1})
+
+    async def test_rebuild_without_players_is_not_repeated(self):
+        self.assertEqual(await sync_to_async(leaderboard.rebuild)(), 0)
+        with mock.patch.object(Leaderboard, '_publish_rebuild') as publish:
+            self.assertEqual(await leaderboard.atop('coins', 10), [])
+            await self.wait_enqueued()
+        publish.assert_not_called()
+
+    def test_registered_player_is_ranked_at_once(self):
+        player = Player.register(5004, 'player')
+        self.assertEqual(self.scores('lvl'), {player.tg_id: 1})
+
+
+class ReferralRewardTests(TestCase):
+    def setUp(self):
+        self.referral = Player.register(6001, 'referral')
+        self.friend = Player.register(6002, 'friend', referral_tg_id=self.referral.tg_id)
+        self.now = timezone.now()
+
+    def earn(self, coins_earned, coins_in_second=0, finish_second_coins=None):
+        Player.objects.filter(id=self.friend.id).update(
+            coins_earned=coins_earned, coins_in_second=coins_in_second, finish_second_coins=finish_second_coins)
+
+    def distribute(self):
+        with mock.patch('app_core.referrals.timezone.now', return_value=self.now):
+            return distribute_referral_rewards(percent=10)
+
+    def bonus(self):
+        return Player.objects.values_list('daily_bonus_friends', flat=True).get(id=self.referral.id)
+
+    def test_first_pass_credits_percent_of_earnings(self):
+        self.earn(1000)
+        self.assertEqual(self.distribute(), 1)
+        self.assertEqual(self.bonus(), 100)
+        self.assertEqual(Player.objects.values('referral_earned_credited', 'referral_earned_pending').get(
+            id=self.friend.id), {'referral_earned_credited': 1000, 'referral_earned_pending': 0})
+
+    def test_next_pass_credits_only_the_increase(self):
+        self.earn(1000)
+        self.distribute()
+        self.earn(1500)
+        self.assertEqual(self.distribute(), 1)
+        self.assertEqual(self.bonus(), 150)
+        # Без нового заработка проход ничего не начисляет
+        self.assertEqual(self.distribute(), 0)
+        self.assertEqual(self.bonus(), 150)
+
+    def test_income_not_yet_settled_counts_in_whole_seconds(self):
+        self.earn(1000, coins_in_second=20, finish_second_coins=self.now - timedelta(seconds=10.5))
+        self.distribute()
+        self.assertEqual(self.bonus(), (1000 + 10 * 20) // 10)
+
+    def test_player_without_settle_time_earns_only_coins_earned(self):
+        self.earn(1000, coins_in_second=20, finish_second_coins=None)
+        self.distribute()
+        self.assertEqual(self.bonus(), 100)
+
+    def test_settle_time_in_the_future_adds_nothing(self):
+        self.earn(1000, coins_in_second=20, finish_second_coins=self.now + timedelta(seconds=30))
+        self.distribute()
+        self.assertEqual(self.bonus(), 100)
+
+
+class AdminBackgroundDeleteTests(RedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.players = [Player.objects.create(tg_id=tg_id, name='player') for tg_id in range(7001, 7006)]
+        self.player_admin = PlayerAdmin(Player, admin.site)
+
+    def run_action(self, model_admin, query='', selected=(), select_across=False):
+        request = RequestFactory().post(f'/admin/?{query}', {'select_across': '1' if select_across else '0'})
+        queryset = model_admin.model.objects.filter(pk__in=selected)
+        with mock.patch.object(model_admin, 'message_user'):
+            model_admin.delete_in_background(request, queryset)
+
+    def remaining(self):
+        return sorted(Player.objects.values_list('tg_id', flat=True))
+
+    def test_selected_rows_are_deleted(self):
+        self.run_action(self.player_admin, selected=[self.players[0].id, self.players[2].id])
+        self.assertEqual(self.remaining(), [7002, 7004, 7005])
+
+    def test_select_across_deletes_only_the_filtered_list(self):
+        # Выбраны все объекты списка: отмеченные на странице id не передаются, задача ищет их сама
+        self.run_action(self.player_admin, query='q=7003&p=2', select_across=True)
+        self.assertEqual(self.remaining(), [7001, 7002, 7004, 7005])
+
+    @override_settings(ADMIN_TASK_CHUNK_SIZE=2)
+    def test_one_task_pages_through_the_selection(self):
+        with mock.patch.object(delete_players, 'delay', wraps=delete_players.delay) as delay:
+            self.run_action(self.player_admin, select_across=True)
+        self.assertEqual(self.remaining(), [])
+        # Первая постановка из админки и две следующие пачки из самой задачи
+        self.assertEqual(delay.call_count, 3)
+
+    def test_select_across_applies_list_filters(self):
+        active = Dog.objects.create(player=self.players[0], dog_field=1)
+        inactive = Dog.objects.create(player=self.players[0], is_active=False)
+        self.run_action(DogAdmin(Dog, admin.site), query='is_active__exact=0', select_across=True)
+        self.assertEqual(list(Dog.objects.values_list('id', flat=True)), [active.id])
+        self.assertFalse(Dog.objects.filter(id=inactive.id).exists())
+
+    def test_lookup_outside_list_filters_is_rejected(self):
+        with self.assertRaises(DisallowedModelAdminLookup):
+            self.player_admin.selected_pks(None, {'dogs__name': ['x']}, '', 0, 10)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        self.flight = SingleFlight()
+
+    async def test_invalidate_from_another_thread_during_load(self):
+        async def loader():
+            # Синхронный apply сбрасывает ключ из потока, пока загрузка идёт в цикле событий
+            await asyncio.to_thread(self.flight.invalidate, 'key')
+            return 'stale'
+
+        self.assertEqual(await self.flight.aload('key', loader), 'stale')
+        self.assertIsNone(self.flight.get('key'))
+
+    @override_settings(PLAYER_LOCAL_CACHE_SIZE=2)
+    def test_invalidate_from_another_thread_while_cache_is_pruned(self):
+        class Key(str):
+            # Хэширование ключа при пересборке кэша отдаёт управление другому потоку
+            on_hash = None
+
+            def __hash__(self):
+                if self.on_hash:
+                    self.on_hash()
+                return str.__hash__(self)
+
+        def invalidate_first():
+            second.on_hash = None
+            worker.start()
+            worker.join(0.2)
+
+        first, second = Key('first'), Key('second')
+        worker = threading.Thread(target=self.flight.invalidate, args=[first])
+        self.flight.set(first, 1)
+        self.flight.set(second, 2)
+        second.on_hash = invalidate_first
+        self.flight.set(Key('third'), 3)
+        worker.join()
+        self.assertEqual((self.flight.get('second'), self.flight.get('third')), (2, 3))
+
+    async def test_concurrent_loads_share_one_call(self):
+        release, calls = asyncio.Event(), []
+
+        async def loader():
+            calls.append(1)
+            await release.wait()
+            return 'value'
+
+        waiting = asyncio.gather(*(self.flight.aload('key', loader) for _ in range(5)))
+        await asyncio.sleep(0)
+        release.set()
+        self.assertEqual(await waiting, ['value'] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.flight.get('key'), 'value')
+
+    @override_settings(PLAYER_LOCAL_CACHE_TTL=0.05)
+    def test_value_expires_after_ttl(self):
+        self.flight.set('key', 'value')
+        self.assertEqual(self.flight.get('key'), 'value')
+        time.sleep(0.06)
+        self.assertIsNone(self.flight.get('key'))
+
+    @override_settings(PLAYER_LOCAL_CACHE_TTL=0)
+    def test_zero_ttl_disables_cache(self):
+        self.flight.set('key', 'value')
+        self.assertIsNone(self.flight.get('key'))
+
+    async def test_load_does_not_overwrite_value_set_meanwhile(self):
+        release = asyncio.Event()
+
+        async def loader():
+            await release.wait()
+            return 'stale'
+
+        loading = asyncio.ensure_future(self.flight.aload('key', loader))
+        await asyncio.sleep(0)
+        self.flight.set('key', 'fresh')
+        release.set()
+        # Ждавший загрузку получает её результат, но в кэше остаётся значение, записанное позже
+        self.assertEqual(await loading, 'stale')
+        self.assertEqual(self.flight.get('key'), 'fresh')
+        # Следующая загрузка уже не ждёт старую
+        self.assertEqual(await self.flight.aload('key', loader), 'fresh')
+
+    async def test_load_does_not_refill_invalidated_key(self):
+        release = asyncio.Event()
+
+        async def loader():
+            await release.wait()
+            return 'stale'
+
+        loading = asyncio.ensure_future(self.flight.aload('key', loader))
+        await asyncio.sleep(0)
+        self.flight.invalidate('key')
+        release.set()
+        self.assertEqual(await loading, 'stale')
+        self.assertIsNone(self.flight.get('key'))
+
+
+class PlayerStateLocalCacheTests(RedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.player = Player.objects.create(tg_id=8001, name='player', coins=100)
+        # Кэш процесса общий для всех тестов
+        player_state._states.invalidate(self.player.tg_id)
+        self.addCleanup(player_state._states.invalidate, self.player.tg_id)
+        # Состояние уже в Redis: дальше загрузка - это только чтение хэша
+        player_state.get(self.player.tg_id)
+
+    async def test_concurrent_requests_share_one_redis_read(self):
+        client = settings.REDIS_ASYNC_INSTANCE
+        with mock.patch.object(client, 'hgetall', wraps=client.hgetall) as hgetall:
+            states = await asyncio.gather(*(player_state.aget(self.player.tg_id) for _ in range(5)))
+            # Вызывающие получают свои копии состояния
+            self.assertEqual(len({id(state) for state in states}), 5)
+            self.assertEqual({state.coins for state in states}, {100})
+            await player_state.aget(self.player.tg_id)
+        self.assertEqual(hgetall.call_count, 1)
+
+
+class AccrueTests(SimpleTestCase):
+    def setUp(self):
+        self.settled_at = timezone.now()
+
+    def at(self, seconds):
+        return self.settled_at + timedelta(seconds=seconds)
+
+    def test_only_whole_seconds_are_settled(self):
+        self.assertEqual(accrue(100, 10, self.settled_at, self.at(3.9)), (130, self.at(3)))
+
+    def test_fraction_is_kept_for_next_settle(self):
+        coins, settled_at = accrue(100, 10, self.settled_at, self.at(3.9))
+        # Остаток 0.9 с не потерян: вместе со следующими 0.3 с даёт ещё одну секунду
+        self.assertEqual(accrue(coins, 10, settled_at, self.at(4.2)), (140, self.at(4)))
+
+    def test_zero_rate_moves_settle_time_only(self):
+        self.assertEqual(accrue(100, 0, self.settled_at, self.at(3600.5)), (100, self.at(3600)))
+
+    def test_without_settle_time_nothing_accrues(self):
+        self.assertEqual(accrue(100, 10, None, self.at(60)), (100, None))
+
+    def test_settle_time_in_the_future_accrues_nothing(self):
+        self.assertEqual(accrue(100, 10, self.settled_at, self.at(-5)), (100, self.settled_at))
+
+
+class SettleRoundTripTests(RedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.settled_at = timezone.now() - timedelta(seconds=12.7)
+        self.player = Player.objects.create(tg_id=9001, name='player', coins=100, coins_earned=100,
+                                            coins_in_second=10, finish_second_coins=self.settled_at)
+
+    def test_settle_in_redis_matches_accrue(self):
+        state = player_state.apply(self.player.tg_id, settle=True)
+        seconds = (state.finish_second_coins - self.settled_at).total_seconds()
+        # Lua фиксирует те же целые секунды, что и accrue, дробная часть времени фиксации сохраняется
+        self.assertGreaterEqual(seconds, 12)
+        self.assertAlmostEqual(seconds, round(seconds), places=3)
+        self.assertEqual((state.coins, state.coins_earned), (100 + round(seconds) * 10, 100 + round(seconds) * 10))
+        self.assertEqual(state.balance(state.finish_second_coins + timedelta(seconds=2.5)), state.coins + 20)
+
+    def test_apply_to_settles_like_redis(self):
+        state = player_state.get(self.player.tg_id)
+        now = self.settled_at + timedelta(seconds=12.7)
+        player = state.apply_to(Player(id=self.player.id, tg_id=self.player.tg_id), now)
+        self.assertEqual((player.coins, player.coins_earned), (220, 220))
+        self.assertAlmostEqual(player.finish_second_coins.timestamp(),
+                               (self.settled_at + timedelta(seconds=12)).timestamp(), places=3)
+        # Повторная фиксация на тот же момент ничего не добавляет
+        self.assertEqual(accrue(player.coins, 10, player.finish_second_coins, now)[0], 220)
+
+
+class AccrueOfflineTests(SimpleTestCase):
+    def setUp(self):
+        self.settled_at = timezone.now()
+
+    def at(self, seconds):
+        return self.settled_at + timedelta(seconds=seconds)
+
+    def offline(self, now, start, finish, percent=100, max_coins=10 ** 6, offline_coins=0):
+        return accrue_offline(offline_coins, 10, self.settled_at, self.at(now), self.at(start), self.at(finish),
+                              percent, max_coins)
+
+    def test_only_seconds_inside_window_count(self):
+        # Фиксация до начала окна и после его конца: учитывается только само окно
+        self.assertEqual(self.offline(100, start=20, finish=50), 300)
+        # Окно ещё идёт: учитываются целые секунды до now
+        self.assertEqual(self.offline(35.8, start=20, finish=50), 150)
+
+    def test_window_outside_settled_seconds_adds_nothing(self):
+        self.assertEqual(self.offline(100, start=-50, finish=-10, offline_coins=7), 7)
+        self.assertEqual(self.offline(10, start=20, finish=50, offline_coins=7), 7)
+
+    def test_percent_of_income(self):
+        self.assertEqual(self.offline(100, start=20, finish=50, percent=50), 150)
+
+    def test_window_total_is_capped(self):
+        self.assertEqual(self.offline(100, start=20, finish=50, max_coins=200, offline_coins=120), 200)
+
+    def test_without_window_or_settle_time_nothing_accrues(self):
+        self.assertEqual(accrue_offline(7, 10, self.settled_at, self.at(100), None, None, 100, 10 ** 6), 7)
+        self.assertEqual(accrue_offline(7, 10, None, self.at(100), self.at(0), self.at(50), 100, 10 ** 6), 7)
+
+
+class OfflineBonusTests(RedisTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = timezone.now()
+        # Игрок был офлайн 100 с, окно бонуса закрылось 40 с назад и длилось 60 с
+        self.player = Player.objects.create(
+            tg_id=10001, name='player', coins=0, coins_earned=0, coins_in_second=10, offline_coins=50,
+            finish_second_coins=self.now - timedelta(seconds=100),
+            start_offline_coins=self.now - timedelta(seconds=100),
+            finish_offline_coins=self.now - timedelta(seconds=40))
+        self.settled_at = self.player.finish_second_coins
+        player_state._states.invalidate(self.player.tg_id)
+        self.addCleanup(player_state._states.invalidate, self.player.tg_id)
+
+    def income(self, state):
+        return round((state.finish_second_coins - self.settled_at).total_seconds()) * 10
+
+    def test_claim_banks_window_and_moves_it_to_coins(self):
+        state = player_state.apply(self.player.tg_id, claim_offline=True)
+        # 50 уже накоплено и 60 с окна по 10 монет при 100 %
+        self.assertEqual(state.offline_coins, 0)
+        self.assertEqual((state.coins, state.coins_earned), (self.income(state) + 650, self.income(state) + 650))
+
+    def test_claim_is_refused_while_window_is_open(self):
+        Player.objects.filter(id=self.player.id).update(finish_offline_coins=self.now + timedelta(seconds=60))
+        state = player_state.apply(self.player.tg_id, when={'finish_offline_coins': ('le', timezone.now())},
+                                   claim_offline=True)
+        self.assertIsNone(state)
+        state = player_state.get(self.player.tg_id)
+        # Доход и бонус за все 100 с офлайн внутри окна зафиксированы, бонус остался ждать конца окна
+        self.assertEqual(state.offline_coins, 50 + 1000)
+        self.assertEqual(state.coins, self.income(state))
+
+    async def claim(self):
+        return await self.async_client.post(reverse('collecting_bonuses'), {'tg_id': self.player.tg_id, 'hour': True},
+                                            content_type='application/json')
+
+    async def test_get_bonus_claims_once_per_window(self):
+        response = await self.claim()
+        self.assertEqual(response.status_code, 200)
+        state = await player_state.aget(self.player.tg_id)
+        self.assertEqual(state.offline_coins, 0)
+        self.assertEqual(state.coins, self.income(state) + 650)
+        self.assertEqual(response.json()['player_coins'], state.balance())
+        # Открыто следующее окно
+        window = game_config.get().progression.offline_window
+        self.assertEqual(state.finish_offline_coins - state.start_offline_coins, window)
+        self.assertGreaterEqual(state.start_offline_coins, self.now)
+        response = await self.claim()
+        self.assertEqual((response.status_code, response.json()), (400, {"error": "Офлайн бонус еще недоступен."}))
+
+
+class PlayerSocketTests(RedisTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.player = Player.objects.create(tg_id=11001, name='player', coins=1000, coins_in_second=0)
+        player_state._states.invalidate(self.player.tg_id)
+        self.addCleanup(player_state._states.invalidate, self.player.tg_id)
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/dogs/{self.player.tg_id}/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_change_in_one_socket_reaches_the_other(self):
+        first, second = await self.connect(), await self.connect()
+        try:
+            await first.send_json_to({'action': 'create_dog'})
+            patch = await first.receive_json_from()
+            self.assertEqual(await second.receive_json_from(), patch)
+            self.assertEqual((patch['action'], patch['event']), ('patch', 'create_dog'))
+            self.assertEqual(len(patch['added']), 1)
+            # Сессии процесса получили патч сразу, до группы, и совпадают с тем, что пришло клиентам
+            sessions = list(_local_sessions[self.player.tg_id])
+            self.assertEqual(len(sessions), 2)
+            for session in sessions:
+                self.assertEqual(session.state.version, patch['version'])
+                self.assertEqual(list(session.dogs.values()), patch['added'])
+                self.assertEqual(session.virtual_dog, patch['virtual_dog'])
+                self.assertEqual(session.state.coins, patch['player']['coins'])
+                self.assertEqual(session.state.finish_second_coins.isoformat(), patch['player']['finish_second_coins'])
+            # Снимок второго сокета строится из памяти сессии и уже содержит собаку
+            await second.send_json_to({'action': 'get_dogs'})
+            snapshot = await second.receive_json_from()
+            self.assertEqual((snapshot['version'], snapshot['dogs']), (patch['version'], patch['added']))
+        finally:
+            await first.disconnect()
+            await second.disconnect()
+        self.assertNotIn(self.player.tg_id, _local_sessions)
+
+
+class PlayerSessionTests(RedisTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.player = Player.objects.create(tg_id=12001, name='player', coins=50, coins_in_second=0)
+        self.dogs = [Dog.objects.create(player=self.player, lvl=lvl, dog_field=field)
+                     for field, lvl in enumerate([1, 1, 2], 1)]
+        for cache in (player_state._states, player_state._boards):
+            cache.invalidate(self.player.tg_id)
+            self.addCleanup(cache.invalidate, self.player.tg_id)
+
+    async def load(self):
+        session = PlayerSession(self.player.tg_id)
+        await session.load()
+        return session
+
+    async def test_load_reads_state_and_board(self):
+        session = await self.load()
+        self.assertFalse(session.stale)
+        self.assertEqual(session.state.coins, 50)
+        self.assertEqual(sorted(session.dogs), [dog.id for dog in self.dogs])
+        self.assertEqual(session.virtual_dog['price'], game_config.get().progression.virtual_dog(0, 2)['price'])
+        snapshot = session.snapshot('get_dogs')
+        self.assertEqual((snapshot['action'], snapshot['version']), ('get_dogs', session.state.version))
+        self.assertEqual(snapshot['player']['coins'], 50)
+        self.assertEqual(snapshot['dogs'], list(session.dogs.values()))
+
+    async def test_patch_is_applied_once_and_gap_marks_session_stale(self):
+        session = await self.load()
+        state = await player_state.aapply(self.player.tg_id, incr={'coins': 25}, board=True)
+        removed = self.dogs[0].id
+        patch = build_patch(state, 'delete_dog', removed=[removed])
+        self.assertTrue(session.apply_patch(patch))
+        self.assertFalse(session.stale)
+        self.assertNotIn(removed, session.dogs)
+        self.assertEqual((session.state.coins, session.state.version), (75, state.version))
+        # Тот же патч из группы уже учтён
+        self.assertFalse(session.apply_patch(patch))
+        # Патч через версию применяется, но сессия перечитается перед следующим действием
+        state = await player_state.aapply(self.player.tg_id, bump=True)
+        state = await player_state.aapply(self.player.tg_id, incr={'coins': 5}, bump=True)
+        self.assertTrue(session.apply_patch(build_patch(state, 'bonus')))
+        self.assertTrue(session.stale)
+        self.assertEqual(session.state.coins, 80)
+
+    async def test_create_dog_checks(self):
+        session = await self.load()
+        with self.assertRaisesMessage(ValueError, "недостаточно денег"):
+            session.check_create_dog()
+        session.state.coins = session.virtual_dog['price']
+        session.check_create_dog()
+        session.dogs = {dog_id: {'id': dog_id, 'lvl': 1} for dog_id in range(BOARD_SIZE)}
+        with self.assertRaisesMessage(ValueError, "максимальное количество собак"):
+            session.check_create_dog()
+
+    async def test_update_dogs_checks(self):
+        session = await self.load()
+        first, second, third = [dog.id for dog in self.dogs]
+        session.check_update_dogs([[first, second]])
+        with self.assertRaisesMessage(ValueError, "Необходимо передать список пар собак."):
+            session.check_update_dogs([])
+        with self.assertRaisesMessage(ValueError, "одного уровня"):
+            session.check_update_dogs([[first, third]])
+        with self.assertRaisesMessage(ValueError, "Найдено: 1"):
+            session.check_update_dogs([[first, 10 ** 9]])
+        with self.assertRaisesMessage(ValueError, "ровно две собаки"):
+            session.check_update_dogs([['x', first]])
+        # Собаки, уже затронутые предыдущей парой, проверяет БД
+        session.check_update_dogs([[first, second], [first, third]])
+        for dog_pairs in (5, 'ab', {'a': 1}):
+            with self.assertRaisesMessage(ValueError, "Необходимо передать список пар собак."):
+                session.check_update_dogs(dog_pairs)
+
+    async def test_delete_dog_checks(self):
+        session = await self.load()
+        session.check_delete_dog(str(self.dogs[0].id))
+        for dog_id in (None, 'x', 10 ** 9):
+            with self.assertRaisesMessage(ValueError, "Собака не найдена или уже удалена."):
+                session.check_delete_dog(dog_id)
+
+
+@override_settings(PLAYER_RATE_LIMIT_RATE=1, PLAYER_RATE_LIMIT_BURST=3)
+class RateLimitTests(RedisTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.player = Player.objects.create(tg_id=13001, name='player', coins=10 ** 6, coins_in_second=0)
+        for cache in (player_state._states, player_state._boards):
+            cache.invalidate(self.player.tg_id)
+            self.addCleanup(cache.invalidate, self.player.tg_id)
+        self.now = time.time()
+
+    def acquire(self, cost=1, after=0):
+        with mock.patch('app_core.rate_limit.time', SimpleNamespace(time=lambda: self.now + after)):
+            return rate_limiter.acquire(self.player.tg_id, cost)
+
+    def tokens(self):
+        return float(settings.REDIS_INSTANCE.hget(rate_limiter.key(self.player.tg_id), 'tokens'))
+
+    def test_bucket_allows_burst_then_refills_at_rate(self):
+        self.assertEqual([self.acquire()[0] for _ in range(3)], [True] * 3)
+        self.assertEqual(self.acquire(), (False, 1.0))
+        self.assertEqual(self.acquire(after=0.5), (False, 0.5))
+        self.assertEqual(self.acquire(after=1), (True, 0.0))
+        # Простой не копит токенов больше ёмкости
+        self.assertEqual(self.acquire(cost=3, after=100), (True, 0.0))
+        self.assertEqual(self.acquire(cost=2, after=100), (False, 2.0))
+
+    def test_redis_failure_does_not_block_players(self):
+        with mock.patch.object(rate_limiter, '_script', side_effect=ConnectionError), \
+                self.assertLogs('app_core.rate_limit', 'WARNING'):
+            self.assertEqual(rate_limiter.acquire(self.player.tg_id), (True, 0.0))
+
+    async def test_redis_failure_does_not_block_players_async(self):
+        with mock.patch.object(rate_limiter, '_script', side_effect=ConnectionError), \
+                self.assertLogs('app_core.rate_limit', 'WARNING'):
+            self.assertEqual(await rate_limiter.aacquire(self.player.tg_id), (True, 0.0))
+
+    async def test_throttled_request_gets_retry_after(self):
+        await sync_to_async(self.acquire)(cost=3)
+        response = await self.async_client.post(
+            reverse('collecting_bonuses'), {'tg_id': self.player.tg_id, 'second': True},
+            content_type='application/json')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/dogs/{self.player.tg_id}/')
+        await communicator.connect()
+        return communicator
+
+    async def test_batch_spends_a_token_per_action(self):
+        socket = await self.connect()
+        try:
+            await self.spend_in_batches(socket)
+        finally:
+            await socket.disconnect()
+
+    async def spend_in_batches(self, socket):
+        await socket.send_json_to({'action': 'batch', 'actions': [{'action': 'create_dog'}, {'action': 'create_dog'}]})
+        self.assertEqual([(await socket.receive_json_from())['event'] for _ in range(2)], ['create_dog'] * 2)
+        self.assertLess(await sync_to_async(self.tokens)(), 1.5)
+        # Пачка, на которую не хватает токенов, отклоняется целиком
+        await socket.send_json_to({'action': 'batch', 'actions': [{'action': 'create_dog'}] * 3})
+        response = await socket.receive_json_from()
+        self.assertEqual(response['error'], "Слишком много действий, повторите позже.")
+        self.assertEqual(await Dog.objects.filter(player_id=self.player.id).acount(), 2)
+
+    async def test_batch_longer_than_burst_is_rejected_without_spending_tokens(self):
+        socket = await self.connect()
+        try:
+            await socket.send_json_to({'action': 'batch', 'actions': [{'action': 'create_dog'}] * 4})
+            response = await socket.receive_json_from()
+        finally:
+            await socket.disconnect()
+        self.assertEqual(response, {'error': "В пачке может быть не больше 3 действий."})
+        self.assertFalse(await settings.REDIS_ASYNC_INSTANCE.exists(rate_limiter.key(self.player.tg_id)))
+
+
+class ProgressionPriceTests(SimpleTestCase):
+    def setUp(self):
+        self.progression = game_config.get().progression
+
+    def test_price_grows_by_7_percent_until_purchase_16(self):
+        self.assertEqual(self.progression.prices[:4], [100, 107, 114, 121])
+        price = 100
+        for index in range(1, 17):
+            price = int(price * 1.07)
+            self.assertEqual(self.progression.prices[index], price)
+        self.assertEqual(self.progression.percent_up_price[15], 7.0)
+
+    def test_price_grows_by_17_5_percent_from_purchase_16(self):
+        self.assertEqual(self.progression.percent_up_price[16], 17.5)
+        self.assertEqual(self.progression.prices[17], int(self.progression.prices[16] * 1.175))
+        self.assertEqual(self.progression.virtual_dog(17, 0)['price'], self.progression.prices[17])
+
+    def test_price_stops_growing_after_the_table(self):
+        last = self.progression.prices[-1]
+        self.assertEqual(self.progression.virtual_dog(10 ** 6, 0)['price'], last)
+        self.assertLessEqual(last, 2 ** 31 - 1)
+
+
+class DogsBoughtBackfillTests(TestCase):
+    migration = importlib.import_module('app_core.migrations.0004_player_dogs_bought')
+
+    def legacy_player(self, tg_id, virtual_price=None):
+        player = Player.objects.create(tg_id=tg_id, name='player')
+        Dog.objects.create(player=player, dog_field=1)
+        if virtual_price is not None:
+            # До 0004 следующая покупка хранилась строкой неактивной собаки с её ценой
+            Dog.objects.create(player=player, price=virtual_price, is_active=False)
+        return player
+
+    def test_table_of_migration_matches_first_progression_version(self):
+        self.assertEqual(self.migration.version_1_prices(), game_config.get().progression.prices)
+
+    def test_purchase_count_is_recovered_from_virtual_dog_price(self):
+        prices = self.migration.version_1_prices()
+        players = {
+            0: self.legacy_player(14001, prices[0]),
+            5: self.legacy_player(14002, prices[5]),
+            20: self.legacy_player(14003, prices[20]),
+            # Цена между строками таблицы, например округлённая старым кодом иначе
+            7: self.legacy_player(14004, prices[7] + 1),
+            # Цена ниже базовой
+            -1: self.legacy_player(14005, 50),
+            None: self.legacy_player(14006),
+        }
+        self.migration.fill_dogs_bought(apps, None)
+        bought = dict(Player.objects.values_list('tg_id', 'dogs_bought'))
+        self.assertEqual({key: bought[player.tg_id] for key, player in players.items()},
+                         {0: 0, 5: 5, 20: 20, 7: 7, -1: 0, None: 0})
+        self.assertFalse(Dog.objects.filter(is_active=False).exists())
+        self.assertEqual(Dog.objects.filter(is_active=True).count(), len(players))
+
+
+class PlayerInfoTests(RedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.player = Player.objects.create(tg_id=15001, name='player', coins=70, instruction=False)
+        player_state._states.invalidate(self.player.tg_id)
+        self.addCleanup(player_state._states.invalidate, self.player.tg_id)
+
+    def enter(self, tg_id=15001, name='player'):
+        response = self.client.get(reverse('player_info', args=[tg_id, name]))
+        self.assertEqual(response.status_code, 200)
+        return response.json()['player_info']
+
+    def test_returning_player_is_read_with_one_select(self):
+        # Горячего состояния ещё нет в Redis: оно заполняется из той же строки
+        with self.assertNumQueries(1):
+            info = self.enter()
+        self.assertEqual((info['tg_id'], info['name'], info['coins'], info['instruction']),
+                         (15001, 'player', 70, False))
+        self.assertEqual(info['config_version'], game_config.get().version)
+        with self.assertNumQueries(1):
+            self.enter()
+
+    def test_renamed_player_is_updated_once(self):
+        with self.assertNumQueries(2):
+            info = self.enter(name='renamed')
+        self.assertEqual(info['name'], 'renamed')
+        self.assertEqual(Player.objects.values_list('name', flat=True).get(id=self.player.id), 'renamed')
+        with self.assertNumQueries(1):
+            self.enter(name='renamed')
+
+    def test_instruction_is_shown_on_first_entry_only(self):
+        info = self.enter(tg_id=15002, name='new')
+        self.assertTrue(info['instruction'])
+        self.assertEqual(info['coins'], 0)
+        with self.assertNumQueries(2):
+            info = self.enter(tg_id=15002, name='new')
+        self.assertFalse(info['instruction'])
+        with self.assertNumQueries(1):
+            self.assertFalse((self.enter(tg_id=15002, name='new'))['instruction'])
+
+    def test_player_created_by_concurrent_request_is_read_back(self):
+        def register(tg_id, name, referral_id):
+            # Параллельный запрос успел создать игрока первым
+            Player.objects.create(tg_id=tg_id, name=name, coins=5, instruction=True)
+            raise IntegrityError
+
+        with mock.patch.object(Player, 'register', side_effect=register):
+            info = self.enter(tg_id=15003, name='racer')
+        self.assertEqual((info['tg_id'], info['coins'], info['instruction']), (15003, 5, False))
+        self.assertEqual(Player.objects.filter(tg_id=15003).count(), 1)
+
+
+class GameConfigLoaderTests(SimpleTestCase):
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.config_dir)
+        for file_name in CONFIG_FILES.values():
+            shutil.copy(Path(settings.GAME_CONFIG_DIR) / file_name, self.config_dir)
+        self.original = json.loads((Path(settings.GAME_CONFIG_DIR) / CONFIG_FILES['progression']).read_text())
+        settings_override = override_settings(GAME_CONFIG_DIR=self.config_dir, GAME_CONFIG_RELOAD_INTERVAL=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.loader = GameConfigLoader()
+        self.mtime = 0
+
+    def write_progression(self, content):
+        path = Path(self.config_dir) / CONFIG_FILES['progression']
+        path.write_text(content)
+        # Время изменения сдвигается явно: запись в ту же единицу времени его бы не поменяла
+        self.mtime += 1
+        os.utime(path, ns=(self.mtime * 10 ** 9, self.mtime * 10 ** 9))
+
+    def progression(self, **changes):
+        return json.dumps({**self.original, **changes})
+
+    def test_changed_file_is_reloaded(self):
+        first = self.loader.get()
+        self.assertEqual(first.version, game_config.get().version)
+        self.write_progression(self.progression(base_price=200))
+        second = self.loader.get()
+        self.assertNotEqual(second.version, first.version)
+        self.assertEqual(second.progression.prices[0], 200)
+
+    def test_unchanged_files_keep_the_same_config(self):
+        first = self.loader.get()
+        self.assertIs(self.loader.get(), first)
+
+    def test_files_are_not_checked_within_interval(self):
+        first = self.loader.get()
+        self.write_progression(self.progression(base_price=200))
+        with override_settings(GAME_CONFIG_RELOAD_INTERVAL=60):
+            self.assertIs(self.loader.get(), first)
+
+    def test_broken_file_keeps_previous_config(self):
+        first = self.loader.get()
+        self.write_progression('{"version": ')
+        with self.assertLogs('app_core.game_config', 'ERROR'):
+            self.assertIs(self.loader.get(), first)
+        # Исправленный файл подхватывается
+        self.write_progression(self.progression(base_price=200))
+        self.assertEqual(self.loader.get().progression.prices[0], 200)
+
+    def test_broken_file_on_start_is_an_error(self):
+        self.write_progression(self.progression(price_growth=None))
+        with self.assertRaises(TypeError):
+            self.loader.get()
+
+
+class GameConfigViewTests(SimpleTestCase):
+    def setUp(self):
+        self.config = game_config.get()
+
+    def test_config_is_revalidated_by_etag(self):
+        response = self.client.get(reverse('game_config'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['version'], self.config.version)
+        self.assertEqual((response['ETag'], response['Cache-Control']), (self.config.etag, 'public, max-age=60'))
+        response = self.client.get(reverse('game_config'), headers={'If-None-Match': f'"old", {self.config.etag}'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], self.config.etag)
+
+    def test_versioned_url_is_immutable(self):
+        response = self.client.get(reverse('game_config_version', args=[self.config.version]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+
+    def test_outdated_version_gets_current_config_briefly_cached(self):
+        response = self.client.get(reverse('game_config_version', args=['outdated']))
+        self.assertEqual(response.json()['version'], self.config.version)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+
+
+@override_settings(DB_POOL_MAX_WAITING=10)
+class DatabasePoolMiddlewareTests(SimpleTestCase):
+    def with_pool(self, requests_waiting):
+        pool = SimpleNamespace(get_stats=lambda: {'pool_size': 20, 'requests_waiting': requests_waiting})
+        return mock.patch('app_core.db_pool.get_pool', return_value=pool)
+
+    def test_saturated_pool_rejects_request_with_retry_after(self):
+        with self.with_pool(10), self.assertLogs('app_core.db_pool', 'WARNING'):
+            response = self.client.get(reverse('game_config'))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(response.json(), {"error": "Сервер перегружен, повторите запрос позже."})
+
+    def test_busy_pool_below_limit_lets_request_through(self):
+        with self.with_pool(9):
+            self.assertFalse(is_saturated())
+            self.assertEqual(self.client.get(reverse('game_config')).status_code, 200)
+
+    def test_without_pool_requests_pass_through(self):
+        # SQLite в тестах работает без пула
+        self.assertIsNone(pool_stats())
+        self.assertFalse(is_saturated())
+        self.assertEqual(self.client.get(reverse('game_config')).status_code, 200)
+
+    def test_pool_timeout_in_view_becomes_503(self):
+        middleware = DatabasePoolBackpressureMiddleware(lambda request: None)
+        request = RequestFactory().get('/')
+        try:
+            raise OperationalError from PoolTimeout()
+        except OperationalError as error:
+            with self.with_pool(0), self.assertLogs('app_core.db_pool', 'WARNING'):
+                response = middleware.process_exception(request, error)
+        self.assertEqual(response.status_code, 503)
+        self.assertIsNone(middleware.process_exception(request, OperationalError()))
+
+
+class DogDataTests(TestCase):
+    def setUp(self):
+        player = Player.objects.create(tg_id=16001, name='player')
+        self.dog = Dog.objects.create(player=player, name='dog', lvl=3, price=250, percent_up_price=17.5,
+                                      bonus_second=9, bonus_connection=2, dog_field=4)
+
+    def test_matches_serializer_including_field_order(self):
+        expected = DogSerializer(self.dog).data
+        data = dog_data(self.dog)
+        self.assertEqual(data, dict(expected))
+        self.assertEqual(list(data), list(expected))
+
+    def test_virtual_dog_has_serializer_fields(self):
+        virtual_dog = game_config.get().progression.virtual_dog(0, 0, player_id=self.dog.player_id)
+        self.assertEqual(list(virtual_dog), list(DogSerializer(self.dog).data))
+
+    def test_compact_dog_follows_dog_fields_order(self):
+        payload = {'action': 'patch', 'added': [dog_data(self.dog)], 'changed': [], 'virtual_dog': None}
+        compact = compact_payload(payload)
+        self.assertEqual(compact['dog_fields'], DOG_COMPACT_FIELDS)
+        self.assertEqual(compact['added'], [[getattr(self.dog, field) for field in DOG_COMPACT_FIELDS]])
+        self.assertEqual(compact['added'][0], [self.dog.id, 'dog', 3, 250, 17.5, 9, 2, 4])
+        self.assertIsNone(compact['virtual_dog'])
+        # Исходный ответ не меняется: его же получают соединения без compact
+        self.assertEqual(payload['added'], [dog_data(self.dog)])
+        self.assertNotIn('dog_fields', payload)
+
+
+class MetricsTests(RedisTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        registry.reset()
+        self.addCleanup(registry.reset)
+
+    def test_queries_and_redis_calls_are_counted(self):
+        with track('test', 'count') as metrics:
+            Player.objects.count()
+            list(Player.objects.filter(tg_id=17001))
+            settings.REDIS_INSTANCE.get('metrics:test')
+            # Конвейер - одно обращение к серверу
+            pipe = settings.REDIS_INSTANCE.pipeline()
+            pipe.set('metrics:test', 1)
+            pipe.get('metrics:test')
+            pipe.execute()
+        self.assertEqual((metrics.queries, metrics.redis_calls), (2, 2))
+        self.assertEqual(len(metrics.sql), 2)
+        self.assertIn('app_core_player', metrics.sql[0][1])
+        # Вне действия ничего не считается
+        Player.objects.count()
+        self.assertEqual(metrics.queries, 2)
+
+    async def test_counters_follow_action_into_threads_and_tasks(self):
+        async def in_task():
+            await settings.REDIS_ASYNC_INSTANCE.get('metrics:test')
+
+        with track('test', 'async') as metrics:
+            await sync_to_async(Player.objects.count)()
+            await Player.objects.filter(tg_id=17001).afirst()
+            await asyncio.gather(in_task(), in_task())
+        self.assertEqual((metrics.queries, metrics.redis_calls), (2, 2))
+
+    def test_error_marks_action_and_is_recorded(self):
+        with self.assertRaises(KeyError):
+            with track('test', 'broken'):
+                raise KeyError
+        self.assertIn('dogs_actions_total{transport="test",action="broken",status="error"} 1', registry.render())
+
+    def test_prometheus_text_format(self):
+        metrics = ActionMetrics('ws', 'say "hi"')
+        metrics.queries, metrics.redis_calls = 3, 4
+        registry.record(metrics, 0.02)
+        with self.assertLogs('app_core.metrics', 'WARNING'):
+            registry.record(ActionMetrics('ws', 'say "hi"'), 20)
+        lines = registry.render().splitlines()
+        labels = 'transport="ws",action="say \\"hi\\""'
+        for line in (
+                '# TYPE dogs_action_duration_seconds histogram',
+                f'dogs_action_duration_seconds_bucket{{{labels},le="0.01"}} 0',
+                f'dogs_action_duration_seconds_bucket{{{labels},le="0.025"}} 1',
+                f'dogs_action_duration_seconds_bucket{{{labels},le="10"}} 1',
+                f'dogs_action_duration_seconds_bucket{{{labels},le="+Inf"}} 2',
+                f'dogs_action_duration_seconds_count{{{labels}}} 2',
+                f'dogs_action_db_queries_bucket{{{labels},le="3"}} 2',
+                f'dogs_action_redis_calls_total{{{labels}}} 4',
+                f'dogs_slow_actions_total{{{labels}}} 1',
+                f'dogs_actions_total{{{labels},status="ok"}} 2'):
+            self.assertIn(line, lines)
+
+    @override_settings(METRICS_SLOW_ACTION_QUERIES=2)
+    def test_slow_action_is_logged_with_its_queries(self):
+        with self.assertLogs('app_core.metrics', 'WARNING') as logs:
+            with track('test', 'slow'):
+                Player.objects.count()
+                Player.objects.exists()
+        self.assertIn('Медленное действие test slow', logs.output[0])
+        self.assertIn('app_core_player', logs.output[0])
+
+    def test_middleware_records_route_template_and_status(self):
+        self.client.get(reverse('game_config_version', args=['v1']))
+        self.client.get(reverse('game_config_version', args=['v2']))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response['Content-Type'], CONTENT_TYPE)
+        # tg_id и другие параметры пути не создают отдельных серий
+        self.assertIn('dogs_actions_total{transport="http",action="GET /api/game-config/<str:version>/",'
+                      'status="200"} 2', response.content.decode())
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_need_token_when_configured(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        response = self.client.get(reverse('metrics'), headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+
+
+class ProfilingTests(RedisTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+        settings_override = override_settings(PROFILING_DIR=self.profile_dir, PROFILING_TOKEN='token',
+                                              PROFILING_REFRESH_INTERVAL=0, PROFILING_SAMPLE_INTERVAL=0.001)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(self.reset_control)
+        self.player = Player.objects.create(tg_id=18001, name='player', coins_in_second=0)
+
+    @staticmethod
+    def reset_control():
+        profiling.sampler.stop()
+        if profiling.sampler._thread is not None:
+            profiling.sampler._thread.join(5)
+        profiling._players, profiling._refresh_at = frozenset(), 0.0
+
+    def players(self):
+        return async_to_sync(profiling.aplayers)()
+
+    def reports(self):
+        return sorted(os.listdir(self.profile_dir))
+
+    def test_player_is_enabled_until_disabled_or_expired(self):
+        profiling.enable_player(18001)
+        profiling.enable_player(18002, seconds=-1)
+        self.assertEqual(self.players(), {18001})
+        profiling.disable_player(18001)
+        self.assertEqual(self.players(), set())
+
+    def test_redis_failure_keeps_previous_players(self):
+        profiling.enable_player(18001)
+        self.players()
+        with mock.patch.object(settings.REDIS_ASYNC_INSTANCE, 'pipeline', side_effect=ConnectionError), \
+                self.assertLogs('app_core.profiling', 'ERROR'):
+            self.assertEqual(self.players(), {18001})
+
+    def test_tg_id_is_taken_from_path_or_json_body(self):
+        factory = RequestFactory()
+        self.assertEqual(request_tg_id(factory.get(reverse('leaderboard_around', args=['coins', 18001]))), 18001)
+        body = factory.post(reverse('collecting_bonuses'), {'tg_id': '18001'}, content_type='application/json')
+        self.assertEqual(request_tg_id(body), 18001)
+        for request in (
+                factory.post(reverse('collecting_bonuses'), '{"tg_id":', content_type='application/json'),
+                factory.post(reverse('collecting_bonuses'), '[18001]', content_type='application/json'),
+                factory.post(reverse('collecting_bonuses'), {'tg_id': 18001}),
+                factory.get('/not-found/')):
+            self.assertIsNone(request_tg_id(request))
+
+    def test_request_with_token_header_is_profiled(self):
+        response = self.client.get(reverse('game_config'), headers={'X-Profile': 'token'})
+        self.assertEqual(self.reports(), [response['X-Profile-File']])
+        response = self.client.get(reverse('game_config'), headers={'X-Profile': 'wrong'})
+        self.assertNotIn('X-Profile-File', response)
+        self.assertEqual(len(self.reports()), 1)
+
+    def test_requests_of_enabled_player_are_profiled(self):
+        profiling.enable_player(18001)
+        bonus = reverse('collecting_bonuses')
+        self.client.post(bonus, {'tg_id': 18001, 'second': True}, content_type='application/json')
+        self.assertEqual(len(self.reports()), 1)
+        # Запрос другого игрока не профилируется
+        self.client.post(bonus, {'tg_id': 18002, 'second': True}, content_type='application/json')
+        self.assertEqual(len(self.reports()), 1)
+
+    def test_sampler_runs_while_enabled_and_writes_folded_stacks(self):
+        call_command('profile_workers', seconds=60, stdout=StringIO())
+        self.players()
+        self.assertTrue(profiling.sampler.running)
+        time.sleep(0.05)
+        call_command('profile_workers', stop=True, stdout=StringIO())
+        self.players()
+        profiling.sampler._thread.join(5)
+        self.assertFalse(profiling.sampler.running)
+        (report,) = self.reports()
+        self.assertTrue(report.startswith(f'stacks-{os.getpid()}-'))
+        stacks = (Path(self.profile_dir) / report).read_text().splitlines()
+        self.assertTrue(stacks)
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in stacks))
+
+    def test_fold_goes_from_thread_to_current_frame(self):
+        stack = StackSampler.fold('Main Thread', sys._getframe())
+        self.assertTrue(stack.startswith('Main_Thread;'))
+        self.assertTrue(stack.endswith('app_core.tests:ProfilingTests.test_fold_goes_from_thread_to_current_frame'))
+
+
+class LeaderboardViewTests(RedisTestMixin, TestCase):
+    def get(self, url, **params):
+        response = self.client.get(url, params)
+        return response.status_code, response.json()
+
+    def test_invalid_numbers_get_fixed_message(self):
+        self.assertEqual(self.get(reverse('leaderboard_top', args=['coins']), limit='abc'),
+                         (400, {"error": "Параметр limit должен быть целым числом."}))
+        self.assertEqual(self.get(reverse('leaderboard_around', args=['coins', 19001]), neighbours='abc'),
+                         (400, {"error": "Параметр neighbours должен быть целым числом."}))
+
+    def test_unknown_board_is_rejected(self):
+        status_code, data = self.get(reverse('leaderboard_top', args=['gems']))
+        self.assertEqual(status_code, 400)
+        self.assertTrue(data['error'].startswith("Неизвестный рейтинг."))
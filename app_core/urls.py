@@ -5,7 +5,12 @@ urlpatterns = [
     path('player-info/<int:tg_id>/<str:name>/<int:referral_id>/', PlayerInfo.as_view(), name='player_info_referral'),
     path('player-info/<int:tg_id>/<str:name>/', PlayerInfo.as_view(), name='player_info'),
     path('daily-bonus/', LoginTodayFlag.as_view(), name='daily_bonus'),
+    path('game-config/', GameConfigView.as_view(), name='game_config'),
+    path('game-config/<str:version>/', GameConfigView.as_view(), name='game_config_version'),
     path('collecting-bonuses/', GetBonus.as_view(), name='collecting_bonuses'),
     path('dogs-player/<int:tg_id>/', DogsPlayer.as_view(), name='collecting_bonuses'),
+    path('leaderboard/<str:board>/', LeaderboardTop.as_view(), name='leaderboard_top'),
+    path('leaderboard/<str:board>/<int:tg_id>/', LeaderboardAround.as_view(), name='leaderboard_around'),
+    path('metrics/', prometheus_metrics, name='metrics'),
 
 ]
@@ -1,10 +1,22 @@
+import hmac
+from asgiref.sync import sync_to_async
 from adrf.generics import GenericAPIView
 from adrf.views import APIView
+from django.conf import settings
+from django.db import IntegrityError
+from django.http import HttpResponse
+from django.utils import timezone
 from drf_spectacular.utils import OpenApiResponse, inline_serializer, extend_schema_view, extend_schema, OpenApiExample, \
     OpenApiParameter
 from rest_framework import status, serializers
 from rest_framework.response import Response
+from app_core.leaderboard import leaderboard
+from app_core.game_config import game_config
+from app_core.metrics import CONTENT_TYPE, registry
 from app_core.models import Player, ReferralSystem, Dog
+from app_core.notifications import player_payload, push_player_update
+from app_core.player_state import STATE_FIELDS, player_state
+from app_core.rate_limit import PlayerActionThrottle
 from app_core.serializers import *
 
 
@@ -27,6 +39,28 @@ from app_core.serializers import *
 #     tasks = [task async for task in Task.objects.all()]
 #     await PlayerTask.objects.abulk_create([PlayerTask(player=player, task=task) for task in tasks])
 
+# Поля строки игрока, которые нужны при входе: горячее состояние и то, что живёт только в БД
+BOOTSTRAP_FIELDS = ('id', 'tg_id', 'name', 'lvl', 'consecutive_days', 'last_login_date', 'daily_bonus_friends',
+                    'friends_count', 'instruction', *STATE_FIELDS)
+
+
+def bootstrap_payload(row, state):
+    """Компактные данные игрока при входе. Таблица бонусов и прогрессия отдаются отдельно по config_version."""
+    return {
+        'tg_id': row['tg_id'],
+        'name': row['name'],
+        'lvl': row['lvl'],
+        'consecutive_days': row['consecutive_days'],
+        'daily_bonus': row['last_login_date'] != timezone.localdate(),
+        'daily_bonus_friends': row['daily_bonus_friends'],
+        'friends_count': row['friends_count'],
+        'instruction': row['instruction'],
+        **player_payload(state),
+        'version': state.version,
+        'config_version': game_config.get().version,
+    }
+
+
 class PlayerInfo(GenericAPIView):
     """
     Представление для входа/создания пользователя.
@@ -36,44 +70,43 @@ class PlayerInfo(GenericAPIView):
     - `name`: Имя пользователя.
     - `referral_id`: Id-друга который пригласил. (Не обязательный аргумент)
     Возвращает:
-    - Информацию о пользователе.
+    - Информацию о пользователе. Существующий игрок читается одним запросом.
     """
     serializer_class = PlayerSerializer
 
     async def get(self, request, tg_id: int, name: str, referral_id: int = None):
-        # Пытаемся получить игрока или создаем нового
-        player, created = await Player.objects.aget_or_create(tg_id=tg_id, name=name)
-        # Если игрок только что создан проверяем реферальную систему
+        # Игрок ищется только по tg_id: смена имени в Telegram не должна создавать нового игрока
+        row = await Player.objects.filter(tg_id=tg_id).values(*BOOTSTRAP_FIELDS).afirst()
+        created = row is None
         if created:
             try:
                 # ТУТ ПРИСВОИМ ВСЕ СУЩЕСТВУЮЩИЕ ЗАДАЧИ ДЛЯ ИГРОКОВ
                 # await self.create_tasks_new_player(player)  # Присваиваем все задачи игроку
-                player.start_offline_coins = timezone.now()
-                player.finish_offline_coins = timezone.now() + timedelta(hours=3)
-                player.finish_second_coins = timezone.now()
-                await player.asave()
-                # Создаем виртуальную собаку для игрока
-                await Dog.get_or_create_virtual_dog(player)
+                player = await sync_to_async(Player.register)(tg_id, name, referral_id)
+            except IntegrityError:
+                # Игрока одновременно создал параллельный запрос
+                row = await Player.objects.filter(tg_id=tg_id).values(*BOOTSTRAP_FIELDS).aget()
+                created = False
             except Exception as e:
                 return Response({"Error": f"Ошибка при присвоении задач: {str(e)}"},
                                 status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-            if referral_id and referral_id != tg_id:
-                referral = await Player.objects.aget(tg_id=referral_id)
-                # Проверяем, что реферальная связь ещё не существует
-                exists = await ReferralSystem.objects.filter(referral=referral, new_player=player).aexists()
-                if not exists:
-                    await ReferralSystem.objects.acreate(referral=referral, new_player=player)
-                else:
-                    return Response({"Error": "Игрок уже в друзьях у реферала."}, status=status.HTTP_400_BAD_REQUEST)
-            elif referral_id == tg_id:
-                return Response({"Error": "Нельзя добавить самого себя в друзья!"}, status=status.HTTP_400_BAD_REQUEST)
-        else:
-            if player.instruction:
-                player.instruction = False
-                await player.asave(update_fields=['instruction'])
-        serializer = self.get_serializer(player)
-        response_data = {"player_info": serializer.data, "bonus_info": DAILY_BONUSES}
-        return Response(response_data, status=status.HTTP_200_OK)
+            else:
+                row = {field: getattr(player, field) for field in BOOTSTRAP_FIELDS}
+                if referral_id == tg_id:
+                    return Response({"Error": "Нельзя добавить самого себя в друзья!"},
+                                    status=status.HTTP_400_BAD_REQUEST)
+        if not created:
+            # Инструкция показывается только при первом входе; запись происходит один раз за жизнь игрока
+            if row['instruction']:
+                await Player.objects.filter(id=row['id'], instruction=True).aupdate(instruction=False)
+                row['instruction'] = False
+            if row['name'] != name:
+                await Player.objects.filter(id=row['id']).aupdate(name=name)
+                row['name'] = name
+        # Монеты и таймеры бонусов берём из горячего состояния, при промахе Redis оно заполняется из уже
+        # прочитанной строки без второго запроса
+        state = await player_state.aget(tg_id, row=row)
+        return Response({"player_info": bootstrap_payload(row, state)}, status=status.HTTP_200_OK)
 
     # # Обновляем ежедневный статус и возвращаем данные игрока
     # response_data = await self.update_player_status(player)
@@ -110,19 +143,43 @@ class PlayerInfo(GenericAPIView):
 )
 class LoginTodayFlag(APIView):
     """Представление для получения ежедневного бонуса"""
+    throttle_classes = [PlayerActionThrottle]
+
     async def post(self, request):
         tg_id = request.data.get('tg_id')
         try:
-            player = await Player.objects.aget(tg_id=tg_id)
-        except Player.DoesNotExist:
+            player = await Player.objects.only('id', 'tg_id', 'consecutive_days', 'last_login_date').aget(tg_id=tg_id)
+        except (Player.DoesNotExist, ValueError):
             return Response({"error": "Игрок с указанным tg_id не найден."}, status=status.HTTP_404_NOT_FOUND)
-        # Обновляем ежедневный статус
+        # Обновляем ежедневный статус, после этого daily_bonus вернёт False до следующего дня
         await player.update_daily_status()
-        player.daily_bonus = False  # Обновляем флаг, что пользователь не надо показывать ежедневный бонус
-        await player.asave(update_fields=['daily_bonus'])
         return Response({"message": "Флаг 'daily_bonus' успешно установлен"}, status=status.HTTP_200_OK)
 
 
+def config_response(request, config, cache_control):
+    """Ответ с конфигурацией или 304, если у клиента уже есть эта версия."""
+    if config.etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response(config.payload, status=status.HTTP_200_OK)
+    response['ETag'] = config.etag
+    response['Cache-Control'] = cache_control
+    return response
+
+
+class GameConfigView(APIView):
+    """
+    Игровая конфигурация: таблица ежедневных бонусов и параметры прогрессии собак. Клиент сверяет config_version
+    из данных игрока со своей копией и запрашивает конфигурацию только при расхождении. Без версии в адресе ответ
+    кэшируется ненадолго и проверяется по ETag, адрес с текущей версией кэшируется навсегда.
+    """
+    async def get(self, request, version: str = None):
+        config = game_config.get()
+        if version == config.version:
+            return config_response(request, config, 'public, max-age=31536000, immutable')
+        return config_response(request, config, 'public, max-age=60')
+
+
 @extend_schema_view(
     post=extend_schema(
         tags=["Игрок: бонусы"],
@@ -157,39 +214,40 @@ class LoginTodayFlag(APIView):
 )
 class GetBonus(APIView):
     """Представление для получения офлайн бонуса 1 раз в 3 часа и ежесекундного бонуса"""
+    throttle_classes = [PlayerActionThrottle]
+
     async def post(self, request):
         tg_id = request.data.get('tg_id')
         hour = request.data.get('hour', False)  # Флаг для офлайн бонуса
         second = request.data.get('second', False)  # Флаг для ежесекундного бонуса
         try:
-            player = await Player.objects.aget(tg_id=tg_id)
+            player = await player_state.aget(tg_id)
         except Player.DoesNotExist:
             return Response({"error": "Игрок с указанным tg_id не найден."}, status=status.HTTP_404_NOT_FOUND)
         if not hour and not second:
             return Response({"error": "Не указаны hour или second."}, status=status.HTTP_400_BAD_REQUEST)
         if hour:
-            if player.finish_offline_coins and timezone.now() >= player.finish_offline_coins:
-                player.coins += player.offline_coins
-                player.start_offline_coins = timezone.now()
-                player.finish_offline_coins = timezone.now() + timedelta(hours=3)
-                await player.asave(update_fields=['coins', 'start_offline_coins', 'finish_offline_coins'])
-            else:
+            now = timezone.now()
+            # Бонус копится лениво по доходу в секунду за окно. Проверка окна, досчёт бонуса и начисление
+            # выполняются одним скриптом в Redis, поэтому бонус не начислится дважды
+            player = await player_state.aapply(
+                tg_id,
+                values={'start_offline_coins': now,
+                        'finish_offline_coins': now + game_config.get().progression.offline_window},
+                when={'finish_offline_coins': ('le', now)},
+                claim_offline=True,
+                bump=True,
+            )
+            if player is None:
                 return Response({"error": "Офлайн бонус еще недоступен."}, status=status.HTTP_400_BAD_REQUEST)
-        if second:
-            # Вычисляем количество секунд с момента последнего получения бонуса
-            current_time = timezone.now()
-            if player.finish_second_coins:
-                time_difference = current_time - player.finish_second_coins
-                seconds_passed = time_difference.total_seconds()
-                # Умножаем количество секунд на заработок монет в секунду
-                earned_coins = int(seconds_passed) * player.coins_in_second
-                player.coins += earned_coins
-            # Обновляем время последнего сбора бонуса
-            player.finish_second_coins = current_time
-            await player.asave(update_fields=['coins', 'finish_second_coins'])
+            await push_player_update(player, 'bonus')
+        if second and player.finish_second_coins is None:
+            # Запускаем отсчёт ежесекундного дохода. Дальше доход начисляется лениво: баланс вычисляется по формуле
+            # при чтении и фиксируется только при смене дохода в секунду или покупке, поэтому опрос ничего не пишет
+            player = await player_state.aapply(tg_id, settle=True)
         response_data = {
             'tg_id': player.tg_id,
-            'player_coins': player.coins,
+            'player_coins': player.balance(),
             'message': '',
         }
         if hour and second:
@@ -208,7 +266,9 @@ class GetBonus(APIView):
         summary="Получить список собак игрока",
         description="Возвращает список всех активных собак игрока, включая виртуальную собаку.",
         parameters=[
-            OpenApiParameter(name="tg_id", type=int, description="Уникальный идентификатор пользователя в Telegram")
+            OpenApiParameter(name="tg_id", type=int, description="Уникальный идентификатор пользователя в Telegram"),
+            OpenApiParameter(name="compact", type=bool, required=False,
+                             description="Собаки массивами значений в порядке поля dog_fields ответа")
         ],
         responses={
             200: OpenApiResponse(
@@ -234,10 +294,17 @@ class GetBonus(APIView):
     post=extend_schema(
         tags=["Собаки: создание"],
         summary="Создать новую собаку",
-        description="Создает новую собаку для игрока и возвращает информацию о ней.",
+        description="Создает новую собаку для игрока и возвращает информацию о ней. С count покупает до count собак "
+                    "подряд одной транзакцией: столько, сколько помещается на поле и хватает монет.",
         parameters=[
             OpenApiParameter(name="tg_id", type=int, description="Уникальный идентификатор пользователя в Telegram")
         ],
+        request=inline_serializer(
+            name="CreateDogRequest",
+            fields={
+                "count": serializers.IntegerField(help_text="Сколько собак купить (от 1 до 12)", required=False)
+            }
+        ),
         responses={
             201: OpenApiResponse(
                 response=DogSerializer,
@@ -247,6 +314,7 @@ class GetBonus(APIView):
                         "Пример ответа",
                         value={
                             "dog": {"id": 1, "name": "Собака 1", "lvl": 1, "price": 100, "bonus_second": 3},
+                            "dogs": [{"id": 1, "name": "Собака 1", "lvl": 1, "price": 100, "bonus_second": 3}],
                             "virtual_dog": {"id": 2, "name": "Виртуальная собака", "lvl": 1, "price": 0, "bonus_second": 0}
                         }
                     )
@@ -306,26 +374,22 @@ class GetBonus(APIView):
 class DogsPlayer(GenericAPIView):
     """
     Эндпоинт для работы с собаками игрока.
-    Поддерживает создание, скрещивание и получение списка собак.
+    Поддерживает создание, скрещивание и получение списка собак. Изменения ограничены по частоте для каждого игрока.
     """
     serializer_class = DogSerializer
+    throttle_classes = [PlayerActionThrottle]
 
     async def get(self, request, tg_id: int):
         """Получение списка собак игрока."""
         try:
-            player = await Player.objects.aget(tg_id=tg_id)
-            dogs = player.dogs.filter(is_active=True)
-            # Преобразуем QuerySet в список асинхронно
-            dogs = [dog async for dog in dogs.aiterator()]
-            serializer = DogSerializer(dogs, many=True)
-            # Получаем информацию о виртуальной собаке
-            virtual_dog = await Dog.get_or_create_virtual_dog(player)
-            virtual_dog_serializer = DogSerializer(virtual_dog)
-
-            return Response({
-                'dogs': serializer.data,
-                'virtual_dog': virtual_dog_serializer.data
-            }, status=status.HTTP_200_OK)
+            player = await player_state.aget(tg_id)
+            # Поле игрока (активные собаки и виртуальная собака) кэшируется в Redis до следующего изменения
+            board = await player_state.aget_board(player)
+            # Версия нужна клиенту, чтобы применять поверх снимка патчи из WebSocket
+            data = {**board, 'version': player.version}
+            if request.query_params.get('compact') in ('1', 'true'):
+                data = compact_payload(data)
+            return Response(data, status=status.HTTP_200_OK)
         except Player.DoesNotExist:
             return Response({"error": "Игрок не найден."}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
@@ -334,17 +398,13 @@ class DogsPlayer(GenericAPIView):
     async def post(self, request, tg_id: int):
         """Создание новой собаки для игрока."""
         try:
-            player = await Player.objects.aget(tg_id=tg_id)
-            dog = await Dog.create_dog(player)
-            serializer = DogSerializer(dog)
-
-            # Получаем информацию о виртуальной собаке после создания
-            virtual_dog = await Dog.get_or_create_virtual_dog(player)
-            virtual_dog_serializer = DogSerializer(virtual_dog)
-
+            player = await player_state.aget(tg_id)
+            # Виртуальная собака для следующей покупки считается по таблицам прогрессии без запроса к БД
+            dogs, virtual_dog = await Dog.create_dogs(player, request.data.get('count', 1))
             return Response({
-                'dog': serializer.data,
-                'virtual_dog': virtual_dog_serializer.data
+                'dog': dog_data(dogs[0]),
+                'dogs': dogs_data(dogs),
+                'virtual_dog': virtual_dog
             }, status=status.HTTP_201_CREATED)
         except Player.DoesNotExist:
             return Response({"error": "Игрок не найден."}, status=status.HTTP_404_NOT_FOUND)
@@ -358,20 +418,14 @@ class DogsPlayer(GenericAPIView):
         Скрещивание собак.
         """
         try:
-            player = await Player.objects.aget(tg_id=tg_id)
+            player = await player_state.aget(tg_id)
             dog_pairs = request.data.get('dog_pairs', [])
             if not dog_pairs:
                 return Response({"error": "Необходимо передать список пар собак."}, status=status.HTTP_400_BAD_REQUEST)
-            upgraded_dogs = await Dog.breed_dogs(player, dog_pairs)
-            serializer = DogSerializer(upgraded_dogs, many=True)
-
-            # Получаем информацию о виртуальной собаке после скрещивания
-            virtual_dog = await Dog.get_or_create_virtual_dog(player)
-            virtual_dog_serializer = DogSerializer(virtual_dog)
-
+            upgraded_dogs, virtual_dog = await Dog.breed_dogs(player, dog_pairs)
             return Response({
-                'upgraded_dogs': serializer.data,
-                'virtual_dog': virtual_dog_serializer.data
+                'upgraded_dogs': dogs_data(upgraded_dogs),
+                'virtual_dog': virtual_dog
             }, status=status.HTTP_200_OK)
         except Player.DoesNotExist:
             return Response({"error": "Игрок не найден."}, status=status.HTTP_404_NOT_FOUND)
@@ -379,3 +433,101 @@ class DogsPlayer(GenericAPIView):
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@extend_schema_view(
+    get=extend_schema(
+        tags=["Рейтинг"],
+        summary="Топ игроков",
+        description="Возвращает первых игроков рейтинга: coins, lvl или coins_in_second.",
+        parameters=[
+            OpenApiParameter(name="board", type=str, description="Рейтинг: coins, lvl или coins_in_second"),
+            OpenApiParameter(name="limit", type=int, description="Количество игроков (до 100)", required=False)
+        ],
+        responses={
+            200: OpenApiResponse(
+                description="Топ игроков",
+                examples=[
+                    OpenApiExample(
+                        "Пример ответа",
+                        value={"board": "coins", "top": [{"rank": 1, "tg_id": 1, "name": "Игрок", "score": 1000}]}
+                    )
+                ]
+            ),
+            400: {"description": "Неизвестный рейтинг"}
+        }
+    )
+)
+class LeaderboardTop(APIView):
+    """Топ игроков из рейтинга в Redis."""
+    async def get(self, request, board: str):
+        try:
+            limit = int(request.query_params.get('limit', 100))
+        except ValueError:
+            return Response({"error": "Параметр limit должен быть целым числом."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            top = await leaderboard.atop(board, limit)
+            return Response({'board': board, 'top': top}, status=status.HTTP_200_OK)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@extend_schema_view(
+    get=extend_schema(
+        tags=["Рейтинг"],
+        summary="Место игрока в рейтинге",
+        description="Возвращает место игрока и соседей выше и ниже него.",
+        parameters=[
+            OpenApiParameter(name="board", type=str, description="Рейтинг: coins, lvl или coins_in_second"),
+            OpenApiParameter(name="tg_id", type=int, description="Уникальный идентификатор пользователя в Telegram"),
+            OpenApiParameter(name="neighbours", type=int, description="Соседей с каждой стороны (до 50)",
+                             required=False)
+        ],
+        responses={
+            200: OpenApiResponse(
+                description="Место игрока и соседи",
+                examples=[
+                    OpenApiExample(
+                        "Пример ответа",
+                        value={"board": "coins", "rank": 2, "entries": [
+                            {"rank": 1, "tg_id": 1, "name": "Игрок", "score": 1000},
+                            {"rank": 2, "tg_id": 2, "name": "Игрок 2", "score": 900}
+                        ]}
+                    )
+                ]
+            ),
+            400: {"description": "Неизвестный рейтинг"},
+            404: {"description": "Игрока нет в рейтинге"}
+        }
+    )
+)
+class LeaderboardAround(APIView):
+    """Место игрока в рейтинге в Redis и его соседи."""
+    async def get(self, request, board: str, tg_id: int):
+        try:
+            neighbours = int(request.query_params.get('neighbours', 5))
+        except ValueError:
+            return Response({"error": "Параметр neighbours должен быть целым числом."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            around = await leaderboard.aaround(board, tg_id, neighbours)
+            if around is None:
+                return Response({"error": "Игрок не найден в рейтинге."}, status=status.HTTP_404_NOT_FOUND)
+            return Response({'board': board, **around}, status=status.HTTP_200_OK)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+async def prometheus_metrics(request):
+    """
+    Метрики процесса в текстовом формате Prometheus: задержки, запросы к БД и Redis и время сериализации по
+    эндпоинтам и действиям WebSocket. Если задан METRICS_TOKEN, нужен заголовок Authorization: Bearer <токен>.
+    """
+    if settings.METRICS_TOKEN and not hmac.compare_digest(
+            request.headers.get('Authorization', '').encode(), f'Bearer {settings.METRICS_TOKEN}'.encode()):
+        return HttpResponse(status=status.HTTP_403_FORBIDDEN)
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)
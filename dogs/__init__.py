@@ -0,0 +1,4 @@
+# Приложение Celery загружается вместе с Django, чтобы shared_task из веб-процесса шли в брокер из настроек
+from .celery import app as celery_app
+
+__all__ = ('celery_app',)
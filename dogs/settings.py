@@ -10,9 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 import os
+from datetime import timedelta
 from pathlib import Path
 from celery.schedules import crontab
 import redis
+import redis.asyncio
 from dotenv import load_dotenv
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -58,7 +60,10 @@ INSTALLED_APPS = [
 ASGI_APPLICATION = 'dogs.asgi.application'
 
 MIDDLEWARE = [
+    'app_core.metrics.MetricsMiddleware',
+    'app_core.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'app_core.db_pool.DatabasePoolBackpressureMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -91,6 +96,14 @@ WSGI_APPLICATION = 'dogs.wsgi.application'
 
 load_dotenv()
 
+# Пул соединений psycopg3 на процесс: суммарный max_size всех процессов не должен превышать max_connections Postgres.
+# Запрос ждёт соединение не дольше DB_POOL_TIMEOUT секунд, а при DB_POOL_MAX_WAITING ожидающих получает 503
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 20))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 5))
+DB_POOL_MAX_WAITING = int(os.getenv("DB_POOL_MAX_WAITING", 100))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", 300))
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.postgresql",
@@ -99,6 +112,15 @@ DATABASES = {
         "PASSWORD": os.getenv("POSTGRES_PASSWORD"),
         "HOST": os.getenv("POSTGRES_HOST"),
         "PORT": os.getenv("POSTGRES_PORT"),
+        "OPTIONS": {
+            "pool": {
+                "min_size": DB_POOL_MIN_SIZE,
+                "max_size": DB_POOL_MAX_SIZE,
+                "timeout": DB_POOL_TIMEOUT,
+                "max_waiting": DB_POOL_MAX_WAITING,
+                "max_idle": DB_POOL_MAX_IDLE,
+            },
+        },
     }
 }
 
@@ -152,8 +174,63 @@ CACHES = {
         }
     }
 }
-# Создаем асинхронный экземпляр Redis
-redis_instance = redis.StrictRedis(host=os.getenv("REDIS_HOST", "localhost"), port = os.getenv("REDIS_PORT", 6379), db=0)
+# Создаем синхронный и асинхронный экземпляры Redis. Код берёт их из django.conf.settings, поэтому модуль
+# настроек (например, dogs.test_settings) может подменить их
+REDIS_INSTANCE = redis.StrictRedis(host=os.getenv("REDIS_HOST", "localhost"), port = os.getenv("REDIS_PORT", 6379), db=0)
+REDIS_ASYNC_INSTANCE = redis.asyncio.StrictRedis(host=os.getenv("REDIS_HOST", "localhost"),
+                                                 port=os.getenv("REDIS_PORT", 6379), db=0)
+
+# Горячее состояние игроков в Redis: время жизни ключа и период сброса изменений в Postgres (в секундах)
+PLAYER_STATE_TTL = int(os.getenv("PLAYER_STATE_TTL", 60 * 60 * 24))
+PLAYER_STATE_FLUSH_INTERVAL = int(os.getenv("PLAYER_STATE_FLUSH_INTERVAL", 5))
+PLAYER_STATE_FLUSH_BATCH = int(os.getenv("PLAYER_STATE_FLUSH_BATCH", 1000))
+# Короткий кэш состояния и поля игрока в памяти процесса (с) и его предельный размер в записях
+PLAYER_LOCAL_CACHE_TTL = float(os.getenv("PLAYER_LOCAL_CACHE_TTL", 1))
+PLAYER_LOCAL_CACHE_SIZE = int(os.getenv("PLAYER_LOCAL_CACHE_SIZE", 10000))
+# Каталог JSON-файлов игровой конфигурации и период проверки их изменений (с)
+GAME_CONFIG_DIR = os.getenv("GAME_CONFIG_DIR", BASE_DIR / 'app_core')
+GAME_CONFIG_RELOAD_INTERVAL = int(os.getenv("GAME_CONFIG_RELOAD_INTERVAL", 5))
+# Период пересборки рейтингов из БД (с), подтягивает баланс игроков, которые копят монеты без действий
+LEADERBOARD_REBUILD_INTERVAL = int(os.getenv("LEADERBOARD_REBUILD_INTERVAL", 60 * 60))
+# Процент заработка приглашённых игроков, который получает реферал, и период начисления (с)
+REFERRAL_REWARD_PERCENT = int(os.getenv("REFERRAL_REWARD_PERCENT", 10))
+REFERRAL_REWARD_INTERVAL = int(os.getenv("REFERRAL_REWARD_INTERVAL", 60 * 60))
+# Частота действий игрока: пополнение корзины токенов в секунду и её ёмкость (столько действий можно сделать
+# подряд). Ёмкость же ограничивает число действий в одной пачке WebSocket
+PLAYER_RATE_LIMIT_RATE = float(os.getenv("PLAYER_RATE_LIMIT_RATE", 10))
+PLAYER_RATE_LIMIT_BURST = int(os.getenv("PLAYER_RATE_LIMIT_BURST", 20))
+# Метрики производительности запросов и действий WebSocket (/api/metrics/). Действие попадает в лог медленных,
+# если длится дольше METRICS_SLOW_ACTION_SECONDS (с) или делает не меньше METRICS_SLOW_ACTION_QUERIES запросов
+# к БД; в лог пишутся первые METRICS_SLOW_QUERY_LIMIT запросов. Если задан METRICS_TOKEN, метрики отдаются только
+# с заголовком Authorization: Bearer <токен>
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_SLOW_ACTION_SECONDS = float(os.getenv("METRICS_SLOW_ACTION_SECONDS", 0.5))
+METRICS_SLOW_ACTION_QUERIES = int(os.getenv("METRICS_SLOW_ACTION_QUERIES", 20))
+METRICS_SLOW_QUERY_LIMIT = int(os.getenv("METRICS_SLOW_QUERY_LIMIT", 50))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# Профилирование по запросу: каталог отчётов, токен заголовка X-Profile (пусто - заголовок не действует),
+# интервал выборки профиля запроса и семплера стеков (с), срок профилирования игрока, включённого в админке (с),
+# и период сверки включённых игроков и семплера с Redis (с)
+PROFILING_DIR = os.getenv("PROFILING_DIR", BASE_DIR / 'profiles')
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+PROFILING_INTERVAL = float(os.getenv("PROFILING_INTERVAL", 0.001))
+PROFILING_SAMPLE_INTERVAL = float(os.getenv("PROFILING_SAMPLE_INTERVAL", 0.01))
+PROFILING_PLAYER_SECONDS = int(os.getenv("PROFILING_PLAYER_SECONDS", 60 * 60))
+PROFILING_REFRESH_INTERVAL = float(os.getenv("PROFILING_REFRESH_INTERVAL", 5))
+# Админка больших таблиц: до скольких строк считается список с фильтром или поиском и по сколько id
+# массовые действия передаются в одну задачу Celery
+ADMIN_COUNT_LIMIT = int(os.getenv("ADMIN_COUNT_LIMIT", 1000))
+ADMIN_TASK_CHUNK_SIZE = int(os.getenv("ADMIN_TASK_CHUNK_SIZE", 1000))
+
+# Channel layer для рассылки изменений состояния игрока во все его WebSocket-соединения
+CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "CONFIG": {
+            "hosts": [(os.getenv("REDIS_HOST", "localhost"), int(os.getenv("REDIS_PORT", 6379)))],
+        },
+    },
+}
 
 CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
 CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", "redis://localhost:6379/0")
@@ -165,9 +242,17 @@ CELERY_RESULT_SERIALIZER = "json"
 CELERY_TASK_SERIALIZER = "json"
 CELERY_TIMEZONE = "Europe/Moscow"
 CELERY_BEAT_SCHEDULE = {
-    "reset_login_today": {
-        "task": "app_core.tasks.reset_login_today",
-        "schedule": crontab(0, 0),  # Каждый день в 00:00 сбрасываем поле login_today у всех игроков
+    "flush_player_state": {
+        "task": "app_core.tasks.flush_player_state",
+        "schedule": timedelta(seconds=PLAYER_STATE_FLUSH_INTERVAL),  # Сбрасываем изменённых игроков из Redis в БД
+    },
+    "rebuild_leaderboard": {
+        "task": "app_core.tasks.rebuild_leaderboard",
+        "schedule": timedelta(seconds=LEADERBOARD_REBUILD_INTERVAL),  # Пересобираем рейтинги из БД
+    },
+    "credit_referral_rewards": {
+        "task": "app_core.tasks.credit_referral_rewards",
+        "schedule": timedelta(seconds=REFERRAL_REWARD_INTERVAL),  # Начисляем рефералам бонус от заработка друзей
     },
 }
 
@@ -178,6 +263,10 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
+    'DEFAULT_RENDERER_CLASSES': [
+        'app_core.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
 # Настройки Swagger.
@@ -0,0 +1,44 @@
+"""
+Настройки для тестов и локальных прогонов без Postgres и Redis: SQLite, fakeredis (с поддержкой Lua), channel
+layer и кэш в памяти процесса, задачи Celery выполняются сразу в вызывающем процессе.
+
+    python manage.py test --settings=dogs.test_settings
+    python manage.py loadtest --players 20 --settings=dogs.test_settings
+
+Нужны пакеты из requirements-dev.txt.
+"""
+import fakeredis
+from dogs.settings import *
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / 'test_db.sqlite3',
+        "TEST": {"NAME": BASE_DIR / 'test_db_test.sqlite3'},
+    }
+}
+# SQLite не поддерживает INCLUDE в индексах, индекс создаётся без него
+SILENCED_SYSTEM_CHECKS = ['models.W040']
+
+# Оба клиента работают с одним сервером в памяти, как настоящие клиенты с одним Redis
+REDIS_SERVER = fakeredis.FakeServer()
+REDIS_INSTANCE = fakeredis.FakeStrictRedis(server=REDIS_SERVER)
+REDIS_ASYNC_INSTANCE = fakeredis.FakeAsyncRedis(server=REDIS_SERVER)
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+}
+CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+    },
+}
+
+CELERY_TASK_ALWAYS_EAGER = True
+CELERY_TASK_EAGER_PROPAGATES = True
+CELERY_BROKER_URL = 'memory://'
+CELERY_RESULT_BACKEND = 'cache+memory://'
+
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']